@@ -0,0 +1,160 @@
+'''
+Measures the throughput of the queue backends with a growing number of
+consumers, and how much publishing in batches gains over publishing each
+message on its own, see the ``harvester queue_benchmark`` and ``harvester
+publish_benchmark`` commands.
+
+The messages go to a queue of their own, so harvesting is not affected,
+but the backends are loaded while it runs.
+'''
+import time
+import logging
+import multiprocessing
+
+from ckan import model
+from ckan.lib.base import config
+
+from ckanext.harvest.queue import get_publisher, get_consumer
+
+log = logging.getLogger(__name__)
+
+
+class BenchmarkError(Exception):
+    pass
+
+WORKER_COUNTS = (1, 4, 16)
+
+# seconds the workers get to consume all the messages
+TIMEOUT = 600
+
+
+def get_benchmark_queue():
+    '''Returns the queue name and routing key used for the benchmark'''
+    site_id = config.get('ckan.site_id', 'default')
+    return ('ckan.harvest.{0}.benchmark'.format(site_id),
+            'ckanext-harvest:{0}:benchmark'.format(site_id))
+
+
+def run_benchmark(backends, messages, worker_counts=WORKER_COUNTS,
+                  timeout=TIMEOUT):
+    '''
+    Publishes ``messages`` messages and consumes them with each number of
+    workers in ``worker_counts``, for each backend.
+
+    The workers are separate processes, so the ``local`` backend, whose
+    queues only exist in the process using them, can't be measured. A
+    ``BenchmarkError`` is raised if the workers die or take more than
+    ``timeout`` seconds.
+
+    Returns a list of ``(backend, workers, published per second, consumed
+    per second)`` tuples.
+    '''
+    if 'local' in backends:
+        raise BenchmarkError('The local backend can only be consumed by the '
+                             'process that publishes, and can\'t be measured')
+    results = []
+    configured_backend = config.get('ckan.harvest.mq.type')
+    try:
+        for backend in backends:
+            config['ckan.harvest.mq.type'] = backend
+            for workers in worker_counts:
+                published, consumed = _measure(workers, messages,
+                                               timeout)
+                log.info('%s with %i workers: %.0f published/s, '
+                         '%.0f consumed/s', backend, workers, published,
+                         consumed)
+                results.append((backend, workers, published, consumed))
+    finally:
+        config['ckan.harvest.mq.type'] = configured_backend
+    return results
+
+
+def run_publish_benchmark(backends, messages):
+    '''
+    Publishes ``messages`` messages one at a time with ``send``, as the
+    gather stage used to, and then in batches with ``send_many``, for each
+    backend.
+
+    Returns a list of ``(backend, sent per second, sent in batches per
+    second)`` tuples.
+    '''
+    results = []
+    configured_backend = config.get('ckan.harvest.mq.type')
+    try:
+        for backend in backends:
+            config['ckan.harvest.mq.type'] = backend
+            single = _measure_publish(messages, batched=False)
+            batched = _measure_publish(messages, batched=True)
+            log.info('%s: %.0f sent/s, %.0f sent in batches/s', backend,
+                     single, batched)
+            results.append((backend, single, batched))
+    finally:
+        config['ckan.harvest.mq.type'] = configured_backend
+    return results
+
+
+def _measure_publish(messages, batched):
+    queue_name, routing_key = get_benchmark_queue()
+    consumer = get_consumer(queue_name, routing_key)
+    consumer.queue_purge(queue=queue_name)
+
+    publisher = get_publisher(routing_key)
+    bodies = ({'benchmark': i} for i in range(messages))
+    start = time.time()
+    if batched:
+        publisher.send_many(bodies)
+    else:
+        for body in bodies:
+            publisher.send(body)
+    rate = messages / (time.time() - start)
+    publisher.close()
+    consumer.queue_purge(queue=queue_name)
+    return rate
+
+
+def _measure(num_workers, messages, timeout=TIMEOUT):
+    queue_name, routing_key = get_benchmark_queue()
+    get_consumer(queue_name, routing_key).queue_purge(queue=queue_name)
+
+    publisher = get_publisher(routing_key)
+    start = time.time()
+    publisher.send_many({'benchmark': i} for i in range(messages))
+    published = messages / (time.time() - start)
+    publisher.close()
+
+    # Don't let the workers inherit the database connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+    processed = multiprocessing.Value('i', 0)
+    workers = [multiprocessing.Process(target=_consume,
+                                       args=(queue_name, routing_key,
+                                             processed))
+               for i in range(num_workers)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    try:
+        while processed.value < messages:
+            if not any(worker.is_alive() for worker in workers):
+                raise BenchmarkError(
+                    'The workers died after consuming %i of %i messages' %
+                    (processed.value, messages))
+            if time.time() - start > timeout:
+                raise BenchmarkError(
+                    'Only %i of %i messages were consumed in %i seconds' %
+                    (processed.value, messages, timeout))
+            time.sleep(0.01)
+        consumed = messages / (time.time() - start)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+    return published, consumed
+
+
+def _consume(queue_name, routing_key, processed):
+    consumer = get_consumer(queue_name, routing_key)
+    for method, header, body in consumer.consume(queue=queue_name):
+        consumer.basic_ack(method.delivery_tag)
+        with processed.get_lock():
+            processed.value += 1
@@ -15,6 +15,17 @@ class Harvester(CkanCommand):
       harvester initdb
         - Creates the necessary tables in the database
 
+      harvester migrate
+        - Updates the harvest tables and creates their missing indexes with
+          CREATE INDEX CONCURRENTLY, so harvesting can go on meanwhile. It
+          reports the progress and can be run again safely
+
+      harvester backfill_job_stats
+        - counts the objects and errors of the existing harvest jobs, which
+          are kept up to date afterwards, so job reports don't have to count
+          them every time. Run it once after upgrading, and again once the
+          jobs that were running have finished
+
       harvester source {name} {url} {type} [{title}] [{active}] [{owner_org}] [{frequency}] [{config}]
         - create new harvest source
 
@@ -62,21 +73,66 @@ class Harvester(CkanCommand):
           import) without involving the web UI or the queue backends. This is
           useful for testing a harvester without having to fire up
           gather/fetch_consumer processes, as is done in production.
+          With the local queue backend the stages are run by its threads,
+          concurrently as they would be in production.
 
       harvester gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+      harvester [--workers={n}] [--threads] [--concurrency={n}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          The --workers option runs n consumers, as separate processes or,
+          with --threads, as threads of the same process. Workers that crash
+          are restarted, and on SIGTERM they finish the object they are
+          processing before exiting.
+
+          The --concurrency option makes each consumer process handle up to
+          n messages at a time, in a pool of threads.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
+      harvester queue_stats
+        - shows how many messages are waiting, in flight and delayed in the
+          gather and fetch queues, the number of consumers, how long the
+          oldest job or object has waited and the objects waiting by source
+
+      harvester queue_benchmark [{backends}] [{messages}]
+        - measures how many messages per second the queue backends publish
+          and consume with 1, 4 and 16 consumers. Backends are given as a
+          comma separated list (default: redis,postgres), and 10000 messages
+          are used by default. A separate queue is used, so it doesn't
+          interfere with harvesting, but it does load the backends.
+
+      harvester publish_benchmark [{backends}] [{messages}]
+        - measures how many messages per second the queue backends publish
+          one at a time and in batches of ckan.harvest.mq.publish_batch_size.
+          Backends are given as a comma separated list (default:
+          redis,amqp), and 10000 messages are used by default, on a separate
+          queue.
+
+      harvester [--limit={n}] dlq list|replay|purge [gather|fetch]
+        - manage the messages that could not be processed and were set
+          aside in the dead letter queues, for the given stage or both
+
+          list shows the messages, with their error and number of attempts,
+          replay puts them back on their queue and purge deletes them. With
+          --limit, only the n oldest ones are listed or replayed.
+
       harvester clean_harvest_log
         - Clean-up mechanism for the harvest log table.
           You can configure the time frame through the configuration
           parameter `ckan.harvest.log_timeframe`. The default time frame is 30 days
 
+      harvester archive_objects [{days}]
+        - moves the harvest objects that are no longer current and are older
+          than the given number of days (by default the configuration
+          parameter `ckan.harvest.object_retention_days`, or 90) to the
+          harvest_object_archive table, in batches of
+          `ckan.harvest.archive_batch_size` (1000). harvest_object_show
+          still finds the archived objects by id
+
       harvester [-j] [-o|-g|-p {id/guid}] [--segments={segments}] import [{source-id}]
         - perform the import stage with the last fetched objects, for a certain
           source or a single harvest object. Please note that no objects will
@@ -135,6 +191,21 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--workers', dest='workers', type='int',
+            default=1, help='Number of fetch consumers to run')
+
+        self.parser.add_option('--threads', dest='threads',
+            action='store_true', default=False,
+            help='Run the fetch consumers as threads instead of processes')
+
+        self.parser.add_option('--concurrency', dest='concurrency',
+            type='int', default=1,
+            help='Number of fetch messages each consumer process handles '
+                 'at a time')
+
+        self.parser.add_option('--limit', dest='limit', type='int',
+            default=None, help='Maximum number of dead letters to handle')
+
     def command(self):
         self._load_config()
 
@@ -184,6 +255,21 @@ class Harvester(CkanCommand):
         elif cmd == 'fetch_consumer':
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
+            if self.options.concurrency > 1 and self.options.threads:
+                print 'The --concurrency and --threads options can not be ' \
+                      'used together'
+                sys.exit(1)
+            if self.options.workers > 1 or self.options.threads:
+                from ckanext.harvest.workers import FetchWorkers
+                FetchWorkers(self.options.workers,
+                             use_threads=self.options.threads,
+                             concurrency=self.options.concurrency).run()
+                return
+            if self.options.concurrency > 1:
+                from ckanext.harvest.workers import \
+                    run_concurrent_fetch_consumer
+                run_concurrent_fetch_consumer(self.options.concurrency)
+                return
             from ckanext.harvest.queue import (get_fetch_consumer, fetch_callback,
                 get_fetch_queue_name)
             consumer = get_fetch_consumer()
@@ -191,8 +277,20 @@ class Harvester(CkanCommand):
                fetch_callback(consumer, method, header, body)
         elif cmd == 'purge_queues':
             self.purge_queues()
+        elif cmd == 'dlq':
+            self.dead_letters()
+        elif cmd == 'queue_stats':
+            self.queue_stats()
+        elif cmd == 'queue_benchmark':
+            self.queue_benchmark()
+        elif cmd == 'publish_benchmark':
+            self.publish_benchmark()
         elif cmd == 'initdb':
             self.initdb()
+        elif cmd == 'migrate':
+            self.migrate()
+        elif cmd == 'backfill_job_stats':
+            self.backfill_job_stats()
         elif cmd == 'import':
             self.initdb()
             self.import_stage()
@@ -203,6 +301,8 @@ class Harvester(CkanCommand):
             pprint(harvesters_info)
         elif cmd == 'reindex':
             self.reindex()
+        elif cmd == 'archive_objects':
+            self.archive_objects()
         elif cmd == 'clean_harvest_log':
             self.clean_harvest_log()
         else:
@@ -217,6 +317,27 @@ class Harvester(CkanCommand):
 
         print 'DB tables created'
 
+    def migrate(self):
+        from ckanext.harvest.model import (setup as db_setup,
+                                           create_indexes_concurrently)
+        db_setup()
+
+        def report(message):
+            print message
+            sys.stdout.flush()
+
+        create_indexes_concurrently(report)
+
+    def backfill_job_stats(self):
+        from ckanext.harvest.model import backfill_job_stats
+
+        def report(message):
+            print message
+            sys.stdout.flush()
+
+        total = backfill_job_stats(report=report)
+        print 'Harvest job stats backfilled for %i jobs' % total
+
     def create_harvest_source(self):
 
         if len(self.args) >= 2:
@@ -415,6 +536,7 @@ class Harvester(CkanCommand):
         get_action('harvest_jobs_run')(context, {})
 
     def run_test_harvest(self):
+        from pylons import config
         from ckanext.harvest import queue
         from ckanext.harvest.tests import lib
         from ckanext.harvest.logic import HarvestJobExists
@@ -458,7 +580,16 @@ class Harvester(CkanCommand):
         harvester = queue.get_harvester(source['source_type'])
         assert harvester, \
             'No harvester found for type: %s' % source['source_type']
-        lib.run_harvest_job(job_obj, harvester)
+        if config.get('ckan.harvest.mq.type') == 'local':
+            # the job goes through the queues, processed by the threads of
+            # this process
+            get_action('harvest_send_job_to_gather_queue')(
+                context, {'id': job_obj.id})
+            queue.join_local_queues()
+            get_action('harvest_jobs_run')(
+                context, {'source_id': source['id']})
+        else:
+            lib.run_harvest_job(job_obj, harvester)
 
     def import_stage(self):
 
@@ -499,6 +630,99 @@ class Harvester(CkanCommand):
         from ckanext.harvest.queue import purge_queues
         purge_queues()
 
+    def queue_stats(self):
+        from ckanext.harvest.queue import get_queue_status
+
+        def show(value):
+            return '-' if value is None else str(value)
+
+        status = get_queue_status()
+        print '%-8s %8s %10s %8s %10s %12s' % (
+            'queue', 'depth', 'in flight', 'delayed', 'consumers',
+            'oldest age')
+        for stage in ('gather', 'fetch'):
+            stats = status[stage]
+            print '%-8s %8s %10s %8s %10s %12s' % (
+                stage, show(stats['depth']), show(stats['in_flight']),
+                show(stats['delayed']), show(stats['consumers']),
+                show(stats['oldest_age']))
+        sources = status['fetch']['sources']
+        if sources:
+            print '\nHarvest objects waiting to be fetched by source:'
+            for source_id, count in sorted(sources.items(),
+                                           key=lambda item: -item[1]):
+                print '%-40s %8i' % (source_id, count)
+
+    def queue_benchmark(self):
+        from ckanext.harvest.benchmark import run_benchmark, BenchmarkError
+
+        backends = ['redis', 'postgres']
+        if len(self.args) >= 2:
+            backends = self.args[1].split(',')
+        messages = 10000
+        if len(self.args) >= 3:
+            messages = int(self.args[2])
+
+        try:
+            results = run_benchmark(backends, messages)
+        except BenchmarkError, e:
+            print str(e)
+            sys.exit(1)
+        print '%-10s %8s %12s %12s' % ('backend', 'workers', 'published/s',
+                                       'consumed/s')
+        for backend, workers, published, consumed in results:
+            print '%-10s %8i %12.0f %12.0f' % (backend, workers, published,
+                                               consumed)
+
+    def publish_benchmark(self):
+        from ckanext.harvest.benchmark import run_publish_benchmark
+
+        backends = ['redis', 'amqp']
+        if len(self.args) >= 2:
+            backends = self.args[1].split(',')
+        messages = 10000
+        if len(self.args) >= 3:
+            messages = int(self.args[2])
+
+        results = run_publish_benchmark(backends, messages)
+        print '%-10s %12s %12s %8s' % ('backend', 'single/s', 'batched/s',
+                                       'speedup')
+        for backend, single, batched in results:
+            print '%-10s %12.0f %12.0f %7.1fx' % (backend, single, batched,
+                                                  batched / single)
+
+    def dead_letters(self):
+        from ckanext.harvest.queue import (list_dead_letters,
+            replay_dead_letters, purge_dead_letters)
+
+        if len(self.args) < 2 or self.args[1] not in ('list', 'replay', 'purge'):
+            print 'Please provide a dlq command: list, replay or purge'
+            sys.exit(1)
+        dlq_cmd = self.args[1]
+        stages = self.args[2:3] or ['gather', 'fetch']
+        for stage in stages:
+            if stage not in ('gather', 'fetch'):
+                print 'Unknown stage %s, use gather or fetch' % stage
+                sys.exit(1)
+
+        for stage in stages:
+            if dlq_cmd == 'list':
+                entries = list_dead_letters(stage, limit=self.options.limit)
+                for entry in entries:
+                    print '   failed: %s' % entry.get('failed')
+                    print ' attempts: %s' % entry.get('attempts')
+                    print '     body: %s' % entry.get('body')
+                    print '    error: %s' % entry.get('error')
+                    print ''
+                self.print_there_are('%s dead letter' % stage, entries)
+            elif dlq_cmd == 'replay':
+                count = replay_dead_letters(stage, limit=self.options.limit)
+                print 'Replayed %i messages to the %s queue' % (count, stage)
+            else:
+                count = purge_dead_letters(stage)
+                print 'Purged %i messages from the %s dead letter queue' % (
+                    count, stage)
+
     def print_harvest_sources(self, sources):
         if sources:
             print ''
@@ -563,3 +787,25 @@ class Harvester(CkanCommand):
         
         # Delete logs older then the given date
         clean_harvest_log(condition=condition)
+
+    def archive_objects(self):
+        from datetime import datetime, timedelta
+        from pylons import config
+        from ckanext.harvest.model import archive_harvest_objects
+
+        if len(self.args) >= 2:
+            days = toolkit.asint(self.args[1])
+        else:
+            days = toolkit.asint(
+                config.get('ckan.harvest.object_retention_days', 90))
+        batch_size = toolkit.asint(
+            config.get('ckan.harvest.archive_batch_size', 1000))
+
+        def report(message):
+            print message
+            sys.stdout.flush()
+
+        total = archive_harvest_objects(
+            datetime.utcnow() - timedelta(days=days), batch_size, report)
+        print 'Archived %i harvest objects older than %i days' % (total,
+                                                                  days)
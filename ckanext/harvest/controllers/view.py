@@ -19,6 +19,7 @@ from ckan.lib.base import BaseController, c, \
 
 from ckanext.harvest.logic import HarvestJobExists, HarvestSourceInactiveError
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
+from ckanext.harvest.queue import PRIORITY_HIGH
 
 import logging
 log = logging.getLogger(__name__)
@@ -56,8 +57,10 @@ class ViewController(BaseController):
     def refresh(self, id):
         try:
             context = {'model':model, 'user':c.user, 'session':model.Session}
+            # jobs started by hand go ahead of the scheduled ones
             p.toolkit.get_action('harvest_job_create')(
-                context, {'source_id': id, 'run': True})
+                context, {'source_id': id, 'run': True,
+                          'priority': PRIORITY_HIGH})
             h.flash_success(_('Harvest will start shortly. Refresh this page for updates.'))
         except p.toolkit.ObjectNotFound:
             abort(404,_('Harvest source not found'))
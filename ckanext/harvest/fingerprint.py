@@ -0,0 +1,133 @@
+'''
+Detection of harvest objects whose document hasn't changed since it was
+last imported, so they are not fetched and imported again
+(``ckan.harvest.skip_unchanged``).
+
+The fingerprint of a harvest object is a hash of its content, normalized
+so formatting changes don't count, its extras and the configuration of its
+source, so changing the source configuration imports everything again. It
+is stored on the object, and compared with the one of the current object
+for the same guid: objects harvested with their content during the gather
+stage are compared there, and never sent to the fetch queue if unchanged.
+Others are compared once their fetch stage has run, skipping the import.
+'''
+import json
+import logging
+import hashlib
+
+from ckan import model
+from ckan.lib.base import config
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestObject
+
+log = logging.getLogger(__name__)
+
+# guids looked up per query
+LOOKUP_BATCH_SIZE = 1000
+
+
+def skip_unchanged_enabled():
+    return toolkit.asbool(config.get('ckan.harvest.skip_unchanged', False))
+
+
+def get_fingerprint(obj):
+    '''
+    Returns the fingerprint of a harvest object, or None if it has no
+    content yet.
+    '''
+    content = obj.content
+    if content is None:
+        return None
+    try:
+        content = json.dumps(json.loads(content), sort_keys=True,
+                             separators=(',', ':'))
+    except ValueError:
+        # XML and others: ignore indentation and line endings
+        content = u'\n'.join(line.strip() for line in content.splitlines())
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    extras = sorted((extra.key, extra.value) for extra in obj.extras)
+    source_config = obj.source.config if obj.source else None
+
+    fingerprint = hashlib.sha256(content)
+    fingerprint.update(json.dumps([extras, source_config]))
+    return unicode(fingerprint.hexdigest())
+
+
+def get_current_fingerprints(source_id, guids):
+    '''
+    Returns the fingerprints of the current harvest objects of a source
+    with the given guids, by guid. Only objects whose dataset is still
+    active count.
+    '''
+    guids = list(set(guids))
+    fingerprints = {}
+    for i in range(0, len(guids), LOOKUP_BATCH_SIZE):
+        rows = model.Session.query(HarvestObject.guid,
+                                   HarvestObject.fingerprint) \
+            .join(model.Package,
+                  model.Package.id == HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_source_id == source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.guid.in_(guids[i:i + LOOKUP_BATCH_SIZE])) \
+            .filter(HarvestObject.fingerprint != None) \
+            .filter(model.Package.state == u'active')
+        fingerprints.update(rows)
+    return fingerprints
+
+
+def _is_unchanged(obj, fingerprint, current_fingerprints):
+    return fingerprint is not None and \
+        current_fingerprints.get(obj.guid) == fingerprint
+
+
+def skip_unchanged_objects(job, harvest_object_ids):
+    '''
+    Fingerprints the harvest objects returned by the gather stage that
+    already have their content, and marks the ones that haven't changed as
+    not modified.
+
+    Returns the ids of the objects that still need to be fetched, in the
+    same order.
+    '''
+    if not harvest_object_ids:
+        return harvest_object_ids
+    objects = model.Session.query(HarvestObject) \
+        .filter(HarvestObject.id.in_(harvest_object_ids)) \
+        .all()
+    fingerprints = {}
+    for obj in objects:
+        fingerprints[obj.id] = obj.fingerprint = get_fingerprint(obj)
+
+    current_fingerprints = get_current_fingerprints(
+        job.source_id, [obj.guid for obj in objects
+                        if fingerprints[obj.id] is not None])
+    skipped = set()
+    for obj in objects:
+        if _is_unchanged(obj, fingerprints[obj.id], current_fingerprints):
+            obj.state = u'COMPLETE'
+            obj.report_status = u'not modified'
+            skipped.add(obj.id)
+    model.Session.commit()
+
+    if skipped:
+        log.info('%i of %i harvest objects of job %s are not modified, '
+                 'not fetching them', len(skipped), len(harvest_object_ids),
+                 job.id)
+    return [id for id in harvest_object_ids if id not in skipped]
+
+
+def is_unchanged_after_fetch(obj):
+    '''
+    Fingerprints a harvest object after its fetch stage, unless that was
+    done during the gather stage already, and returns whether it is
+    unchanged and doesn't need importing.
+    '''
+    if obj.fingerprint is not None:
+        return False
+    obj.fingerprint = get_fingerprint(obj)
+    if obj.fingerprint is None:
+        return False
+    return _is_unchanged(obj, obj.fingerprint, get_current_fingerprints(
+        obj.harvest_source_id, [obj.guid]))
@@ -7,7 +7,7 @@ import ckan.plugins as p
 
 from ckanext.harvest.model import UPDATE_FREQUENCIES
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import registry
 
 def package_list_for_source(source_id):
     '''
@@ -104,9 +104,10 @@ def link_for_harvest_object(id=None, guid=None, text=None):
 
 def harvest_source_extra_fields():
     fields = {}
-    for harvester in p.PluginImplementations(IHarvester):
+    for name in registry.get_harvester_names():
+        harvester = registry.get_harvester(name)
         if not hasattr(harvester, 'extra_schema'):
             continue
-        fields[harvester.info()['name']] = harvester.extra_schema().keys()
+        fields[name] = harvester.extra_schema().keys()
     return fields
 
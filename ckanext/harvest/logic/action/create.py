@@ -11,6 +11,7 @@ from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject,
 from ckanext.harvest.logic.dictization import (harvest_job_dictize,
                                                harvest_object_dictize)
 from ckanext.harvest.logic.schema import harvest_object_create_schema
+from ckanext.harvest.queue import PRIORITY_NORMAL, MAX_PRIORITY
 from ckanext.harvest.logic.action.get import (harvest_source_list,
                                               harvest_job_list)
 
@@ -81,12 +82,24 @@ def harvest_job_create(context, data_dict):
     :type source_id: string
     :param run: whether to also run it or not (default: True)
     :type run: bool
+    :param priority: jobs and harvest objects with a higher priority are
+        taken first from the queues, from 0 (the default) to 2. Jobs started
+        from the web interface get 1.
+    :type priority: int
     '''
     log.info('Harvest job create: %r', data_dict)
     check_access('harvest_job_create', context, data_dict)
 
     source_id = data_dict['source_id']
     run_it = data_dict.get('run', True)
+    try:
+        priority = int(data_dict.get('priority') or PRIORITY_NORMAL)
+        if not PRIORITY_NORMAL <= priority <= MAX_PRIORITY:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise toolkit.ValidationError(
+            {'priority': ['Must be an integer between {0} and {1}'.format(
+                PRIORITY_NORMAL, MAX_PRIORITY)]})
 
     # Check if source exists
     source = HarvestSource.get(source_id)
@@ -110,6 +123,7 @@ def harvest_job_create(context, data_dict):
 
     job = HarvestJob()
     job.source = source
+    job.priority = priority
     job.save()
     log.info('Harvest job saved %s', job.id)
 
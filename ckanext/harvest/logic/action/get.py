@@ -1,3 +1,4 @@
+import json
 import logging
 from itertools import groupby
 from sqlalchemy import or_
@@ -5,18 +6,22 @@ from ckan.model import User
 import datetime
 
 from ckan import logic
-from ckan.plugins import PluginImplementations
-from ckanext.harvest.interfaces import IHarvester
+from ckan.lib.base import config
+from ckanext.harvest import registry
 
 import ckan.plugins as p
 from ckan.logic import NotFound, check_access, side_effect_free
 
 from ckanext.harvest import model as harvest_model
 
-from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject, HarvestLog)
+from ckanext.harvest.queue import get_fetch_queue_depths, get_queue_status
+from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject,
+                                   HarvestObjectArchive, HarvestLog)
 from ckanext.harvest.logic.dictization import (harvest_source_dictize,
+                                               harvest_source_list_dictize,
                                                harvest_job_dictize,
                                                harvest_object_dictize,
+                                               harvest_archived_object_dictize,
                                                harvest_log_dictize)
 
 log = logging.getLogger(__name__)
@@ -67,6 +72,12 @@ def harvest_source_show_status(context, data_dict):
     Note that this information is already included on the output of
     harvest_source_show, under the 'status' field.
 
+    Unless its last job is running, the status is cached when the source
+    is reindexed (after each of its jobs finishes), until a job, harvest
+    object or dataset of the source changes, for up to
+    ``ckan.harvest.status_cache_ttl`` seconds (a day by default, 0 disables
+    the cache).
+
     :param id: the id or name of the harvest source
     :type id: string
 
@@ -75,22 +86,45 @@ def harvest_source_show_status(context, data_dict):
 
     p.toolkit.check_access('harvest_source_show_status', context, data_dict)
 
-
-    model = context.get('model')
-
     source = harvest_model.HarvestSource.get(data_dict['id'])
     if not source:
         raise p.toolkit.ObjectNotFound('Harvest source {0} does not exist'.format(data_dict['id']))
 
+    ttl = p.toolkit.asint(config.get('ckan.harvest.status_cache_ttl', 86400))
+    if ttl and not harvest_model.source_status_cache_supported():
+        ttl = 0
+    if ttl:
+        out, version = harvest_model.get_cached_source_status(source.id, ttl)
+        if out is not None:
+            return out
+
+    computed = datetime.datetime.utcnow()
+    # the cached status must not depend on what the caller asked for
+    out = _compute_source_status(source, {'model': context['model']})
+    if ttl and (not out['last_job'] or
+                out['last_job']['status'] not in (u'New', u'Running')):
+        # as the cache stores it, so that it doesn't change once cached
+        # (eg the stats of objects without a report status are under
+        # "null" rather than None)
+        out = json.loads(json.dumps(out))
+        # this action can be called with GET, so only write actions (like
+        # harvest_source_reindex) cache the status
+        if context.get('cache_source_status'):
+            harvest_model.cache_source_status(source.id, out, version,
+                                              computed)
+    return out
+
+
+def _compute_source_status(source, context):
+    model = context.get('model')
+
     out = {
            'job_count': 0,
            'last_job': None,
            'total_datasets': 0,
            }
 
-    jobs = harvest_model.HarvestJob.filter(source=source).all()
-
-    job_count = len(jobs)
+    job_count = harvest_model.HarvestJob.filter(source=source).count()
     if job_count == 0:
         return out
 
@@ -132,7 +166,7 @@ def harvest_source_list(context, data_dict):
 
     last_job_status = p.toolkit.asbool(data_dict.get('return_last_job_status', False))
 
-    return [harvest_source_dictize(source, context, last_job_status) for source in sources]
+    return harvest_source_list_dictize(sources, context, last_job_status)
 
 
 @side_effect_free
@@ -182,10 +216,9 @@ def harvest_job_report(context, data_dict):
     # Check if the harvester for this job's source has a method for returning
     # the URL to the original document
     original_url_builder = None
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == job.source.type:
-             if hasattr(harvester, 'get_original_url'):
-                original_url_builder = harvester.get_original_url
+    harvester = registry.get_harvester(job.source.type)
+    if harvester and hasattr(harvester, 'get_original_url'):
+        original_url_builder = harvester.get_original_url
 
     q = model.Session.query(harvest_model.HarvestObjectError, harvest_model.HarvestObject.guid) \
                       .join(harvest_model.HarvestObject) \
@@ -253,6 +286,11 @@ def harvest_object_show(context,data_dict):
     if id:
         attr = data_dict.get('attr',None)
         obj = HarvestObject.get(id,attr=attr)
+        if not obj and attr in (None, 'id'):
+            # It may have been moved out by the archive_objects command
+            archived = HarvestObjectArchive.get(id)
+            if archived:
+                return harvest_archived_object_dictize(archived, context)
     elif dataset_id:
         model = context['model']
 
@@ -304,11 +342,7 @@ def harvesters_info_show(context,data_dict):
     check_access('harvesters_info_show',context,data_dict)
 
     available_harvesters = []
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if not info or 'name' not in info:
-            log.error('Harvester %r does not provide the harvester name in the info response' % str(harvester))
-            continue
+    for info in registry.get_harvesters_info():
         info['show_config'] = (info.get('form_config_interface','') == 'Text')
         available_harvesters.append(info)
 
@@ -357,6 +391,46 @@ def harvest_log_list(context,data_dict):
     out = [harvest_log_dictize(obj, context) for obj in logs]        
     return out
 
+@side_effect_free
+def harvest_fetch_queue_depths(context, data_dict):
+    '''Returns the number of messages waiting in the fetch queue for each
+    harvest source, largest first.
+
+    The messages are only kept by source when using the Redis backend with
+    ``ckan.harvest.mq.fair_queue`` enabled, otherwise the list is empty.
+    Messages put back on the queue after a timeout are listed with a
+    ``source_id`` of ``None``.
+
+    :returns: list of dicts with ``source_id`` and ``depth`` keys
+    :rtype: list
+    '''
+    check_access('harvest_fetch_queue_depths', context, data_dict)
+
+    depths = get_fetch_queue_depths()
+    return [{'source_id': source_id, 'depth': depth}
+            for source_id, depth in sorted(depths.items(),
+                                           key=lambda item: -item[1])]
+
+@side_effect_free
+def harvest_queue_status(context, data_dict):
+    '''Returns the state of the gather and fetch queues, to monitor them and
+    decide how many consumers to run.
+
+    For each queue there is the number of messages waiting (``depth``),
+    taken by a consumer but not acknowledged yet (``in_flight``) and
+    waiting to be retried (``delayed``), the number of ``consumers`` and
+    how many seconds the oldest job or object waiting has waited
+    (``oldest_age``). The fetch queue also has the number of harvest
+    objects waiting by source id (``sources``). Values that the queue
+    backend can't tell are ``None``.
+
+    :returns: dict with ``gather`` and ``fetch`` keys
+    :rtype: dict
+    '''
+    check_access('harvest_queue_status', context, data_dict)
+
+    return get_queue_status()
+
 def _get_sources_for_user(context,data_dict):
 
     model = context['model']
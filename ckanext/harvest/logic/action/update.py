@@ -8,9 +8,7 @@ from pylons import config
 from sqlalchemy import and_, or_
 
 from ckan.lib.search.index import PackageSearchIndex
-from ckan.plugins import PluginImplementations
 from ckan.logic import get_action
-from ckanext.harvest.interfaces import IHarvester
 from ckan.lib.search.common import SearchIndexError, make_connection
 
 
@@ -21,6 +19,7 @@ from ckan.plugins import toolkit
 
 from ckan.logic import NotFound, check_access
 
+from ckanext.harvest import registry
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
 from ckanext.harvest.queue import get_gather_publisher, resubmit_jobs
 
@@ -171,8 +170,13 @@ def harvest_source_clear(context, data_dict):
         select id from harvest_object
         where harvest_source_id = '{harvest_source_id}');
     delete from harvest_object where harvest_source_id = '{harvest_source_id}';
+    delete from harvest_object_archive where harvest_source_id = '{harvest_source_id}';
     delete from harvest_gather_error where harvest_job_id in (
         select id from harvest_job where source_id = '{harvest_source_id}');
+    delete from harvest_job_stats where harvest_job_id in (
+        select id from harvest_job where source_id = '{harvest_source_id}');
+    update harvest_source_status set status = null, cached = null,
+        version = version + 1 where source_id = '{harvest_source_id}';
     delete from harvest_job where source_id = '{harvest_source_id}';
     delete from package_tag_revision where package_id in (
         select id from package where state = 'to_delete');
@@ -279,7 +283,10 @@ def harvest_source_job_history_clear(context, data_dict):
     delete from harvest_object_error where harvest_object_id in (select id from harvest_object where harvest_source_id = '{harvest_source_id}');
     delete from harvest_object_extra where harvest_object_id in (select id from harvest_object where harvest_source_id = '{harvest_source_id}');
     delete from harvest_object where harvest_source_id = '{harvest_source_id}';
+    delete from harvest_object_archive where harvest_source_id = '{harvest_source_id}';
     delete from harvest_gather_error where harvest_job_id in (select id from harvest_job where source_id = '{harvest_source_id}');
+    delete from harvest_job_stats where harvest_job_id in (select id from harvest_job where source_id = '{harvest_source_id}');
+    update harvest_source_status set status = null, cached = null, version = version + 1 where source_id = '{harvest_source_id}';
     delete from harvest_job where source_id = '{harvest_source_id}';
     commit;
     '''.format(harvest_source_id=harvest_source_id)
@@ -430,12 +437,11 @@ def harvest_objects_import(context, data_dict):
 
         obj = session.query(HarvestObject).get(obj_id)
 
-        for harvester in PluginImplementations(IHarvester):
-            if harvester.info()['name'] == obj.source.type:
-                if hasattr(harvester, 'force_import'):
-                    harvester.force_import = True
-                harvester.import_stage(obj)
-                break
+        harvester = registry.get_harvester(obj.source.type)
+        if harvester:
+            if hasattr(harvester, 'force_import'):
+                harvester.force_import = True
+            harvester.import_stage(obj)
         last_objects_count += 1
     log.info('Harvest objects imported: %s', last_objects_count)
     return last_objects_count
@@ -587,7 +593,7 @@ def harvest_send_job_to_gather_queue(context, data_dict):
     job_obj = HarvestJob.get(job['id'])
     job_obj.status = job['status'] = u'Running'
     job_obj.save()
-    publisher.send({'harvest_job_id': job['id']})
+    publisher.send({'harvest_job_id': job['id']}, priority=job_obj.priority)
     log.info('Sent job %s to the gather queue', job['id'])
 
     return harvest_job_dictize(job_obj, context)
@@ -699,7 +705,9 @@ def harvest_source_reindex(context, data_dict):
 
     if 'extras_as_string'in context:
         del context['extras_as_string']
-    context.update({'ignore_auth': True})
+    # the status added to the source is cached (see
+    # harvest_source_show_status)
+    context.update({'ignore_auth': True, 'cache_source_status': True})
     package_dict = logic.get_action('harvest_source_show')(
         context, {'id': harvest_source_id})
     log.debug('Updating search index for harvest source: %s',
@@ -1,6 +1,6 @@
 from ckan.plugins import toolkit as pt
 
-from ckanext.harvest.logic.auth import get_job_object
+from ckanext.harvest.logic.auth import get_job_object, user_is_sysadmin
 
 
 
@@ -132,3 +132,29 @@ def harvesters_info_show(context, data_dict):
         Everybody can do it
     '''
     return {'success': True}
+
+
+def harvest_fetch_queue_depths(context, data_dict):
+    '''
+        Authorization check for getting the number of messages waiting in the
+        fetch queue for each source
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can see the state of the fetch queue')}
+    else:
+        return {'success': True}
+
+
+def harvest_queue_status(context, data_dict):
+    '''
+        Authorization check for getting the state of the gather and fetch
+        queues
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can see the state of the queues')}
+    else:
+        return {'success': True}
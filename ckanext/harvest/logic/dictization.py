@@ -3,25 +3,48 @@ from sqlalchemy import distinct, func
 from ckan.model import Package, Group
 from ckan import logic
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject,
-                                   HarvestGatherError, HarvestObjectError)
+                                   HarvestGatherError, HarvestObjectError,
+                                   HarvestJobStats)
 
 
 def harvest_source_dictize(source, context, last_job_status=False):
-    out = source.as_dict()
+    return harvest_source_list_dictize([source], context, last_job_status)[0]
 
-    out['publisher_title'] = u''
 
-    publisher_id = out.get('publisher_id')
-    if publisher_id:
-        group = Group.get(publisher_id)
-        if group:
-            out['publisher_title'] = group.title
-
-    out['status'] = _get_source_status(source, context)
+def harvest_source_list_dictize(sources, context, last_job_status=False):
+    '''
+    Dictizes several harvest sources, with the same output as
+    harvest_source_dictize, querying their publishers and statuses for all
+    of them at once.
+    '''
+    model = context['model']
 
-    if last_job_status:
-        source_status = logic.get_action('harvest_source_show_status')(context, {'id': source.id})
-        out['last_job_status'] = source_status.get('last_job', {})
+    publisher_ids = set(source.publisher_id for source in sources
+                        if source.publisher_id)
+    publisher_titles = {}
+    if publisher_ids:
+        publisher_titles = dict(model.Session.query(Group.id, Group.title)
+                                .filter(Group.id.in_(publisher_ids)))
+        # like Group.get, fall back to names
+        names = publisher_ids - set(publisher_titles)
+        if names:
+            publisher_titles.update(
+                model.Session.query(Group.name, Group.title)
+                .filter(Group.name.in_(names)))
+
+    statuses = _get_sources_status(sources, context)
+
+    out = []
+    for source in sources:
+        source_dict = source.as_dict()
+        source_dict['publisher_title'] = \
+            publisher_titles.get(source.publisher_id, u'')
+        source_dict['status'] = statuses[source.id]
+
+        if last_job_status:
+            source_status = logic.get_action('harvest_source_show_status')(context, {'id': source.id})
+            source_dict['last_job_status'] = source_status.get('last_job', {})
+        out.append(source_dict)
 
     return out
 
@@ -32,32 +55,16 @@ def harvest_job_dictize(job, context):
     model = context['model']
 
     if context.get('return_stats', True):
-        stats = model.Session.query(
-            HarvestObject.report_status,
-            func.count(HarvestObject.id).label('total_objects'))\
-            .filter_by(harvest_job_id=job.id)\
-            .group_by(HarvestObject.report_status).all()
-        out['stats'] = {'added': 0, 'updated': 0, 'not modified': 0,
-                        'errored': 0, 'deleted': 0}
-        for status, count in stats:
-            out['stats'][status] = count
-
-        # We actually want to check which objects had errors, because they
-        # could have been added/updated anyway (eg bbox errors)
-        count = model.Session.query(
-            func.distinct(HarvestObjectError.harvest_object_id)) \
-            .join(HarvestObject) \
-            .filter(HarvestObject.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = count
-
-        # Add gather errors to the error count
-        count = model.Session.query(HarvestGatherError) \
-            .filter(HarvestGatherError.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = out['stats'].get('errored', 0) + count
+        # they are updated with SQL, so don't use a copy the session has
+        job_stats = model.Session.query(HarvestJobStats) \
+            .populate_existing() \
+            .filter_by(harvest_job_id=job.id).first()
+        if job_stats:
+            out['stats'] = job_stats.as_stats()
+        else:
+            # jobs from before harvest_job_stats existed, until it is
+            # backfilled
+            out['stats'] = _count_job_stats(job, context)
 
     if context.get('return_error_summary', True):
         q = model.Session.query(
@@ -80,6 +87,38 @@ def harvest_job_dictize(job, context):
     return out
 
 
+def _count_job_stats(job, context):
+    model = context['model']
+
+    stats = model.Session.query(
+        HarvestObject.report_status,
+        func.count(HarvestObject.id).label('total_objects'))\
+        .filter_by(harvest_job_id=job.id)\
+        .group_by(HarvestObject.report_status).all()
+    out = {'added': 0, 'updated': 0, 'not modified': 0,
+           'errored': 0, 'deleted': 0}
+    for status, count in stats:
+        out[status] = count
+
+    # We actually want to check which objects had errors, because they
+    # could have been added/updated anyway (eg bbox errors)
+    count = model.Session.query(
+        func.distinct(HarvestObjectError.harvest_object_id)) \
+        .join(HarvestObject) \
+        .filter(HarvestObject.harvest_job_id == job.id) \
+        .count()
+    if count > 0:
+        out['errored'] = count
+
+    # Add gather errors to the error count
+    count = model.Session.query(HarvestGatherError) \
+        .filter(HarvestGatherError.harvest_job_id == job.id) \
+        .count()
+    if count > 0:
+        out['errored'] = out.get('errored', 0) + count
+    return out
+
+
 def harvest_object_dictize(obj, context):
     out = obj.as_dict()
     out['source'] = obj.harvest_source_id
@@ -98,6 +137,23 @@ def harvest_object_dictize(obj, context):
 
     return out
 
+def harvest_archived_object_dictize(obj, context):
+    '''Dictizes a HarvestObjectArchive like harvest_object_dictize would
+    have done before it was archived, plus the date it was archived'''
+    out = obj.as_dict()
+    out['content'] = obj.get_content()
+    out['current'] = False
+    out['source'] = obj.harvest_source_id
+    out['job'] = obj.harvest_job_id
+
+    if obj.package_id:
+        out['package'] = obj.package_id
+
+    out['errors'] = obj.get_errors()
+    out['extras'] = obj.get_extras()
+
+    return out
+
 def harvest_log_dictize(obj, context):
     out = obj.as_dict()
     del out['id']
@@ -108,60 +164,99 @@ def _get_source_status(source, context):
     '''
     TODO: Deprecated, use harvest_source_show_status instead
     '''
+    return _get_sources_status([source], context)[source.id]
 
-    model = context.get('model')
 
-    out = dict()
-
-    job_count = HarvestJob.filter(source=source).count()
-
-    out = {
-        'job_count': 0,
-        'next_harvest': '',
-        'last_harvest_request': '',
-        'overall_statistics': {'added': 0, 'errors': 0},
-        }
-
-    if not job_count:
-        out['msg'] = 'No jobs yet'
-        return out
-    else:
-        out['job_count'] = job_count
-
-    # Get next scheduled job
-    next_job = HarvestJob.filter(source=source, status=u'New').first()
-    if next_job:
-        out['next_harvest'] = 'Scheduled'
-    else:
-        out['next_harvest'] = 'Not yet scheduled'
-
-    # Get the last finished job
-    last_job = HarvestJob.filter(source=source, status=u'Finished') \
-        .order_by(HarvestJob.created.desc()).first()
-
-    if last_job:
-        #TODO: Should we encode the dates as strings?
-        out['last_harvest_request'] = str(last_job.gather_finished)
-
-        # Overall statistics
-        packages = model.Session.query(distinct(HarvestObject.package_id),
-                                       Package.name) \
-            .join(Package).join(HarvestSource) \
-            .filter(HarvestObject.source == source) \
-            .filter(HarvestObject.current == True) \
-            .filter(Package.state == u'active')
-
-        out['overall_statistics']['added'] = packages.count()
-
-        gather_errors = model.Session.query(HarvestGatherError) \
-            .join(HarvestJob).join(HarvestSource) \
-            .filter(HarvestJob.source == source).count()
-
-        object_errors = model.Session.query(HarvestObjectError) \
-            .join(HarvestObject).join(HarvestJob).join(HarvestSource) \
-            .filter(HarvestJob.source == source).count()
-        out['overall_statistics']['errors'] = gather_errors + object_errors
-    else:
-        out['last_harvest_request'] = 'Not yet harvested'
+def _get_sources_status(sources, context):
+    '''
+    Returns the status of each source, by id, with a query for each figure
+    grouped by source rather than queries for each source. Sources without
+    jobs only need the first one.
+    '''
+    model = context.get('model')
 
-    return out
+    statuses = {}
+    for source in sources:
+        statuses[source.id] = {
+            'job_count': 0,
+            'next_harvest': '',
+            'last_harvest_request': '',
+            'overall_statistics': {'added': 0, 'errors': 0},
+            'msg': 'No jobs yet',
+            }
+    if not statuses:
+        return statuses
+
+    job_counts = dict(model.Session.query(HarvestJob.source_id,
+                                          func.count(HarvestJob.id))
+                      .filter(HarvestJob.source_id.in_(list(statuses)))
+                      .group_by(HarvestJob.source_id))
+    source_ids = list(job_counts)
+    if not source_ids:
+        return statuses
+
+    # Sources with a scheduled job
+    scheduled = set(row[0] for row in model.Session.query(
+        distinct(HarvestJob.source_id))
+        .filter(HarvestJob.source_id.in_(source_ids))
+        .filter(HarvestJob.status == u'New'))
+
+    # The last finished job of each source
+    last_gather_finished = dict(
+        model.Session.query(HarvestJob.source_id, HarvestJob.gather_finished)
+        .filter(HarvestJob.source_id.in_(source_ids))
+        .filter(HarvestJob.status == u'Finished')
+        .order_by(HarvestJob.source_id, HarvestJob.created.desc())
+        .distinct(HarvestJob.source_id))
+
+    # Overall statistics
+    added = dict(model.Session.query(HarvestObject.harvest_source_id,
+                                     func.count(distinct(
+                                         HarvestObject.package_id)))
+                 .join(Package, Package.id == HarvestObject.package_id)
+                 .filter(HarvestObject.harvest_source_id.in_(source_ids))
+                 .filter(HarvestObject.current == True)
+                 .filter(Package.state == u'active')
+                 .group_by(HarvestObject.harvest_source_id))
+
+    gather_errors = dict(model.Session.query(HarvestJob.source_id,
+                                             func.count(HarvestGatherError.id))
+                         .join(HarvestGatherError,
+                               HarvestGatherError.harvest_job_id ==
+                               HarvestJob.id)
+                         .filter(HarvestJob.source_id.in_(source_ids))
+                         .group_by(HarvestJob.source_id))
+
+    object_errors = dict(model.Session.query(HarvestJob.source_id,
+                                             func.count(HarvestObjectError.id))
+                         .join(HarvestObject,
+                               HarvestObject.harvest_job_id == HarvestJob.id)
+                         .join(HarvestObjectError,
+                               HarvestObjectError.harvest_object_id ==
+                               HarvestObject.id)
+                         .filter(HarvestJob.source_id.in_(source_ids))
+                         .group_by(HarvestJob.source_id))
+
+    for source_id in source_ids:
+        out = statuses[source_id]
+        del out['msg']
+        out['job_count'] = job_counts[source_id]
+
+        if source_id in scheduled:
+            out['next_harvest'] = 'Scheduled'
+        else:
+            out['next_harvest'] = 'Not yet scheduled'
+
+        if source_id in last_gather_finished:
+            #TODO: Should we encode the dates as strings?
+            out['last_harvest_request'] = \
+                str(last_gather_finished[source_id])
+
+            out['overall_statistics']['added'] = added.get(source_id, 0)
+            out['overall_statistics']['errors'] = \
+                gather_errors.get(source_id, 0) + \
+                object_errors.get(source_id, 0)
+        else:
+            out['last_harvest_request'] = 'Not yet harvested'
+
+    return statuses
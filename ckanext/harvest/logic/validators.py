@@ -4,11 +4,10 @@ import json
 
 from ckan.lib.navl.dictization_functions import Invalid, validate
 from ckan import model
-from ckan.plugins import PluginImplementations
 
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
 from ckanext.harvest.model import HarvestSource, UPDATE_FREQUENCIES, HarvestJob
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import registry
 
 from ckan.lib.navl.validators import keep_extras
 
@@ -111,14 +110,7 @@ def harvest_source_type_exists(value, context):
     # TODO: use new description interface
 
     # Get all the registered harvester types
-    available_types = []
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if not info or 'name' not in info:
-            log.error('Harvester %s does not provide the harvester name in '
-                      'the info response' % harvester)
-            continue
-        available_types.append(info['name'])
+    available_types = registry.get_harvester_names()
 
     if not value in available_types:
         raise Invalid('Unknown harvester type: %s. Registered types: %r' %
@@ -129,19 +121,17 @@ def harvest_source_type_exists(value, context):
 
 def harvest_source_config_validator(key, data, errors, context):
     harvester_type = data.get(('source_type',), '')
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if info['name'] == harvester_type:
-            if hasattr(harvester, 'validate_config'):
-                try:
-                    config = harvester.validate_config(data[key])
-                except Exception, e:
-                    raise Invalid('Error parsing the configuration options: %s'
-                                  % e)
-                if config is not None:
-                    # save an edited config, for use during the harvest
-                    data[key] = config
-            # no value is returned for this sort of validator/converter
+    harvester = registry.get_harvester(harvester_type)
+    if harvester and hasattr(harvester, 'validate_config'):
+        try:
+            config = harvester.validate_config(data[key])
+        except Exception, e:
+            raise Invalid('Error parsing the configuration options: %s'
+                          % e)
+        if config is not None:
+            # save an edited config, for use during the harvest
+            data[key] = config
+    # no value is returned for this sort of validator/converter
 
 
 def keep_not_empty_extras(key, data, errors, context):
@@ -157,20 +147,15 @@ def harvest_source_extra_validator(key, data, errors, context):
     # gather all extra fields to use as whitelist of what
     # can be added to top level data_dict
     all_extra_fields = set()
-    for harvester in PluginImplementations(IHarvester):
+    for harvester in registry.get_harvesters():
         if not hasattr(harvester, 'extra_schema'):
             continue
         all_extra_fields.update(harvester.extra_schema().keys())
 
     extra_schema = {'__extras': [keep_not_empty_extras]}
-    for harvester in PluginImplementations(IHarvester):
-        if not hasattr(harvester, 'extra_schema'):
-            continue
-        info = harvester.info()
-        if not info['name'] == harvester_type:
-            continue
+    harvester = registry.get_harvester(harvester_type)
+    if harvester and hasattr(harvester, 'extra_schema'):
         extra_schema.update(harvester.extra_schema())
-        break
 
     extra_data, extra_errors = validate(data.get(key, {}), extra_schema)
     for key in extra_data.keys():
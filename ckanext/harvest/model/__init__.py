@@ -1,3 +1,6 @@
+import zlib
+import json
+import hashlib
 import logging
 import datetime
 import uuid
@@ -9,9 +12,14 @@ from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import types
 from sqlalchemy import Index
+from sqlalchemy import text, bindparam
 from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.orm import backref, relation
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import backref, relation, subqueryload, column_property
+from sqlalchemy.orm import object_session, Session as OrmSession
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from paste.deploy.converters import asbool
 
 from ckan import model
 from ckan import logic
@@ -31,7 +39,12 @@ __all__ = [
     'HarvestObject', 'harvest_object_table',
     'HarvestGatherError', 'harvest_gather_error_table',
     'HarvestObjectError', 'harvest_object_error_table',
-    'HarvestLog', 'harvest_log_table'
+    'HarvestLog', 'harvest_log_table',
+    'HarvestObjectArchive', 'harvest_object_archive_table',
+    'harvest_object_content_table',
+    'HarvestJobStats', 'harvest_job_stats_table',
+    'harvest_source_status_table',
+    'harvest_queue_table'
 ]
 
 
@@ -42,6 +55,11 @@ harvest_gather_error_table = None
 harvest_object_error_table = None
 harvest_object_extra_table = None
 harvest_log_table = None
+harvest_queue_table = None
+harvest_object_archive_table = None
+harvest_object_content_table = None
+harvest_job_stats_table = None
+harvest_source_status_table = None
 
 
 def setup():
@@ -65,6 +83,11 @@ def setup():
         harvest_object_error_table.create()
         harvest_object_extra_table.create()
         harvest_log_table.create()
+        harvest_queue_table.create()
+        harvest_object_archive_table.create()
+        harvest_object_content_table.create()
+        harvest_job_stats_table.create()
+        harvest_source_status_table.create()
         
         log.debug('Harvest tables created')
     else:
@@ -80,6 +103,19 @@ def setup():
         if not 'frequency' in column_names:
             log.debug('Harvest tables need to be updated')
             migrate_v3()
+        job_column_names = [column['name'] for column in
+                            inspector.get_columns('harvest_job')]
+        if not 'priority' in job_column_names:
+            log.debug('Harvest tables need to be updated')
+            migrate_v4()
+        object_column_names = [column['name'] for column in
+                               inspector.get_columns('harvest_object')]
+        if not 'content_hash' in object_column_names:
+            log.debug('Harvest tables need to be updated')
+            migrate_v5()
+        if not 'fingerprint' in object_column_names:
+            log.debug('Harvest tables need to be updated')
+            migrate_v6()
 
         # Check if this instance has harvest source datasets
         source_ids = Session.query(HarvestSource.id).filter_by(active=True).all()
@@ -94,12 +130,114 @@ def setup():
         if not 'harvest_log' in inspector.get_table_names():
             harvest_log_table.create()
 
+        if not 'harvest_queue' in inspector.get_table_names():
+            harvest_queue_table.create()
+
+        if not 'harvest_object_archive' in inspector.get_table_names():
+            harvest_object_archive_table.create()
+
+        if not 'harvest_object_content' in inspector.get_table_names():
+            harvest_object_content_table.create()
+
+        if not 'harvest_job_stats' in inspector.get_table_names():
+            harvest_job_stats_table.create()
+            log.warning('Run "paster harvester backfill_job_stats" to '
+                        'compute the statistics of existing harvest jobs')
+
+        if not 'harvest_source_status' in inspector.get_table_names():
+            harvest_source_status_table.create()
+
         # Check if harvest_object has a index
         index_names = [index['name'] for index in inspector.get_indexes("harvest_object")]
         if not "harvest_job_id_idx" in index_names:
             log.debug('Creating index for harvest_object')
             Index("harvest_job_id_idx", harvest_object_table.c.harvest_job_id).create()
 
+        # Other indexes can take long to build on large tables, and would
+        # block harvesting meanwhile, so they are left to the migrate
+        # command, which also checks for them rather than every process
+        # start
+
+
+def _get_indexed_tables():
+    return [harvest_job_table, harvest_object_table,
+            harvest_object_error_table, harvest_log_table,
+            harvest_object_archive_table]
+
+
+def get_missing_indexes(inspector=None):
+    '''
+    Returns the indexes declared on the harvest tables that don't exist in
+    the database, or exist but are invalid because building them
+    concurrently failed.
+    '''
+    from ckan.model.meta import engine
+    inspector = inspector or Inspector.from_engine(engine)
+    invalid = set(row[0] for row in engine.execute(
+        'SELECT c.relname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE NOT i.indisvalid'))
+    missing = []
+    for table in _get_indexed_tables():
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        missing.extend(index for index in sorted(table.indexes,
+                                                 key=lambda i: i.name)
+                       if index.name not in existing or index.name in invalid)
+    return missing
+
+
+def create_indexes_concurrently(report=None):
+    '''
+    Creates the missing indexes of the harvest tables with ``CREATE INDEX
+    CONCURRENTLY``, so the tables can still be written to while they are
+    built. Invalid indexes left by a failed attempt are dropped first.
+    Indexes that exist already are skipped, so it can be run again safely.
+
+    ``report`` is called with a message before and after each index.
+
+    Returns the names of the indexes created.
+    '''
+    from sqlalchemy.schema import CreateIndex
+    from ckan.model.meta import engine
+    report = report or log.info
+    missing = get_missing_indexes()
+    if not missing:
+        report('All the harvest indexes exist')
+        return []
+
+    import psycopg2.extensions
+    # CONCURRENTLY can't be used inside a transaction
+    connection = engine.raw_connection()
+    isolation_level = connection.connection.isolation_level
+    try:
+        connection.connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = connection.cursor()
+        existing = set(index['name'] for table in _get_indexed_tables()
+                       for index in Inspector.from_engine(engine)
+                                             .get_indexes(table.name))
+        for number, index in enumerate(missing, 1):
+            started = datetime.datetime.utcnow()
+            if index.name in existing:
+                report('Dropping invalid index %s' % index.name)
+                cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s'
+                               % index.name)
+            report('Creating index %s on %s (%i of %i)...'
+                   % (index.name, index.table.name, number, len(missing)))
+            statement = unicode(CreateIndex(index).compile(
+                dialect=engine.dialect))
+            cursor.execute(statement.replace('CREATE INDEX',
+                                             'CREATE INDEX CONCURRENTLY', 1))
+            report('Created index %s in %s' % (
+                index.name, datetime.datetime.utcnow() - started))
+        cursor.close()
+    finally:
+        # the connection goes back to the pool
+        connection.connection.set_isolation_level(isolation_level)
+        connection.close()
+    return [index.name for index in missing]
+
 
 class HarvestError(Exception):
     pass
@@ -154,6 +292,25 @@ class HarvestJob(HarvestDomainObject):
     '''
     pass
 
+class HarvestJobStats(HarvestDomainObject):
+    '''Number of objects of a harvest job by report status, and of errors,
+       kept up to date as they are saved (see ``update_job_stats``) so job
+       reports don't have to count them.
+    '''
+    key_attr = 'harvest_job_id'
+
+    def as_stats(self):
+        '''Returns the stats as ``harvest_job_dictize`` used to count them'''
+        stats = {'added': self.added, 'updated': self.updated,
+                 'not modified': self.not_modified,
+                 'errored': self.errored, 'deleted': self.deleted}
+        # Objects with errors could have been added/updated anyway (eg
+        # bbox errors)
+        if self.error_objects > 0:
+            stats['errored'] = self.error_objects
+        stats['errored'] += self.gather_errors
+        return stats
+
 class HarvestObject(HarvestDomainObject):
     '''A Harvest Object is created every time an element is fetched from a
        harvest source. Its contents can be processed and imported to ckan
@@ -161,6 +318,46 @@ class HarvestObject(HarvestDomainObject):
 
     '''
 
+    @property
+    def priority(self):
+        '''Objects are queued with the priority of their job'''
+        return self.job.priority if self.job else 0
+
+    @hybrid_property
+    def content(self):
+        '''
+        The document harvested. With the content store enabled it is kept in
+        the ``harvest_object_content`` table, and only loaded when read.
+        '''
+        if self.content_hash is None:
+            return self._content
+        loaded = getattr(self, '_loaded_content', None)
+        if loaded is None or loaded[0] != self.content_hash:
+            loaded = (self.content_hash, get_stored_content(self.content_hash))
+            self._loaded_content = loaded
+        return loaded[1]
+
+    @content.setter
+    def content(self, value):
+        if value is not None and content_store_enabled():
+            data = value.encode('utf-8') if isinstance(value, unicode) \
+                else value
+            self.content_hash = unicode(hashlib.sha256(data).hexdigest())
+            self._content = None
+            # stored when the object is flushed
+            self._pending_content = (self.content_hash, data)
+            self._loaded_content = (self.content_hash, value)
+        else:
+            self.content_hash = None
+            self._content = value
+            self._pending_content = None
+
+    @content.expression
+    def content(cls):
+        # queries, filters and loader options use the column, which is
+        # empty for the documents in the content store
+        return cls._content
+
 class HarvestObjectExtra(HarvestDomainObject):
     '''Extra key value data for Harvest objects'''
 
@@ -220,6 +417,22 @@ class HarvestLog(HarvestDomainObject):
     '''
     pass
 
+class HarvestObjectArchive(HarvestDomainObject):
+    '''A Harvest Object that is no longer current and was moved out of the
+       ``harvest_object`` table by ``archive_harvest_objects``. Its content
+       is stored compressed, and its errors and extras as JSON.
+    '''
+    def get_content(self):
+        if self.content is None:
+            return None
+        return zlib.decompress(self.content).decode('utf-8')
+
+    def get_errors(self):
+        return json.loads(self.errors) if self.errors else []
+
+    def get_extras(self):
+        return json.loads(self.extras) if self.extras else {}
+
 def harvest_object_before_insert_listener(mapper,connection,target):
     '''
         For compatibility with old harvesters, check if the source id has
@@ -232,6 +445,436 @@ def harvest_object_before_insert_listener(mapper,connection,target):
         target.harvest_source_id = target.job.source.id
 
 
+def harvest_object_content_listener(mapper, connection, target):
+    '''
+        Adds the content set on the object to the content store, unless a
+        document with the same hash is there already.
+    '''
+    pending = getattr(target, '_pending_content', None)
+    if pending:
+        content_hash, data = pending
+        # last_used is updated on conflict, so delete_unused_contents()
+        # doesn't remove a document that is being referenced again
+        connection.execute(text(
+            '''INSERT INTO harvest_object_content (hash, content, last_used)
+               VALUES (:hash, :content, :last_used)
+               ON CONFLICT (hash) DO UPDATE SET last_used = EXCLUDED.last_used''',
+            bindparams=[bindparam('content', type_=types.LargeBinary)]),
+            hash=content_hash, content=zlib.compress(data),
+            last_used=datetime.datetime.utcnow())
+        target._pending_content = None
+
+
+# harvest_job_stats columns counting the objects by report_status
+JOB_STATS_COLUMNS = {
+    'added': 'added',
+    'updated': 'updated',
+    'not modified': 'not_modified',
+    'errored': 'errored',
+    'deleted': 'deleted',
+}
+
+
+def update_job_stats(connection, job_id, changes):
+    '''
+    Adds the given amounts (``{column: amount}``) to the stats of a job, in
+    the transaction of the connection. The row is created if needed.
+    '''
+    changes = dict((column, amount) for column, amount in changes.items()
+                   if amount)
+    if not job_id or not changes:
+        return
+    # the column names come from JOB_STATS_COLUMNS and the listeners below.
+    # Rows are created with their job, so the insert is only needed for
+    # jobs older than the table. It is done in a savepoint, as another
+    # transaction may insert the row first, and then the update is retried.
+    columns = sorted(changes)
+    update = text(
+        '''UPDATE harvest_job_stats SET {updates}
+           WHERE harvest_job_id = :job_id'''.format(
+            updates=', '.join('%s = %s + :%s' % (column, column, column)
+                              for column in columns)))
+    if connection.execute(update, job_id=job_id, **changes).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(text(
+                '''INSERT INTO harvest_job_stats (harvest_job_id, {columns})
+                   VALUES (:job_id, {values})'''.format(
+                    columns=', '.join(columns),
+                    values=', '.join('GREATEST(:%s, 0)' % column
+                                     for column in columns))),
+                job_id=job_id, **changes)
+    except IntegrityError:
+        connection.execute(update, job_id=job_id, **changes)
+
+
+def _add_pending_job_stats(target, job_id, changes):
+    '''
+    Records changes to the stats of a job made by the flush of ``target``,
+    to be written when the transaction of its session commits.
+    '''
+    if not job_id:
+        return
+    session = object_session(target)
+    pending = getattr(session, '_pending_job_stats', None)
+    if pending is None:
+        pending = session._pending_job_stats = {}
+    job_changes = pending.setdefault(job_id, {})
+    for column, amount in changes.items():
+        job_changes[column] = job_changes.get(column, 0) + amount
+
+
+def save_pending_job_stats(session):
+    '''
+    Writes the stats changes recorded in the transaction of the session,
+    right before it commits.
+
+    The stats of a job are a single row shared by all the consumers
+    processing its objects, so it is only updated at the end of each
+    transaction, and the lock on it is held for as short as possible.
+    '''
+    # the flush made by the commit comes after this
+    session.flush()
+    pending = getattr(session, '_pending_job_stats', None) or {}
+    error_ids = getattr(session, '_pending_error_ids', None)
+    if not pending and not error_ids:
+        return
+    discard_pending_job_stats(session)
+    connection = session.connection()
+    if error_ids:
+        # objects whose first errors were added in this transaction, all
+        # of them having been flushed by now
+        for job_id, count in connection.execute(text(
+                '''SELECT o.harvest_job_id, count(*) FROM harvest_object o
+                   WHERE o.id = ANY(:object_ids)
+                       AND o.harvest_job_id IS NOT NULL
+                       AND NOT EXISTS (
+                           SELECT 1 FROM harvest_object_error e
+                           WHERE e.harvest_object_id = o.id
+                               AND e.id != ALL(:error_ids))
+                   GROUP BY o.harvest_job_id'''),
+                object_ids=list(error_ids),
+                error_ids=[id for ids in error_ids.values() for id in ids]):
+            job_changes = pending.setdefault(job_id, {})
+            job_changes['error_objects'] = \
+                job_changes.get('error_objects', 0) + count
+    # always in the same order, so transactions don't deadlock
+    for job_id in sorted(pending):
+        update_job_stats(connection, job_id, pending[job_id])
+
+
+def discard_pending_job_stats(session):
+    session._pending_job_stats = None
+    session._pending_error_ids = None
+
+
+def harvest_job_stats_listener(mapper, connection, target):
+    '''Creates the stats of a new job'''
+    connection.execute(harvest_job_stats_table.insert(),
+                       harvest_job_id=target.id)
+
+
+def harvest_object_stats_listener(mapper, connection, target):
+    '''Counts the change of report_status of a harvest object in its job'''
+    added, unchanged, deleted = get_history(target, 'report_status')
+    if not added:
+        return
+    changes = {}
+    for status in deleted:
+        if status in JOB_STATS_COLUMNS:
+            changes[JOB_STATS_COLUMNS[status]] = -1
+    for status in added:
+        if status in JOB_STATS_COLUMNS:
+            column = JOB_STATS_COLUMNS[status]
+            changes[column] = changes.get(column, 0) + 1
+    _add_pending_job_stats(target, target.harvest_job_id, changes)
+
+
+def harvest_object_error_stats_listener(mapper, connection, target):
+    '''
+    Records the new error of an object, which is counted in the errors of
+    its job on commit if the object had none before. Several errors of an
+    object can be flushed together, so they can't tell if they are the
+    first one here.
+    '''
+    session = object_session(target)
+    error_ids = getattr(session, '_pending_error_ids', None)
+    if error_ids is None:
+        error_ids = session._pending_error_ids = {}
+    error_ids.setdefault(target.harvest_object_id, set()).add(target.id)
+
+
+def harvest_gather_error_stats_listener(mapper, connection, target):
+    _add_pending_job_stats(target, target.harvest_job_id,
+                           {'gather_errors': 1})
+
+
+def harvest_job_source_status_listener(mapper, connection, target):
+    '''Drops the cached status of the source of a job that changed'''
+    _add_pending_source_status(target, target.source_id)
+
+
+def harvest_object_source_status_listener(mapper, connection, target):
+    '''
+    Drops the cached status of the source of a harvest object that became
+    current or stopped being so, as the datasets of the source are counted
+    from them.
+    '''
+    added, unchanged, deleted = get_history(target, 'current')
+    if True in added or True in deleted or (
+            target.current and
+            get_history(target, 'package_id').has_changes()):
+        _add_pending_source_status(target, target.harvest_source_id)
+
+
+def package_source_status_listener(mapper, connection, target):
+    '''
+    Drops the cached status of the sources that harvested a dataset that
+    was deleted or made private, or the other way round.
+    '''
+    if not get_history(target, 'state').has_changes() and \
+            not get_history(target, 'private').has_changes():
+        return
+    for row in connection.execute(
+            text('''SELECT DISTINCT harvest_source_id FROM harvest_object
+                    WHERE package_id = :package_id AND current = true'''),
+            package_id=target.id):
+        _add_pending_source_status(target, row[0])
+
+
+def _add_pending_source_status(target, source_id):
+    if not source_id:
+        return
+    session = object_session(target)
+    pending = getattr(session, '_pending_source_ids', None)
+    if pending is None:
+        pending = session._pending_source_ids = set()
+    pending.add(source_id)
+
+
+def save_pending_source_status(session):
+    '''
+    Drops the cached status of the sources changed in the transaction of
+    the session, right before it commits, so that the lock on their rows
+    is held for as short as possible.
+    '''
+    session.flush()
+    source_ids = getattr(session, '_pending_source_ids', None)
+    if not source_ids:
+        return
+    discard_pending_source_status(session)
+    connection = session.connection()
+    # always in the same order, so transactions don't deadlock
+    for source_id in sorted(source_ids):
+        invalidate_source_status(connection, source_id)
+
+
+def discard_pending_source_status(session):
+    session._pending_source_ids = None
+
+
+def invalidate_source_status(connection, source_id):
+    '''
+    Drops the cached status of a source and bumps its version, in the
+    transaction of the connection.
+
+    The row is created if there isn't one, so that a status computed before
+    the transaction commits is not cached after it: ``cache_source_status``
+    only writes it over the version it started from.
+    '''
+    table = harvest_source_status_table
+    update = table.update() \
+        .where(table.c.source_id == source_id) \
+        .values(status=None, cached=None, version=table.c.version + 1)
+    if connection.execute(update).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert(), source_id=source_id,
+                               version=1)
+    except IntegrityError:
+        connection.execute(update)
+
+
+def source_status_cache_supported():
+    '''
+    Whether the database can cache source statuses, which needs
+    ``lock_timeout`` (PostgreSQL 9.3). It is only checked once.
+    '''
+    global _source_status_cache_supported
+    if _source_status_cache_supported is None:
+        from ckan.model.meta import engine
+        connection = engine.connect()
+        try:
+            version = connection.dialect.server_version_info
+        finally:
+            connection.close()
+        _source_status_cache_supported = version >= (9, 3)
+        if not _source_status_cache_supported:
+            log.warning('PostgreSQL %s is older than 9.3, harvest source '
+                        'statuses will not be cached',
+                        '.'.join(str(part) for part in version))
+    return _source_status_cache_supported
+
+_source_status_cache_supported = None
+
+
+def get_cached_source_status(source_id, ttl):
+    '''
+    Returns the cached status of a source and the version of its row (see
+    ``cache_source_status``), each None if there isn't one. Statuses cached
+    more than ``ttl`` seconds ago, or before a job of the source was created
+    or finished, are not returned.
+    '''
+    row = Session.execute(text(
+        '''SELECT s.status, s.version, s.cached > :oldest AND NOT EXISTS (
+               SELECT 1 FROM harvest_job j
+               WHERE j.source_id = s.source_id
+                   AND (j.created > s.cached OR j.finished > s.cached))
+           FROM harvest_source_status s WHERE s.source_id = :source_id'''),
+        {'source_id': source_id,
+         'oldest': datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=ttl)}).first()
+    if not row:
+        return None, None
+    status, version, fresh = row
+    return (json.loads(status) if fresh else None), version
+
+
+def cache_source_status(source_id, status, version, computed):
+    '''
+    Stores the status of a source, as returned by
+    ``harvest_source_show_status`` and computed at ``computed``, unless it
+    changed since ``version`` was read with ``get_cached_source_status``.
+    '''
+    from ckan.model.meta import engine
+    from sqlalchemy.exc import DBAPIError
+    # On a connection of its own, as it must not commit the transaction of
+    # the session. A transaction changing the source holds the lock on its
+    # row until it commits and bumps the version, so don't wait for it.
+    table = harvest_source_status_table
+    values = {'status': json.dumps(status), 'cached': computed}
+    try:
+        with engine.begin() as connection:
+            connection.execute("SET LOCAL lock_timeout = '100ms'")
+            if version is None:
+                connection.execute(table.insert(), source_id=source_id,
+                                   version=0, **values)
+            else:
+                connection.execute(
+                    table.update()
+                    .where(table.c.source_id == source_id)
+                    .where(table.c.version == version), **values)
+    except DBAPIError, e:
+        # lock_not_available and unique_violation: the source changed
+        if getattr(e.orig, 'pgcode', None) in ('55P03', '23505'):
+            log.debug('Status of harvest source %s not cached: %s',
+                      source_id, e)
+        else:
+            log.warning('Status of harvest source %s not cached: %s',
+                        source_id, e)
+
+
+def backfill_job_stats(batch_size=100, report=None):
+    '''
+    Counts the objects and errors of the harvest jobs that are not running
+    and stores them in ``harvest_job_stats``, replacing any stats they had.
+    Running jobs are only counted if they have no stats yet. Each batch of
+    ``batch_size`` jobs is committed on its own, and ``report`` is called
+    with a message after each one.
+
+    Returns the number of jobs counted.
+    '''
+    report = report or log.info
+    total = 0
+    last_id = u''
+    while True:
+        job_ids = [row[0] for row in Session.execute(text(
+            '''SELECT j.id FROM harvest_job j
+               WHERE j.id > :last_id AND (j.status != 'Running' OR NOT EXISTS (
+                   SELECT 1 FROM harvest_job_stats s
+                   WHERE s.harvest_job_id = j.id))
+               ORDER BY j.id LIMIT :limit'''),
+            {'last_id': last_id, 'limit': batch_size})]
+        if not job_ids:
+            break
+        # replaced with a delete and an insert in the same transaction
+        Session.execute(harvest_job_stats_table.delete().where(
+            harvest_job_stats_table.c.harvest_job_id.in_(job_ids)))
+        Session.execute(text(
+            '''INSERT INTO harvest_job_stats (harvest_job_id, added, updated,
+                   not_modified, errored, deleted, error_objects, gather_errors)
+               SELECT j.id,
+                   sum(CASE WHEN o.report_status = 'added' THEN 1 ELSE 0 END),
+                   sum(CASE WHEN o.report_status = 'updated' THEN 1 ELSE 0 END),
+                   sum(CASE WHEN o.report_status = 'not modified'
+                       THEN 1 ELSE 0 END),
+                   sum(CASE WHEN o.report_status = 'errored' THEN 1 ELSE 0 END),
+                   sum(CASE WHEN o.report_status = 'deleted' THEN 1 ELSE 0 END),
+                   (SELECT count(DISTINCT e.harvest_object_id)
+                    FROM harvest_object_error e
+                    JOIN harvest_object eo ON eo.id = e.harvest_object_id
+                    WHERE eo.harvest_job_id = j.id),
+                   (SELECT count(*) FROM harvest_gather_error g
+                    WHERE g.harvest_job_id = j.id)
+               FROM harvest_job j
+               LEFT JOIN harvest_object o ON o.harvest_job_id = j.id
+               WHERE j.id = ANY(:job_ids)
+               GROUP BY j.id'''),
+            {'job_ids': job_ids})
+        Session.commit()
+        total += len(job_ids)
+        last_id = job_ids[-1]
+        report('Counted the objects of %i harvest jobs' % total)
+    return total
+
+
+def content_store_enabled():
+    from ckan.lib.base import config
+    return asbool(config.get('ckan.harvest.content_store', False))
+
+
+def get_stored_content(content_hash):
+    '''Returns the document with the given hash from the content store'''
+    row = Session.query(harvest_object_content_table.c.content) \
+        .filter(harvest_object_content_table.c.hash == content_hash) \
+        .first()
+    if row is None:
+        log.error('Harvest object content %s not found', content_hash)
+        return None
+    return zlib.decompress(row[0]).decode('utf-8')
+
+
+def get_stored_contents(content_hashes):
+    '''
+    Returns the documents with the given hashes from the content store, as
+    they are stored (compressed), in a dict by hash.
+    '''
+    if not content_hashes:
+        return {}
+    table = harvest_object_content_table
+    return dict(Session.query(table.c.hash, table.c.content)
+                .filter(table.c.hash.in_(list(content_hashes))))
+
+
+def delete_unused_contents(grace=datetime.timedelta(days=1)):
+    '''
+    Deletes the documents of the content store that no harvest object
+    refers to, and were not used in the last ``grace`` period, so the ones
+    just added by harvests in progress are kept.
+
+    Returns the number of documents deleted.
+    '''
+    result = Session.execute(text(
+        '''DELETE FROM harvest_object_content c
+           WHERE c.last_used < :before AND NOT EXISTS (
+               SELECT 1 FROM harvest_object o WHERE o.content_hash = c.hash)'''),
+        {'before': datetime.datetime.utcnow() - grace})
+    Session.commit()
+    return result.rowcount
+
+
 def define_harvester_tables():
 
     global harvest_source_table
@@ -241,6 +884,11 @@ def define_harvester_tables():
     global harvest_gather_error_table
     global harvest_object_error_table
     global harvest_log_table
+    global harvest_queue_table
+    global harvest_object_archive_table
+    global harvest_object_content_table
+    global harvest_job_stats_table
+    global harvest_source_status_table
 
     harvest_source_table = Table('harvest_source', metadata,
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
@@ -266,6 +914,11 @@ def define_harvester_tables():
         Column('source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         # status: New, Running, Finished
         Column('status', types.UnicodeText, default=u'New', nullable=False),
+        # jobs and their objects with a higher priority are taken first from
+        # the queues
+        Column('priority', types.Integer, default=0, nullable=False),
+        Index('harvest_job_source_id_status_created_idx',
+              'source_id', 'status', 'created'),
     )
     # A harvest_object contains a representation of one dataset during a
     # particular harvest
@@ -295,7 +948,54 @@ def define_harvester_tables():
         Column('package_id', types.UnicodeText, ForeignKey('package.id', deferrable=True), nullable=True),
         # report_status: 'added', 'updated', 'not modified', 'deleted', 'errored'
         Column('report_status', types.UnicodeText, nullable=True),
+        # sha256 of the content when it is in harvest_object_content, in
+        # which case the content column is empty
+        Column('content_hash', types.UnicodeText, nullable=True),
+        # hash of the normalized content, extras and source config, to
+        # find unchanged objects (ckan.harvest.skip_unchanged)
+        Column('fingerprint', types.UnicodeText, nullable=True),
         Index('harvest_job_id_idx', 'harvest_job_id'),
+        Index('harvest_object_package_id_idx', 'package_id'),
+        Index('harvest_object_source_id_current_idx',
+              'harvest_source_id', 'current'),
+        Index('harvest_object_guid_idx', 'guid'),
+        Index('harvest_object_content_hash_idx', 'content_hash'),
+    )
+    # Counts kept up to date for each job, see HarvestJobStats. There is no
+    # foreign key, so jobs can be deleted as before.
+    harvest_job_stats_table = Table('harvest_job_stats', metadata,
+        Column('harvest_job_id', types.UnicodeText, primary_key=True),
+        Column('added', types.Integer, default=0, server_default='0',
+               nullable=False),
+        Column('updated', types.Integer, default=0, server_default='0',
+               nullable=False),
+        Column('not_modified', types.Integer, default=0, server_default='0',
+               nullable=False),
+        Column('errored', types.Integer, default=0, server_default='0',
+               nullable=False),
+        Column('deleted', types.Integer, default=0, server_default='0',
+               nullable=False),
+        # objects with at least one harvest_object_error
+        Column('error_objects', types.Integer, default=0, server_default='0',
+               nullable=False),
+        Column('gather_errors', types.Integer, default=0, server_default='0',
+               nullable=False),
+    )
+    # harvest_source_show_status results, dropped when a job, harvest
+    # object or dataset of the source changes (ckan.harvest.status_cache_ttl)
+    harvest_source_status_table = Table('harvest_source_status', metadata,
+        Column('source_id', types.UnicodeText, primary_key=True),
+        Column('status', types.UnicodeText),
+        Column('cached', types.DateTime),
+        Column('version', types.Integer, nullable=False),
+    )
+    # Content store (ckan.harvest.content_store): harvested documents,
+    # compressed and kept once however many harvest objects have them
+    harvest_object_content_table = Table('harvest_object_content', metadata,
+        Column('hash', types.UnicodeText, primary_key=True),
+        Column('content', types.LargeBinary, nullable=False),
+        Column('last_used', types.DateTime, default=datetime.datetime.utcnow,
+               nullable=False),
     )
 
     # New table
@@ -321,6 +1021,8 @@ def define_harvester_tables():
         Column('stage', types.UnicodeText),
         Column('line', types.Integer),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Index('harvest_object_error_harvest_object_id_idx',
+              'harvest_object_id'),
     )
     # Harvest Log table
     harvest_log_table = Table('harvest_log', metadata,
@@ -328,6 +1030,58 @@ def define_harvester_tables():
         Column('content', types.UnicodeText, nullable=False),
         Column('level', types.Enum('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', name='log_level')),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Index('harvest_log_created_level_idx', 'created', 'level'),
+    )
+    # Messages of the PostgreSQL queue backend (ckan.harvest.mq.type =
+    # postgres). Rows are claimed by consumers and deleted once processed.
+    harvest_queue_table = Table('harvest_queue', metadata,
+        Column('id', types.Integer, primary_key=True),
+        Column('queue', types.UnicodeText, nullable=False),
+        Column('body', types.UnicodeText, nullable=False),
+        Column('priority', types.Integer, default=0, nullable=False),
+        # not delivered before this time, for delayed retries
+        Column('available', types.DateTime, default=datetime.datetime.utcnow,
+               nullable=False),
+        Column('claimed', types.DateTime),
+        Column('claimed_by', types.UnicodeText),
+    )
+    # claims look for the unclaimed messages of a queue, highest priority
+    # first
+    Index('harvest_queue_claim_idx', harvest_queue_table.c.queue,
+          harvest_queue_table.c.claimed,
+          harvest_queue_table.c.priority.desc(),
+          harvest_queue_table.c.available, harvest_queue_table.c.id)
+    # Old harvest objects moved out of harvest_object, see
+    # archive_harvest_objects(). There are no foreign keys, so archived
+    # objects don't get in the way of deleting jobs or datasets. It is a
+    # plain table rather than a partitioned one: declarative partitioning
+    # needs PostgreSQL 10, while the extension only needs 9.5 for the
+    # optional content store and PostgreSQL queue backend. It is only
+    # appended to and read by id, so partitions would gain little.
+    harvest_object_archive_table = Table('harvest_object_archive', metadata,
+        Column('id', types.UnicodeText, primary_key=True),
+        Column('guid', types.UnicodeText, default=u''),
+        Column('gathered', types.DateTime),
+        Column('fetch_started', types.DateTime),
+        # zlib compressed
+        Column('content', types.LargeBinary, nullable=True),
+        Column('fetch_finished', types.DateTime),
+        Column('import_started', types.DateTime),
+        Column('import_finished', types.DateTime),
+        Column('state', types.UnicodeText),
+        Column('metadata_modified_date', types.DateTime),
+        Column('retry_times', types.Integer),
+        Column('harvest_job_id', types.UnicodeText),
+        Column('harvest_source_id', types.UnicodeText),
+        Column('package_id', types.UnicodeText),
+        Column('report_status', types.UnicodeText),
+        # JSON list of the harvest_object_error rows, as dicts
+        Column('errors', types.UnicodeText),
+        # JSON dict of the harvest_object_extra keys and values
+        Column('extras', types.UnicodeText),
+        Column('archived', types.DateTime, default=datetime.datetime.utcnow,
+               nullable=False),
+        Index('harvest_object_archive_source_id_idx', 'harvest_source_id'),
     )
 
     mapper(
@@ -352,6 +1106,11 @@ def define_harvester_tables():
         HarvestObject,
         harvest_object_table,
         properties={
+            # HarvestObject.content gets it from the content store if needed
+            '_content': harvest_object_table.c.content,
+            # the previous value is needed to update the job stats
+            'report_status': column_property(
+                harvest_object_table.c.report_status, active_history=True),
             'package':relation(
                 Package,
                 lazy=True,
@@ -409,7 +1168,38 @@ def define_harvester_tables():
         harvest_log_table,
     )
 
+    mapper(
+        HarvestObjectArchive,
+        harvest_object_archive_table,
+    )
+
+    mapper(
+        HarvestJobStats,
+        harvest_job_stats_table,
+    )
+
     event.listen(HarvestObject, 'before_insert', harvest_object_before_insert_listener)
+    event.listen(HarvestObject, 'before_insert', harvest_object_content_listener)
+    event.listen(HarvestObject, 'before_update', harvest_object_content_listener)
+    event.listen(HarvestJob, 'after_insert', harvest_job_stats_listener)
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(HarvestJob, event_name,
+                     harvest_job_source_status_listener)
+    for event_name in ('after_insert', 'after_update'):
+        event.listen(HarvestObject, event_name,
+                     harvest_object_source_status_listener)
+    event.listen(Package, 'after_update', package_source_status_listener)
+    event.listen(HarvestObject, 'after_insert', harvest_object_stats_listener)
+    event.listen(HarvestObject, 'after_update', harvest_object_stats_listener)
+    event.listen(HarvestObjectError, 'after_insert',
+                 harvest_object_error_stats_listener)
+    event.listen(HarvestGatherError, 'after_insert',
+                 harvest_gather_error_stats_listener)
+    event.listen(OrmSession, 'before_commit', save_pending_job_stats)
+    event.listen(OrmSession, 'after_rollback', discard_pending_job_stats)
+    event.listen(OrmSession, 'before_commit', save_pending_source_status)
+    event.listen(OrmSession, 'after_rollback',
+                 discard_pending_source_status)
 
 def migrate_v2():
     log.debug('Migrating harvest tables to v2. This may take a while...')
@@ -502,6 +1292,39 @@ ALTER TABLE harvest_object_error
     Session.commit()
     log.info('Harvest tables migrated to v3')
 
+def migrate_v4():
+    log.debug('Migrating harvest tables to v4')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_job ADD COLUMN priority integer NOT NULL DEFAULT 0;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v4')
+
+def migrate_v5():
+    log.debug('Migrating harvest tables to v5')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_object ADD COLUMN content_hash text;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v5')
+
+def migrate_v6():
+    log.debug('Migrating harvest tables to v6')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_object ADD COLUMN fingerprint text;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v6')
+
 class PackageIdHarvestSourceIdMismatch(Exception):
     """
     The package created for the harvest source must match the id of the
@@ -598,3 +1421,82 @@ def clean_harvest_log(condition):
         log.error('An error occurred while trying to clean-up the harvest log table')
 
     log.info('Harvest log table clean-up finished successfully')
+
+
+def archive_harvest_objects(before, batch_size=1000, report=None):
+    '''
+    Moves the harvest objects that are not current, and were gathered
+    before the ``before`` datetime by jobs that have finished, to the
+    ``harvest_object_archive`` table along with their errors and extras.
+
+    Objects are moved in batches of ``batch_size``, each one in a
+    transaction of its own, so the tables are never locked for long and
+    it can be stopped and run again at any time. ``report`` is called
+    with a message after each batch. The documents of the content store
+    that are no longer used are deleted at the end.
+
+    Returns the number of objects archived.
+    '''
+    report = report or log.info
+    total = 0
+    while True:
+        ids = [row[0] for row in Session.query(HarvestObject.id)
+               .join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id)
+               .filter(HarvestObject.current == False)
+               .filter(HarvestObject.gathered < before)
+               .filter(HarvestJob.status == u'Finished')
+               .limit(batch_size)]
+        if not ids:
+            break
+
+        objects = Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .options(subqueryload('errors'), subqueryload('extras')) \
+            .all()
+        # loaded with one query, and copied as they are, since the archive
+        # compresses them the same way
+        contents = get_stored_contents(set(
+            obj.content_hash for obj in objects if obj.content_hash))
+        archived = datetime.datetime.utcnow()
+        Session.execute(harvest_object_archive_table.insert(),
+                        [_get_archive_row(obj, archived, contents)
+                         for obj in objects])
+        for table in (harvest_object_error_table, harvest_object_extra_table):
+            Session.execute(table.delete().where(
+                table.c.harvest_object_id.in_(ids)))
+        Session.execute(harvest_object_table.delete().where(
+            harvest_object_table.c.id.in_(ids)))
+        Session.commit()
+        # the objects were deleted behind the session's back
+        Session.expunge_all()
+
+        total += len(ids)
+        report('Archived %i harvest objects' % total)
+        if len(ids) < batch_size:
+            break
+
+    if total:
+        deleted = delete_unused_contents()
+        if deleted:
+            report('Deleted %i documents no longer used from the content '
+                   'store' % deleted)
+    return total
+
+
+def _get_archive_row(obj, archived, contents):
+    row = dict((column.name, getattr(obj, column.name))
+               for column in harvest_object_archive_table.c
+               if column.name not in ('content', 'errors', 'extras',
+                                      'archived'))
+    row['content'] = None
+    if obj.content_hash is not None:
+        row['content'] = contents.get(obj.content_hash)
+        if row['content'] is None:
+            log.error('Harvest object content %s not found', obj.content_hash)
+    elif obj._content is not None:
+        row['content'] = zlib.compress(obj._content.encode('utf-8'))
+    row['errors'] = json.dumps([error.as_dict() for error in obj.errors])
+    row['extras'] = json.dumps(dict((extra.key, extra.value)
+                                    for extra in obj.extras))
+    row['archived'] = archived
+    return row
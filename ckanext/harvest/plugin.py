@@ -16,6 +16,7 @@ except ImportError:
 from ckan.lib.navl import dictization_functions
 
 from ckanext.harvest import logic as harvest_logic
+from ckanext.harvest import registry
 
 from ckanext.harvest.model import setup as model_setup
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
@@ -40,6 +41,7 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm, DefaultTranslation):
     p.implements(p.IPackageController, inherit=True)
     p.implements(p.ITemplateHelpers)
     p.implements(p.IFacets, inherit=True)
+    p.implements(p.IPluginObserver, inherit=True)
 #    if p.toolkit.check_ckan_version(min_version='2.5.0'):
 #        p.implements(p.ITranslation, inherit=True)
 
@@ -222,8 +224,19 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm, DefaultTranslation):
         # Configure database logger
         _configure_db_logger(config)
 
+        # Index the harvesters again now that they are all configured
+        registry.reset()
+
         self.startup = False
 
+    ## IPluginObserver
+
+    def after_load(self, service):
+        registry.reset()
+
+    def after_unload(self, service):
+        registry.reset()
+
     def before_map(self, map):
 
         # Most of the routes are defined via the IDatasetForm interface
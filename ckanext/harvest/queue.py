@@ -1,16 +1,32 @@
+import os
+import math
+import errno
+import heapq
+import itertools
+import time
+import random
+import select
+import socket
+import urllib2
 import logging
 import datetime
 import json
+import uuid
+import threading
 
 import pika
 import sqlalchemy
+from sqlalchemy.orm.attributes import get_history
 
 from ckan.lib.base import config
-from ckan.plugins import PluginImplementations
+from ckan.plugins import toolkit
 from ckan import model
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.model import (HarvestJob, HarvestObject,
+                                   HarvestGatherError, HarvestObjectError)
+from ckanext.harvest import registry
+from ckanext.harvest import fingerprint
 
 log = logging.getLogger(__name__)
 assert not log.disabled
@@ -32,12 +48,64 @@ REDIS_DB = 0
 EXCHANGE_TYPE = 'direct'
 EXCHANGE_NAME = 'ckan.harvest'
 
+# number of messages sent per round trip by send_many
+PUBLISH_BATCH_SIZE = 500
+
+# number of harvest objects sent in each fetch message
+FETCH_BATCH_SIZE = 1
+
+# seconds a Redis message can be in flight before it is resubmitted
+FETCH_TIMEOUT = 180  # 3 minutes for fetch and import max
+GATHER_TIMEOUT = 7200  # 2 hours for a gather
+
+# seconds after which a reliable Redis consumer that stopped sending
+# heartbeats is considered dead
+CONSUMER_HEARTBEAT = 30
+
+# seconds a Redis consumer that can't block on all its lists waits before
+# checking them again, and maximum number of pending wakeups kept for the
+# fair queue
+POLL_INTERVAL = 5
+MAX_WAKEUP_TOKENS = 1000
+
+# seconds between checks of an AMQP queue by get_message, as pika can't wait
+# for a message with a timeout
+AMQP_POLL_INTERVAL = 0.1
+
+# failed fetches that may succeed later are retried up to
+# RETRY_MAX_ATTEMPTS times, waiting RETRY_DELAY seconds doubled on each
+# attempt, up to RETRY_MAX_DELAY, less a random fraction up to RETRY_JITTER
+RETRY_MAX_ATTEMPTS = 5
+RETRY_DELAY = 30
+RETRY_MAX_DELAY = 3600
+RETRY_JITTER = 0.5
+
+# PostgreSQL backend: messages claimed by a consumer per query, and channel
+# used to notify the consumers of new messages
+CLAIM_BATCH_SIZE = 10
+NOTIFY_CHANNEL = 'ckan_harvest_queue'
+
+# harvest job priorities, messages with a higher one are consumed first
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1  # jobs started by hand from the web interface
+MAX_PRIORITY = 2
+
+# local backend: messages each in-memory queue holds before publishers have
+# to wait, and number of threads consuming the fetch queue
+LOCAL_QUEUE_SIZE = 10000
+LOCAL_WORKERS = 4
+
 def get_connection():
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):  # "ampq" is for compat with old typo
         return get_connection_amqp()
     if backend == 'redis':
         return get_connection_redis()
+    if backend == 'postgres':
+        return get_connection_postgres()
+    if backend == 'local':
+        # the queues are kept in the memory of this process
+        return None
     raise Exception('not a valid queue type %s' % backend)
 
 def get_connection_amqp():
@@ -62,9 +130,81 @@ def get_connection_amqp():
 
 def get_connection_redis():
     import redis
-    return redis.StrictRedis(host=config.get('ckan.harvest.mq.hostname', HOSTNAME),
-                          port=int(config.get('ckan.harvest.mq.port', REDIS_PORT)),
-                          db=int(config.get('ckan.harvest.mq.redis_db', REDIS_DB)))
+    return redis.StrictRedis(connection_pool=get_redis_pool())
+
+def get_connection_postgres():
+    # the queue is a table of the CKAN database, so its engine and
+    # connection pool are used
+    return model.meta.engine
+
+
+# Connections shared by everything in this process. They are rebuilt when
+# the process id changes, so forked workers never reuse the sockets they
+# inherited from their parent.
+_redis_pool = None
+_redis_pool_pid = None
+_amqp_pool = threading.local()
+
+# Errors after which the pooled AMQP connection is considered broken
+AMQP_CONNECTION_ERRORS = (pika.exceptions.AMQPError, socket.error)
+
+
+def get_redis_pool():
+    global _redis_pool, _redis_pool_pid
+    import redis
+    if _redis_pool is None or _redis_pool_pid != os.getpid():
+        _redis_pool = redis.ConnectionPool(
+            host=config.get('ckan.harvest.mq.hostname', HOSTNAME),
+            port=int(config.get('ckan.harvest.mq.port', REDIS_PORT)),
+            db=int(config.get('ckan.harvest.mq.redis_db', REDIS_DB)))
+        _redis_pool_pid = os.getpid()
+    return _redis_pool
+
+
+def get_pooled_channel_amqp(confirm=False):
+    '''
+    Returns the AMQP connection and channel shared by the current thread,
+    (re)opening them if they are closed. pika connections are not thread
+    safe, so each thread gets its own.
+
+    With ``confirm``, the channel is a second one in confirm mode, where
+    publishing waits for the broker to acknowledge the message.
+    '''
+    if getattr(_amqp_pool, 'pid', None) != os.getpid():
+        _amqp_pool.connection = _amqp_pool.channel = None
+        _amqp_pool.confirm_channel = None
+        _amqp_pool.pid = os.getpid()
+
+    connection = _amqp_pool.connection
+    if connection is None or not connection.is_open:
+        connection = _amqp_pool.connection = get_connection_amqp()
+        _amqp_pool.channel = _amqp_pool.confirm_channel = None
+
+    attribute = 'confirm_channel' if confirm else 'channel'
+    channel = getattr(_amqp_pool, attribute)
+    if channel is None or not channel.is_open:
+        channel = connection.channel()
+        channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
+        if confirm:
+            channel.confirm_delivery()
+        setattr(_amqp_pool, attribute, channel)
+
+    return connection, channel
+
+
+def reset_amqp_pool():
+    '''
+    Drops the AMQP connection shared by the current thread, so the next call
+    to ``get_pooled_channel_amqp`` opens a new one.
+    '''
+    connection = getattr(_amqp_pool, 'connection', None)
+    _amqp_pool.connection = _amqp_pool.channel = None
+    _amqp_pool.confirm_channel = None
+    if connection is not None and _amqp_pool.pid == os.getpid():
+        try:
+            connection.close()
+        except AMQP_CONNECTION_ERRORS:
+            pass
 
 
 def get_gather_queue_name():
@@ -95,11 +235,336 @@ def purge_queues():
         log.info('AMQP queue purged: %s', get_gather_queue_name())
         channel.queue_purge(queue=get_fetch_queue_name())
         log.info('AMQP queue purged: %s', get_fetch_queue_name())
-    elif backend == 'redis':
+    elif backend in ('redis', 'postgres', 'local'):
         get_gather_consumer().queue_purge()
-        log.info('Redis gather queue purged')
+        log.info('%s gather queue purged', backend.capitalize())
         get_fetch_consumer().queue_purge()
-        log.info('Redis fetch queue purged')
+        log.info('%s fetch queue purged', backend.capitalize())
+
+
+def get_inflight_key(routing_key):
+    '''
+    Redis sorted set holding the messages taken from the queue but not yet
+    acknowledged, scored by the time they were taken.
+    '''
+    return routing_key + ':inflight'
+
+
+def get_queued_key(routing_key):
+    '''
+    Redis set mirroring the messages waiting in a queue, used to avoid
+    queueing the same message twice. Only the gather queue uses it.
+    '''
+    return routing_key + ':queued'
+
+
+def _dedupes(routing_key):
+    return routing_key == get_gather_routing_key()
+
+
+def get_consumers_key(routing_key):
+    '''Redis set with the ids of the reliable consumers of a queue'''
+    return routing_key + ':consumers'
+
+
+def get_processing_key(routing_key, consumer_id):
+    '''
+    Redis list holding the messages a reliable consumer has taken from the
+    queue but not yet acknowledged.
+    '''
+    return routing_key + ':processing:' + consumer_id
+
+
+def get_heartbeat_key(routing_key, consumer_id):
+    return routing_key + ':heartbeat:' + consumer_id
+
+
+def get_delayed_key(routing_key):
+    '''
+    Redis sorted set holding the messages to be put back on the queue later,
+    scored by the time they are due.
+    '''
+    return routing_key + ':delayed'
+
+
+def get_delay_queue_name(routing_key, delay):
+    '''
+    AMQP queue where messages wait ``delay`` seconds before going back to
+    the queue of the given routing key.
+    '''
+    return '{0}:delay:{1}'.format(routing_key, delay)
+
+
+def get_priority_key(routing_key, priority):
+    '''
+    Redis list holding the messages of the given priority. Normal priority
+    messages use the queue list itself.
+
+    Messages of a higher priority carry it (see ``_with_priority``), so they
+    are put back on their list when they are retried or resubmitted.
+    '''
+    priority = _clamp_priority(priority)
+    if priority == PRIORITY_NORMAL:
+        return routing_key
+    return '{0}:priority:{1}'.format(routing_key, priority)
+
+
+def get_priority_keys(routing_key):
+    '''The Redis lists of all priorities of a queue, highest first'''
+    return [get_priority_key(routing_key, priority)
+            for priority in range(MAX_PRIORITY, PRIORITY_NORMAL - 1, -1)]
+
+
+# Lua function returning the list a message is put back on, for the
+# priority it carries, named like in ``get_priority_key``
+PRIORITY_KEY_LUA = b'''
+    local function priority_key(routing_key, message)
+        local ok, value = pcall(cjson.decode, message)
+        local priority = ok and type(value) == "table" and
+                         tonumber(value["priority"])
+        if not priority or priority <= %d then
+            return routing_key
+        end
+        return routing_key .. ":priority:" ..
+               string.format("%%d", math.min(priority, %d))
+    end
+''' % (PRIORITY_NORMAL, MAX_PRIORITY)
+
+# Lua function leaving a token per message on the list consumers wait on,
+# if they do (see ``_get_wakeup_key``)
+WAKEUP_LUA = b'''
+    local function wake_up(tokens_key, count)
+        if tokens_key == "" or count == 0 then
+            return
+        end
+        for i = 1, count do
+            redis.call("rpush", tokens_key, 1)
+        end
+        redis.call("ltrim", tokens_key, 0, %d)
+    end
+''' % (MAX_WAKEUP_TOKENS - 1)
+
+
+def _with_priority(body, priority):
+    '''
+    Returns the message to push to Redis for ``body``, with its
+    ``priority`` added unless it is normal.
+    '''
+    priority = _clamp_priority(priority)
+    if priority == PRIORITY_NORMAL or not isinstance(body, dict):
+        return body
+    return dict(body, priority=priority)
+
+
+def _clamp_priority(priority):
+    return min(max(int(priority or 0), PRIORITY_NORMAL), MAX_PRIORITY)
+
+
+def get_source_queue_key(routing_key, source_id):
+    '''
+    Redis list holding the fetch messages of a single harvest source, when
+    using the fair queue.
+    '''
+    return routing_key + ':source:' + source_id
+
+
+def get_sources_key(routing_key):
+    '''
+    Redis list that the fair queue consumers rotate through to pick the next
+    source to serve. Each source with messages waiting appears in it as many
+    times as its weight.
+    '''
+    return routing_key + ':sources'
+
+
+def get_active_sources_key(routing_key):
+    '''Redis set with the sources that have messages in the fair queue'''
+    return routing_key + ':sources:active'
+
+
+def get_tokens_key(routing_key):
+    '''
+    Redis list that fair and reliable queue consumers block on, so they are
+    woken up when messages of any priority are published or put back.
+    '''
+    return routing_key + ':tokens'
+
+
+def _get_wakeup_key(routing_key):
+    '''
+    Returns the tokens key of the queue if its consumers wait on it, or an
+    empty string.
+    '''
+    if redis_reliable_queue() or redis_fair_queue(routing_key):
+        return get_tokens_key(routing_key)
+    return ''
+
+
+def get_redis_push_command():
+    '''
+    Returns the Redis command that adds messages at the back of the queues.
+    Reliable consumers take messages from the tail of the list (there is no
+    blocking left pop that moves to another list in Redis < 6.2), so they
+    are pushed onto the head to keep them in order.
+    '''
+    return 'lpush' if redis_reliable_queue() else 'rpush'
+
+
+def redis_fair_queue(routing_key):
+    '''
+    Whether the given queue is split in one sub-queue per harvest source
+    (``ckan.harvest.mq.fair_queue``). Only the fetch queue is.
+    '''
+    return (routing_key == get_fetch_routing_key() and
+            toolkit.asbool(config.get('ckan.harvest.mq.fair_queue', False)))
+
+
+def get_source_weight(source):
+    '''
+    Share of the fetch consumers given to a source in the fair queue, taken
+    from the ``fetch_weight`` key of the source configuration (1 by default).
+    '''
+    try:
+        weight = int(json.loads(source.config or '{}').get('fetch_weight', 1))
+    except (ValueError, TypeError, AttributeError):
+        log.warning('Invalid fetch_weight in the configuration of source %s',
+                    source.id)
+        return 1
+    return max(weight, 1)
+
+
+def get_fetch_queue_depths():
+    '''
+    Returns the number of messages waiting in the fetch queue for each
+    harvest source, as a dict keyed by source id.
+
+    Only the Redis fair queue keeps messages by source, so for other backends
+    and modes an empty dict is returned. Messages put back on the queue after
+    a timeout and high priority messages are counted under ``None``.
+    '''
+    routing_key = get_fetch_routing_key()
+    if (config.get('ckan.harvest.mq.type') != 'redis' or
+            not redis_fair_queue(routing_key)):
+        return {}
+    redis = get_connection()
+    source_ids = sorted(redis.smembers(get_active_sources_key(routing_key)))
+    priority_keys = get_priority_keys(routing_key)
+    pipe = redis.pipeline()
+    for source_id in source_ids:
+        pipe.llen(get_source_queue_key(routing_key, source_id))
+    for key in priority_keys:
+        pipe.llen(key)
+    depths = pipe.execute()
+    result = dict(zip(source_ids, depths[:len(source_ids)]))
+    unassigned = sum(depths[len(source_ids):])
+    if unassigned:
+        result[None] = unassigned
+    return result
+
+
+def get_queue_status():
+    '''
+    Returns the state of the gather and fetch queues, to monitor them and
+    scale their consumers, as a dict keyed by stage with:
+
+    * ``depth``: number of messages waiting to be consumed
+    * ``in_flight``: number of messages taken by a consumer but not
+      acknowledged yet
+    * ``delayed``: number of messages waiting to be retried
+    * ``consumers``: number of consumers of the queue
+    * ``oldest_age``: seconds the oldest harvest job (gather) or object
+      (fetch) waiting to be processed has waited, or ``None``
+    * ``sources`` (fetch only): number of harvest objects waiting to be
+      fetched, by source id
+
+    Values the backend can't tell are ``None``: RabbitMQ doesn't report
+    unacknowledged or delayed messages, and only reliable Redis consumers
+    are registered. Messages carry no timestamp, so the ages and numbers by
+    source come from the harvest jobs and objects in the database.
+    '''
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    status = {}
+    for stage in ('gather', 'fetch'):
+        queue_name, routing_key = _get_stage_queue(stage)
+        stage_status = {'in_flight': None, 'delayed': None}
+        if backend in ('amqp', 'ampq'):
+            stage_status.update(_get_queue_status_amqp(queue_name))
+        else:
+            stage_status.update(
+                get_consumer(queue_name, routing_key).queue_status())
+        status[stage] = stage_status
+
+    now = datetime.datetime.utcnow()
+    oldest_job = model.Session.query(sqlalchemy.func.min(HarvestJob.created)) \
+        .filter(HarvestJob.status == u'Running') \
+        .filter(HarvestJob.gather_started == None) \
+        .scalar()
+    status['gather']['oldest_age'] = _age(oldest_job, now)
+
+    waiting_objects = model.Session.query(
+            HarvestObject.harvest_source_id,
+            sqlalchemy.func.count(HarvestObject.id),
+            sqlalchemy.func.min(HarvestObject.gathered)) \
+        .filter(HarvestObject.harvest_job_id == HarvestJob.id) \
+        .filter(HarvestJob.status == u'Running') \
+        .filter(HarvestObject.state == u'WAITING') \
+        .group_by(HarvestObject.harvest_source_id) \
+        .all()
+    status['fetch']['sources'] = dict(
+        (source_id, count) for source_id, count, gathered in waiting_objects)
+    gathered = [gathered for source_id, count, gathered in waiting_objects
+                if gathered]
+    status['fetch']['oldest_age'] = _age(min(gathered or [None]), now)
+    return status
+
+
+def _get_queue_status_amqp(queue_name):
+    # A connection of its own rather than the pooled one, as the broker
+    # closes the channel if the queue is missing, and pika raises that from
+    # the middle of reading the connection's frames
+    connection = get_connection_amqp()
+    try:
+        channel = connection.channel()
+        try:
+            frame = channel.queue_declare(queue=queue_name, passive=True)
+        except pika.exceptions.ChannelClosed:
+            # no consumer has declared the queue yet
+            return {'depth': 0, 'consumers': 0}
+        return {'depth': frame.method.message_count,
+                'consumers': frame.method.consumer_count}
+    finally:
+        try:
+            connection.close()
+        except AMQP_CONNECTION_ERRORS:
+            pass
+
+
+def _age(timestamp, now):
+    if timestamp is None:
+        return None
+    return max(int((now - timestamp).total_seconds()), 0)
+
+
+def redis_reliable_queue():
+    '''
+    Whether Redis consumers move messages atomically to a processing list
+    (``ckan.harvest.mq.redis_reliable``) instead of just popping them.
+    '''
+    return toolkit.asbool(config.get('ckan.harvest.mq.redis_reliable', False))
+
+
+def _get_timeout(option, default):
+    try:
+        return int(config.get(option, default))
+    except ValueError:
+        return default
+
+
+def get_queue_timeout(routing_key):
+    '''Seconds a message of the given queue can be in flight'''
+    if routing_key == get_gather_routing_key():
+        return _get_timeout('ckan.harvest.mq.gather_timeout', GATHER_TIMEOUT)
+    return _get_timeout('ckan.harvest.mq.fetch_timeout', FETCH_TIMEOUT)
 
 
 def resubmit_jobs():
@@ -108,77 +573,1035 @@ def resubmit_jobs():
     These are removed from the queues and placed back on them afresh, to ensure
     the fetch & gather consumers are triggered to process it.
     '''
-    if config.get('ckan.harvest.mq.type') != 'redis':
+    backend = config.get('ckan.harvest.mq.type')
+    if backend == 'postgres':
+        for routing_key in (get_fetch_routing_key(), get_gather_routing_key()):
+            count = release_stale_claims(get_connection(), routing_key,
+                                         get_queue_timeout(routing_key))
+            if count:
+                log.info('Resubmitted %i messages to %s', count, routing_key)
+        return
+    if backend != 'redis':
         return
     redis = get_connection()
 
+    if redis_reliable_queue():
+        for routing_key in (get_fetch_routing_key(), get_gather_routing_key()):
+            count = reap_dead_consumers(redis, routing_key)
+            if count:
+                log.info('Requeued %i messages from dead consumers of %s',
+                         count, routing_key)
+
     # fetch queue
-    harvest_object_pending = redis.keys(get_fetch_routing_key() + ':*')
-    for key in harvest_object_pending:
-        date_of_key = datetime.datetime.strptime(redis.get(key),
-                                                 "%Y-%m-%d %H:%M:%S.%f")
-        # 3 minutes for fetch and import max
-        if (datetime.datetime.now() - date_of_key).seconds > 180:
-            redis.rpush(get_fetch_routing_key(),
-                json.dumps({'harvest_object_id': key.split(':')[-1]})
-            )
-            redis.delete(key)
+    count = _requeue_stale(
+        redis, get_fetch_routing_key(),
+        _get_timeout('ckan.harvest.mq.fetch_timeout', FETCH_TIMEOUT))
+    if count:
+        log.info('Resubmitted %i harvest objects to the fetch queue', count)
 
     # gather queue
-    harvest_jobs_pending = redis.keys(get_gather_routing_key() + ':*')
-    for key in harvest_jobs_pending:
-        date_of_key = datetime.datetime.strptime(redis.get(key),
-                                                 "%Y-%m-%d %H:%M:%S.%f")
-        # 3 hours for a gather
-        if (datetime.datetime.now() - date_of_key).seconds > 7200:
-            redis.rpush(get_gather_routing_key(),
-                json.dumps({'harvest_job_id': key.split(':')[-1]})
-            )
-            redis.delete(key)
+    count = _requeue_stale(
+        redis, get_gather_routing_key(),
+        _get_timeout('ckan.harvest.mq.gather_timeout', GATHER_TIMEOUT))
+    if count:
+        log.info('Resubmitted %i harvest jobs to the gather queue', count)
+
+
+def _requeue_stale(redis, routing_key, timeout):
+    '''
+    Moves the messages that have been in flight for more than ``timeout``
+    seconds back onto the queue, atomically.
+    '''
+    # Messages are requeued unchanged. Entries left by older versions only
+    # hold the id, so their message is built by hand to match json.dumps
+    # output, which the gather publisher relies on to remove duplicates
+    lua_code = PRIORITY_KEY_LUA + WAKEUP_LUA + b'''
+        local routing_key = KEYS[1]
+        local inflight_key = KEYS[2]
+        local queued_key = KEYS[3]
+        local tokens_key = KEYS[4]
+        local message_key = ARGV[1]
+        local cutoff = ARGV[2]
+        local dedupe = ARGV[3] == "1"
+        local push_command = ARGV[4]
+        local members = redis.call("zrangebyscore", inflight_key, "-inf",
+                                   cutoff)
+        for _, message in ipairs(members) do
+            redis.call("zrem", inflight_key, message)
+            if string.sub(message, 1, 1) ~= "{" then
+                message = '{"' .. message_key .. '": ' ..
+                          cjson.encode(message) .. '}'
+            end
+            if not dedupe or redis.call("sadd", queued_key, message) == 1 then
+                redis.call(push_command, priority_key(routing_key, message),
+                           message)
+            end
+        end
+        wake_up(tokens_key, #members)
+        return #members
+    '''
+    script = redis.register_script(lua_code)
+    return script(keys=[routing_key, get_inflight_key(routing_key),
+                        get_queued_key(routing_key),
+                        _get_wakeup_key(routing_key)],
+                  args=[routing_key.split(':')[-1], time.time() - timeout,
+                        int(_dedupes(routing_key)),
+                        get_redis_push_command()])
+
+
+def reap_dead_consumers(redis, routing_key):
+    '''
+    Puts the unacknowledged messages of reliable consumers that stopped
+    sending heartbeats back on the queue of their priority, ahead of the
+    waiting messages and in the order they were taken.
+
+    Returns the number of messages requeued.
+    '''
+    # Processing lists have the last message taken at their head, and
+    # reliable consumers take messages from the tail of the queues, so the
+    # newest one is pushed onto the tail first
+    lua_code = PRIORITY_KEY_LUA + WAKEUP_LUA + b'''
+        local routing_key = KEYS[1]
+        local processing_key = KEYS[2]
+        local consumers_key = KEYS[3]
+        local heartbeat_key = KEYS[4]
+        local queued_key = KEYS[5]
+        local tokens_key = KEYS[6]
+        local consumer_id = ARGV[1]
+        local dedupe = ARGV[2] == "1"
+        if redis.call("exists", heartbeat_key) == 1 then
+            return 0
+        end
+        local count = 0
+        while true do
+            local s = redis.call("lpop", processing_key)
+            if s == false then
+                break
+            end
+            if not dedupe or redis.call("sadd", queued_key, s) == 1 then
+                redis.call("rpush", priority_key(routing_key, s), s)
+            end
+            count = count + 1
+        end
+        redis.call("srem", consumers_key, consumer_id)
+        wake_up(tokens_key, count)
+        return count
+    '''
+    script = redis.register_script(lua_code)
+    consumers_key = get_consumers_key(routing_key)
+    count = 0
+    for consumer_id in redis.smembers(consumers_key):
+        count += script(keys=[routing_key,
+                              get_processing_key(routing_key, consumer_id),
+                              consumers_key,
+                              get_heartbeat_key(routing_key, consumer_id),
+                              get_queued_key(routing_key),
+                              _get_wakeup_key(routing_key)],
+                        args=[consumer_id, int(_dedupes(routing_key))])
+    return count
+
+
+def get_dead_letter_key(routing_key):
+    '''
+    Redis list holding the messages of a queue that could not be processed,
+    newest first.
+    '''
+    return routing_key + ':dead'
+
+
+def get_dead_letter_queue_name(queue_name):
+    '''AMQP queue holding the messages that could not be processed'''
+    return queue_name + '.dead'
+
+
+def _get_stage_queue(stage):
+    if stage == 'gather':
+        return get_gather_queue_name(), get_gather_routing_key()
+    if stage == 'fetch':
+        return get_fetch_queue_name(), get_fetch_routing_key()
+    raise ValueError('Unknown harvest stage: %s' % stage)
+
+
+def dead_letter(stage, body, error, attempts=None):
+    '''
+    Keeps a message that can't be processed aside, so it doesn't block the
+    queue or get lost. The original body is stored with the error and the
+    number of attempts, to be inspected and replayed with the ``harvester
+    dlq`` command.
+    '''
+    queue_name, routing_key = _get_stage_queue(stage)
+    entry = json.dumps({
+        'body': body,
+        'error': error,
+        'attempts': attempts,
+        'failed': datetime.datetime.utcnow().isoformat(),
+    })
+    log.warning('Sending message to the %s dead letter queue: %s (%s)',
+                stage, body, error)
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend in ('amqp', 'ampq'):
+        connection, channel = get_pooled_channel_amqp()
+        dead_queue_name = get_dead_letter_queue_name(queue_name)
+        channel.queue_declare(queue=dead_queue_name, durable=True)
+        channel.basic_publish('', dead_queue_name, entry,
+                              properties=pika.BasicProperties(delivery_mode=2))
+    elif backend == 'redis':
+        get_connection().lpush(get_dead_letter_key(routing_key), entry)
+    elif backend == 'postgres':
+        with get_connection().begin() as conn:
+            conn.execute(harvest_model.harvest_queue_table.insert(),
+                         queue=get_dead_letter_key(routing_key), body=entry)
+    elif backend == 'local':
+        get_local_queue(routing_key).dead.append(entry)
+
+
+def list_dead_letters(stage, limit=None):
+    '''
+    Returns the messages in the dead letter queue of the given stage
+    (``gather`` or ``fetch``), oldest first, as dicts with the original
+    ``body``, the ``error``, the number of ``attempts`` and when it
+    ``failed``. The messages are left in the queue.
+    '''
+    queue_name, routing_key = _get_stage_queue(stage)
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend in ('amqp', 'ampq'):
+        entries = []
+        channel = _get_dead_letter_channel_amqp(queue_name)
+        try:
+            while limit is None or len(entries) < limit:
+                method, header, entry = channel.basic_get(
+                    queue=get_dead_letter_queue_name(queue_name))
+                if getattr(method, 'delivery_tag', None) is None:
+                    break
+                entries.append(json.loads(entry))
+        finally:
+            # the messages are not acknowledged, so closing the channel
+            # puts them back
+            channel.close()
+        return entries
+    elif backend == 'redis':
+        entries = get_connection().lrange(get_dead_letter_key(routing_key),
+                                          -limit if limit else 0, -1)
+        return [json.loads(entry) for entry in reversed(entries)]
+    elif backend == 'postgres':
+        table = harvest_model.harvest_queue_table
+        query = sqlalchemy.select([table.c.body]) \
+            .where(table.c.queue == get_dead_letter_key(routing_key)) \
+            .order_by(table.c.id).limit(limit)
+        return [json.loads(row.body)
+                for row in get_connection().execute(query)]
+    elif backend == 'local':
+        entries = get_local_queue(routing_key).dead[:limit]
+        return [json.loads(entry) for entry in entries]
+    return []
+
+
+def replay_dead_letters(stage, limit=None):
+    '''
+    Puts the messages in the dead letter queue of the given stage back on
+    its queue, oldest first. Messages with a body that can't be parsed are
+    kept in the dead letter queue.
+
+    Returns the number of messages replayed.
+    '''
+    queue_name, routing_key = _get_stage_queue(stage)
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    publisher = get_publisher(routing_key)
+    count = 0
+    try:
+        if backend in ('amqp', 'ampq'):
+            channel = _get_dead_letter_channel_amqp(queue_name)
+            try:
+                while limit is None or count < limit:
+                    method, header, entry = channel.basic_get(
+                        queue=get_dead_letter_queue_name(queue_name))
+                    if getattr(method, 'delivery_tag', None) is None:
+                        break
+                    body = _parse_dead_letter(entry)
+                    if body is not None:
+                        publisher.send(body)
+                        channel.basic_ack(method.delivery_tag)
+                        count += 1
+            finally:
+                # invalid messages were not acknowledged and go back
+                channel.close()
+        elif backend == 'redis':
+            redis = get_connection()
+            dead_key = get_dead_letter_key(routing_key)
+            invalid = []
+            while limit is None or count < limit:
+                entry = redis.rpop(dead_key)
+                if entry is None:
+                    break
+                body = _parse_dead_letter(entry)
+                if body is None:
+                    invalid.append(entry)
+                    continue
+                publisher.send(body)
+                count += 1
+            if invalid:
+                redis.rpush(dead_key, *reversed(invalid))
+        elif backend == 'postgres':
+            engine = get_connection()
+            last_id = 0
+            while limit is None or count < limit:
+                with engine.begin() as conn:
+                    row = conn.execute(sqlalchemy.text('''
+                        SELECT id, body FROM harvest_queue
+                        WHERE queue = :queue AND id > :last_id
+                        ORDER BY id LIMIT 1
+                        FOR UPDATE SKIP LOCKED'''),
+                        queue=get_dead_letter_key(routing_key),
+                        last_id=last_id).first()
+                    if row is None:
+                        break
+                    last_id = row.id
+                    body = _parse_dead_letter(row.body)
+                    if body is not None:
+                        publisher.send(body)
+                        conn.execute(sqlalchemy.text(
+                            'DELETE FROM harvest_queue WHERE id = :id'),
+                            id=row.id)
+                        count += 1
+        elif backend == 'local':
+            dead = get_local_queue(routing_key).dead
+            invalid = []
+            while dead and (limit is None or count < limit):
+                entry = dead.pop(0)
+                body = _parse_dead_letter(entry)
+                if body is None:
+                    invalid.append(entry)
+                    continue
+                publisher.send(body)
+                count += 1
+            dead[:0] = invalid
+    finally:
+        publisher.close()
+    return count
+
+
+def purge_dead_letters(stage):
+    '''
+    Removes all the messages in the dead letter queue of the given stage.
+
+    Returns the number of messages removed.
+    '''
+    queue_name, routing_key = _get_stage_queue(stage)
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    count = 0
+    if backend in ('amqp', 'ampq'):
+        channel = _get_dead_letter_channel_amqp(queue_name)
+        try:
+            while True:
+                method, header, entry = channel.basic_get(
+                    queue=get_dead_letter_queue_name(queue_name))
+                if getattr(method, 'delivery_tag', None) is None:
+                    break
+                channel.basic_ack(method.delivery_tag)
+                count += 1
+        finally:
+            channel.close()
+    elif backend == 'redis':
+        pipe = get_connection().pipeline()
+        pipe.llen(get_dead_letter_key(routing_key))
+        pipe.delete(get_dead_letter_key(routing_key))
+        count = pipe.execute()[0]
+    elif backend == 'postgres':
+        table = harvest_model.harvest_queue_table
+        count = get_connection().execute(table.delete().where(
+            table.c.queue == get_dead_letter_key(routing_key))).rowcount
+    elif backend == 'local':
+        dead = get_local_queue(routing_key).dead
+        count = len(dead)
+        del dead[:count]
+    return count
+
+
+def _get_dead_letter_channel_amqp(queue_name):
+    connection, channel = get_pooled_channel_amqp()
+    # a channel of its own, as unacknowledged messages are returned when
+    # it is closed
+    channel = connection.channel()
+    channel.queue_declare(queue=get_dead_letter_queue_name(queue_name),
+                          durable=True)
+    return channel
+
+
+def _parse_dead_letter(entry):
+    body = json.loads(entry)['body']
+    try:
+        return json.loads(body)
+    except (ValueError, TypeError):
+        log.warning('Not replaying message with an invalid body: %r', body)
+        return None
+
+
+def release_stale_claims(engine, routing_key, timeout):
+    '''
+    Makes the messages of the PostgreSQL queue that were claimed more than
+    ``timeout`` seconds ago available again, as their consumer has probably
+    died.
+
+    Returns the number of messages released.
+    '''
+    table = harvest_model.harvest_queue_table
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+    return engine.execute(
+        table.update()
+             .where(table.c.queue == routing_key)
+             .where(table.c.claimed < cutoff)
+             .values(claimed=None, claimed_by=None)).rowcount
+
+
+def get_claim_batch_size():
+    try:
+        return int(config.get('ckan.harvest.mq.claim_batch_size',
+                              CLAIM_BATCH_SIZE))
+    except ValueError:
+        return CLAIM_BATCH_SIZE
+
+
+def get_local_queue_size():
+    return _get_timeout('ckan.harvest.mq.local_queue_size', LOCAL_QUEUE_SIZE)
+
+
+def get_local_workers():
+    '''
+    Number of threads consuming the fetch queue of the local backend. With
+    0, no threads are started and the queues must be consumed by hand.
+    '''
+    return _get_timeout('ckan.harvest.mq.local_workers', LOCAL_WORKERS)
+
+
+# Queues of the local backend, by routing key
+_local_queues = {}
+_local_queues_lock = threading.Lock()
+
+
+def get_local_queue(routing_key):
+    '''Returns the in-memory queue of the local backend for a routing key'''
+    with _local_queues_lock:
+        if routing_key not in _local_queues:
+            _local_queues[routing_key] = LocalQueue(routing_key,
+                                                    get_local_queue_size())
+        return _local_queues[routing_key]
+
+
+def join_local_queues(timeout=None):
+    '''
+    Blocks until every message published to the queues of the local
+    backend, including the delayed ones and those published while
+    processing others, has been acknowledged.
+
+    Returns whether the queues were emptied within ``timeout`` seconds.
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        with _local_queues_lock:
+            queues = _local_queues.values()
+        if not any(local_queue.pending() for local_queue in queues):
+            return True
+        for local_queue in queues:
+            remaining = None if deadline is None else deadline - time.time()
+            if not local_queue.join(remaining):
+                return False
+
+
+def get_retry_max_attempts():
+    return _get_timeout('ckan.harvest.mq.retry_max_attempts',
+                        RETRY_MAX_ATTEMPTS)
+
+
+def get_retry_delay(attempt):
+    '''
+    Seconds to wait before trying a harvest object again after its
+    ``attempt``-th attempt failed. The delay doubles with each attempt, and
+    is shortened by a random amount so objects that failed together are not
+    retried together.
+    '''
+    delay = min(_get_timeout('ckan.harvest.mq.retry_delay', RETRY_DELAY) *
+                2 ** max(attempt - 1, 0),
+                _get_timeout('ckan.harvest.mq.retry_max_delay',
+                             RETRY_MAX_DELAY))
+    try:
+        jitter = float(config.get('ckan.harvest.mq.retry_jitter',
+                                  RETRY_JITTER))
+    except ValueError:
+        jitter = RETRY_JITTER
+    return max(delay * (1 - jitter * random.random()), 1)
+
+
+def is_transient_error(error):
+    '''
+    Whether an error raised while fetching or importing a harvest object is
+    likely to go away if it is tried again later: lost connections, timeouts
+    and overloaded or unavailable servers. Other errors are not retried.
+    '''
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in (408, 429, 500, 502, 503, 504)
+    if isinstance(error, (urllib2.URLError, socket.error)):
+        return True
+    if isinstance(error, sqlalchemy.exc.DBAPIError):
+        return (error.connection_invalidated or
+                isinstance(error, sqlalchemy.exc.OperationalError))
+    return False
+
+
+def promote_due_messages(redis, routing_key, limit=None):
+    '''
+    Moves the delayed messages that are due back onto the queue of their
+    priority.
+
+    Returns the number of messages moved.
+    '''
+    lua_code = PRIORITY_KEY_LUA + WAKEUP_LUA + b'''
+        local delayed_key = KEYS[1]
+        local routing_key = KEYS[2]
+        local tokens_key = KEYS[3]
+        local push_command = ARGV[3]
+        local messages = redis.call("zrangebyscore", delayed_key, "-inf",
+                                    ARGV[1], "LIMIT", 0, ARGV[2])
+        for _, message in ipairs(messages) do
+            redis.call("zrem", delayed_key, message)
+            redis.call(push_command, priority_key(routing_key, message),
+                       message)
+        end
+        wake_up(tokens_key, #messages)
+        return #messages
+    '''
+    script = redis.register_script(lua_code)
+    return script(keys=[get_delayed_key(routing_key), routing_key,
+                        _get_wakeup_key(routing_key)],
+                  args=[time.time(), limit or get_publish_batch_size(),
+                        get_redis_push_command()])
+
+
+def get_publish_batch_size():
+    try:
+        return int(config.get('ckan.harvest.mq.publish_batch_size',
+                              PUBLISH_BATCH_SIZE))
+    except ValueError:
+        return PUBLISH_BATCH_SIZE
+
+
+def get_fetch_batch_size():
+    try:
+        return max(int(config.get('ckan.harvest.mq.fetch_batch_size',
+                                  FETCH_BATCH_SIZE)), 1)
+    except ValueError:
+        return FETCH_BATCH_SIZE
+
+
+def get_fetch_messages(harvest_object_ids):
+    '''
+    Returns the messages to put on the fetch queue for the given harvest
+    objects: one per object, or one per chunk of
+    ``ckan.harvest.mq.fetch_batch_size`` objects if that is more than 1.
+    '''
+    batch_size = get_fetch_batch_size()
+    if batch_size == 1:
+        return ({'harvest_object_id': id} for id in harvest_object_ids)
+    return ({'harvest_object_ids': chunk}
+            for chunk in _chunks(harvest_object_ids, batch_size))
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 class Publisher(object):
-    def __init__(self, connection, channel, exchange, routing_key):
+    def __init__(self, connection, channel, exchange, routing_key,
+                 pooled=False):
         self.connection = connection
         self.channel = channel
         self.exchange = exchange
         self.routing_key = routing_key
-    def send(self, body, **kw):
-        return self.channel.basic_publish(self.exchange,
-                                          self.routing_key,
-                                          json.dumps(body),
-                                          properties=pika.BasicProperties(
-                                             delivery_mode = 2, # make message persistent
-                                          ),
-                                          **kw)
+        # pooled connections are shared, so they are not closed on close()
+        # and are reopened if they break
+        self.pooled = pooled
+        self.confirm_channel = None
+
+    def send(self, body, source=None, priority=PRIORITY_NORMAL, **kw):
+        return self._call(self._publish, body, priority, **kw)
+
+    def _call(self, method, *args, **kw):
+        '''
+        Calls ``method`` with the channel and the given arguments, once more
+        on a new connection if the pooled one was lost.
+        '''
+        try:
+            return method(self.channel, *args, **kw)
+        except AMQP_CONNECTION_ERRORS:
+            if not self.pooled:
+                raise
+            log.warning('AMQP connection lost, reconnecting')
+            reset_amqp_pool()
+            self.connection, self.channel = get_pooled_channel_amqp()
+            return method(self.channel, *args, **kw)
+
+    def send_many(self, bodies, source=None, priority=PRIORITY_NORMAL,
+                  **kw):
+        '''
+        Publishes several messages on a channel in confirm mode, kept open
+        for later calls, so each message is known to have reached the broker
+        before the next one is sent. If the connection is lost, only the
+        message that was not confirmed is published again on a new one, so
+        at most that message is delivered twice.
+
+        pika's blocking channels wait for each confirmation, so this takes a
+        round trip per message (``ckan.harvest.mq.fetch_batch_size`` sends
+        fewer messages).
+
+        ``source`` is only used by the Redis fair queue, RabbitMQ has a
+        single queue for all sources.
+
+        Returns the number of messages sent.
+        '''
+        count = 0
+        for body in bodies:
+            self._call(self._publish_confirmed, body, priority, **kw)
+            count += 1
+        return count
+
+    def _publish_confirmed(self, channel, body, priority, **kw):
+        # ``channel`` is the one ``send`` uses. A channel can't leave
+        # confirm mode, so confirmed messages go through one of their own
+        if self.pooled:
+            confirm_channel = get_pooled_channel_amqp(confirm=True)[1]
+        else:
+            if self.confirm_channel is None or \
+                    not self.confirm_channel.is_open:
+                self.confirm_channel = self.connection.channel()
+                self.confirm_channel.confirm_delivery()
+            confirm_channel = self.confirm_channel
+        if not self._publish(confirm_channel, body, priority, **kw):
+            raise Exception('The broker rejected the message %r' % body)
+
+    def send_delayed(self, body, delay, priority=PRIORITY_NORMAL):
+        '''
+        Publishes a message that reaches the queue after ``delay`` seconds,
+        with the given ``priority``.
+
+        The message waits in a queue without consumers until its TTL expires,
+        and is then dead-lettered back to the exchange. Messages only expire
+        from the head of a queue, so there is one waiting queue per power of
+        two seconds, which keeps short delays from waiting behind long ones.
+        '''
+        return self._call(self._publish_delayed, body, delay, priority)
+
+    def _publish_delayed(self, channel, body, delay, priority):
+        bucket = 2 ** int(math.ceil(math.log(max(delay, 1), 2)))
+        queue_name = get_delay_queue_name(self.routing_key, bucket)
+        channel.queue_declare(queue=queue_name, durable=True, arguments={
+            'x-dead-letter-exchange': self.exchange,
+            'x-dead-letter-routing-key': self.routing_key,
+            'x-message-ttl': bucket * 1000,
+            # drop the queue once it has been unused for a while
+            'x-expires': bucket * 2000 + 60000,
+        })
+        return channel.basic_publish('',
+                                     queue_name,
+                                     json.dumps(body),
+                                     properties=pika.BasicProperties(
+                                        delivery_mode=2,
+                                        expiration=str(int(delay * 1000)),
+                                        # kept when it is dead-lettered
+                                        priority=_clamp_priority(priority),
+                                     ))
+
+    def _publish(self, channel, body, priority=PRIORITY_NORMAL, **kw):
+        return channel.basic_publish(self.exchange,
+                                     self.routing_key,
+                                     json.dumps(body),
+                                     properties=pika.BasicProperties(
+                                        delivery_mode = 2, # make message persistent
+                                        priority=_clamp_priority(priority),
+                                     ),
+                                     **kw)
+
     def close(self):
-        self.connection.close()
+        if not self.pooled:
+            self.connection.close()
 
 class RedisPublisher(object):
+
+    # Pushes the messages in ARGV[2..n] that are not already waiting in the
+    # queue, checking the companion set rather than scanning the list
+    dedupe_push_lua = WAKEUP_LUA + b'''
+        local routing_key = KEYS[1]
+        local queued_key = KEYS[2]
+        local tokens_key = KEYS[3]
+        local push_command = ARGV[1]
+        local count = 0
+        for i = 2, #ARGV do
+            if redis.call("sadd", queued_key, ARGV[i]) == 1 then
+                redis.call(push_command, routing_key, ARGV[i])
+                count = count + 1
+            end
+        end
+        wake_up(tokens_key, count)
+        return count
+    '''
+
+    # Pushes the messages in ARGV[3..n] onto the queue of source ARGV[1],
+    # adding it ARGV[2] times to the sources the consumers rotate through if
+    # it had nothing waiting, and leaves a wakeup token for each message
+    fair_push_lua = WAKEUP_LUA + b'''
+        local source_queue_key = KEYS[1]
+        local sources_key = KEYS[2]
+        local active_key = KEYS[3]
+        local tokens_key = KEYS[4]
+        local source_id = ARGV[1]
+        local weight = tonumber(ARGV[2])
+        for i = 3, #ARGV do
+            redis.call("rpush", source_queue_key, ARGV[i])
+        end
+        if redis.call("sadd", active_key, source_id) == 1 then
+            for i = 1, weight do
+                redis.call("lpush", sources_key, source_id)
+            end
+        end
+        wake_up(tokens_key, #ARGV - 2)
+        return #ARGV - 2
+    '''
+
     def __init__(self, redis, routing_key):
         self.redis = redis ## not used
         self.routing_key = routing_key
-    def send(self, body, **kw):
-        value = json.dumps(body)
-        # remove if already there
-        if self.routing_key == get_gather_routing_key():
-            self.redis.lrem(self.routing_key, 0, value)
-        self.redis.rpush(self.routing_key, value)
+        self.push_command = get_redis_push_command()
+        self.wakeup_key = _get_wakeup_key(routing_key)
+        self.dedupe = _dedupes(routing_key)
+        if self.dedupe:
+            self.dedupe_push = self.redis.register_script(self.dedupe_push_lua)
+        self.fair = redis_fair_queue(routing_key)
+        if self.fair:
+            self.fair_push = self.redis.register_script(self.fair_push_lua)
+
+    def send(self, body, source=None, priority=PRIORITY_NORMAL, **kw):
+        self._push([json.dumps(_with_priority(body, priority))], source,
+                   priority)
+
+    def send_many(self, bodies, source=None, priority=PRIORITY_NORMAL,
+                  **kw):
+        '''
+        Pushes several messages, using one multi-value RPUSH (or one script
+        call, on the deduplicated gather queue) per batch of
+        ``ckan.harvest.mq.publish_batch_size`` messages instead of a round
+        trip per message.
+
+        With the fair queue enabled, the messages go to the sub-queue of the
+        given harvest ``source``, unless they have a higher ``priority``.
+
+        Returns the number of messages sent.
+        '''
+        count = 0
+        for chunk in _chunks(bodies, get_publish_batch_size()):
+            values = [json.dumps(_with_priority(body, priority))
+                      for body in chunk]
+            self._push(values, source, priority)
+            count += len(values)
+        return count
+
+    def _push(self, values, source, priority):
+        key = get_priority_key(self.routing_key, priority)
+        if self.fair and source is not None and key == self.routing_key:
+            # normal priority messages wait for the turn of their source
+            self._fair_push(source, values)
+        elif self.dedupe:
+            # skip the ones already there
+            self._dedupe_push(key, values)
+        elif self.wakeup_key:
+            pipe = self.redis.pipeline()
+            getattr(pipe, self.push_command)(key, *values)
+            # wake up the consumers waiting on the queue
+            pipe.rpush(self.wakeup_key, *([1] * len(values)))
+            pipe.ltrim(self.wakeup_key, 0, MAX_WAKEUP_TOKENS - 1)
+            pipe.execute()
+        else:
+            getattr(self.redis, self.push_command)(key, *values)
+
+    def send_delayed(self, body, delay, priority=PRIORITY_NORMAL):
+        '''
+        Adds a message to the delayed set, from where consumers move it to
+        the queue of its ``priority`` after ``delay`` seconds.
+        '''
+        self.redis.zadd(get_delayed_key(self.routing_key),
+                        time.time() + delay,
+                        json.dumps(_with_priority(body, priority)))
+
+    def _dedupe_push(self, key, values):
+        return self.dedupe_push(
+            keys=[key, get_queued_key(self.routing_key), self.wakeup_key],
+            args=[self.push_command] + values)
+
+    def _fair_push(self, source, values):
+        return self.fair_push(
+            keys=[get_source_queue_key(self.routing_key, source.id),
+                  get_sources_key(self.routing_key),
+                  get_active_sources_key(self.routing_key),
+                  get_tokens_key(self.routing_key)],
+            args=[source.id, get_source_weight(source)] + values)
+
+    def close(self):
+        return
+
+class PostgresPublisher(object):
+    '''
+    Publishes messages as rows of the ``harvest_queue`` table, and notifies
+    the waiting consumers when they are committed.
+    '''
+
+    def __init__(self, engine, routing_key):
+        self.engine = engine
+        self.routing_key = routing_key
+        self.dedupe = _dedupes(routing_key)
+
+    def send(self, body, source=None, priority=PRIORITY_NORMAL, **kw):
+        self._insert([json.dumps(body)], priority)
+
+    def send_many(self, bodies, source=None, priority=PRIORITY_NORMAL,
+                  **kw):
+        '''
+        Inserts several messages, with one statement and transaction per
+        batch of ``ckan.harvest.mq.publish_batch_size`` messages.
+
+        Returns the number of messages sent.
+        '''
+        count = 0
+        for chunk in _chunks(bodies, get_publish_batch_size()):
+            values = [json.dumps(body) for body in chunk]
+            self._insert(values, priority)
+            count += len(values)
+        return count
+
+    def send_delayed(self, body, delay, priority=PRIORITY_NORMAL):
+        '''Inserts a message that can't be claimed for ``delay`` seconds'''
+        self._insert([json.dumps(body)], priority, delay=delay)
+
+    def _insert(self, values, priority, delay=0):
+        table = harvest_model.harvest_queue_table
+        available = (datetime.datetime.utcnow() +
+                     datetime.timedelta(seconds=delay))
+        with self.engine.begin() as conn:
+            if self.dedupe:
+                # skip the messages already waiting
+                waiting = set(row.body for row in conn.execute(
+                    sqlalchemy.select([table.c.body])
+                              .where(table.c.queue == self.routing_key)
+                              .where(table.c.claimed == None)
+                              .where(table.c.body.in_(values))))
+                values = [value for value in values if value not in waiting]
+            if not values:
+                return
+            conn.execute(table.insert(), [
+                {'queue': self.routing_key, 'body': value,
+                 'priority': _clamp_priority(priority),
+                 'available': available}
+                for value in values])
+            # delivered when the transaction commits
+            conn.execute(sqlalchemy.select([
+                sqlalchemy.func.pg_notify(NOTIFY_CHANNEL, self.routing_key)]))
+
+    def close(self):
+        return
+
+
+class LocalQueue(object):
+    '''
+    Bounded in-memory queue of the local backend, shared by the publishers
+    and consumers of a routing key in this process.
+
+    Publishers wait while it holds ``maxsize`` messages, so a gather can't
+    get far ahead of the fetch workers. Messages are delivered by priority,
+    then in the order they were published, and count as pending until they
+    are acknowledged.
+    '''
+
+    def __init__(self, routing_key, maxsize):
+        self.routing_key = routing_key
+        self.maxsize = maxsize
+        self.dedupe = _dedupes(routing_key)
+        self.condition = threading.Condition()
+        self.sequence = itertools.count(1)
+        # heaps of (-priority, tag, body) and (due time, tag, body, priority)
+        self.messages = []
+        self.delayed = []
+        # bodies waiting to be consumed, to skip duplicates
+        self.waiting = set()
+        # (body, priority) delivered but not acknowledged yet, by tag
+        self.unacked = {}
+        # dead letters, oldest first
+        self.dead = []
+
+    def put(self, bodies, priority=PRIORITY_NORMAL):
+        '''Adds messages, waiting for room in the queue when it is full'''
+        with self.condition:
+            for body in bodies:
+                if self.dedupe and body in self.waiting:
+                    continue
+                while len(self.messages) >= self.maxsize:
+                    self.condition.wait(POLL_INTERVAL)
+                self._push(body, _clamp_priority(priority))
+
+    def put_delayed(self, body, delay, priority=PRIORITY_NORMAL):
+        with self.condition:
+            heapq.heappush(self.delayed,
+                           (time.time() + delay, next(self.sequence), body,
+                            _clamp_priority(priority)))
+            self.condition.notify_all()
+
+    def _push(self, body, priority):
+        heapq.heappush(self.messages,
+                       (-priority, next(self.sequence), body))
+        if self.dedupe:
+            self.waiting.add(body)
+        self.condition.notify_all()
+
+    def _promote_due_messages(self):
+        now = time.time()
+        while (self.delayed and self.delayed[0][0] <= now and
+               len(self.messages) < self.maxsize):
+            due, tag, body, priority = heapq.heappop(self.delayed)
+            self._push(body, priority)
+
+    def get(self, timeout=None):
+        '''
+        Takes the next message, waiting up to ``timeout`` seconds for one
+        (forever if None). Returns a ``(tag, body)`` tuple, or ``(None,
+        None)`` when there was no message.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                self._promote_due_messages()
+                if self.messages:
+                    priority, tag, body = heapq.heappop(self.messages)
+                    self.waiting.discard(body)
+                    self.unacked[tag] = (body, -priority)
+                    # there is room for the publishers again
+                    self.condition.notify_all()
+                    return tag, body
+                wait = POLL_INTERVAL
+                if self.delayed:
+                    wait = min(wait, self.delayed[0][0] - time.time())
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None, None
+                    wait = min(wait, remaining)
+                self.condition.wait(max(wait, 0.01))
+
+    def ack(self, tag):
+        with self.condition:
+            if self.unacked.pop(tag, None) is not None:
+                self.condition.notify_all()
+
+    def requeue(self, tag, delay):
+        '''
+        Puts a message that was not acknowledged back on the queue after
+        ``delay`` seconds, as a broker would after losing its consumer.
+        '''
+        with self.condition:
+            body, priority = self.unacked.pop(tag, (None, None))
+            if body is not None:
+                heapq.heappush(self.delayed,
+                               (time.time() + delay, tag, body, priority))
+                self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return {'depth': len(self.messages),
+                    'in_flight': len(self.unacked),
+                    'delayed': len(self.delayed)}
+
+    def pending(self):
+        '''Number of messages not acknowledged yet, delayed ones included'''
+        with self.condition:
+            return len(self.messages) + len(self.delayed) + len(self.unacked)
+
+    def join(self, timeout=None):
+        '''
+        Waits until all the messages are acknowledged. Returns whether they
+        were within ``timeout`` seconds.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.messages or self.delayed or self.unacked:
+                wait = POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                self.condition.wait(wait)
+        return True
+
+    def purge(self):
+        '''Removes the messages waiting, returning how many there were'''
+        with self.condition:
+            count = len(self.messages) + len(self.delayed)
+            del self.messages[:]
+            del self.delayed[:]
+            self.waiting.clear()
+            self.condition.notify_all()
+        return count
+
+
+class LocalPublisher(object):
+    '''Publishes messages to a queue of the local backend'''
+
+    def __init__(self, local_queue):
+        self.queue = local_queue
+
+    def send(self, body, source=None, priority=PRIORITY_NORMAL, **kw):
+        self.queue.put([json.dumps(body)], priority)
+
+    def send_many(self, bodies, source=None, priority=PRIORITY_NORMAL,
+                  **kw):
+        '''
+        Adds several messages, waiting for the consumers to make room in the
+        queue if needed.
+
+        Returns the number of messages sent.
+        '''
+        count = 0
+        for chunk in _chunks(bodies, get_publish_batch_size()):
+            self.queue.put([json.dumps(body) for body in chunk], priority)
+            count += len(chunk)
+        return count
+
+    def send_delayed(self, body, delay, priority=PRIORITY_NORMAL):
+        self.queue.put_delayed(json.dumps(body), delay, priority)
 
     def close(self):
         return
 
 def get_publisher(routing_key):
-    connection = get_connection()
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
+        connection, channel = get_pooled_channel_amqp()
         return Publisher(connection,
                          channel,
                          EXCHANGE_NAME,
-                         routing_key=routing_key)
+                         routing_key=routing_key,
+                         pooled=True)
     if backend == 'redis':
-        return RedisPublisher(connection, routing_key)
+        return RedisPublisher(get_connection_redis(), routing_key)
+    if backend == 'postgres':
+        return PostgresPublisher(get_connection_postgres(), routing_key)
+    if backend == 'local':
+        from ckanext.harvest.workers import start_local_workers
+        # the messages are processed by threads of the publishing process
+        start_local_workers()
+        return LocalPublisher(get_local_queue(routing_key))
+    raise Exception('not a valid queue type %s' % backend)
 
 
 class FakeMethod(object):
@@ -188,6 +1611,48 @@ class FakeMethod(object):
 
 
 class RedisConsumer(object):
+
+    # Takes the next message. The lists of each priority in KEYS[4..n] are
+    # checked in turn, then the sources of the fair queue are served in turn
+    # by rotating their list. In reliable mode the message is moved to the
+    # processing list KEYS[3] in the same step.
+    pop_lua = b'''
+        local sources_key = KEYS[1]
+        local active_key = KEYS[2]
+        local processing_key = KEYS[3]
+        local pop_command = ARGV[1]
+        local source_queue_prefix = ARGV[2]
+        local message = false
+        for i = 4, #KEYS do
+            message = redis.call(pop_command, KEYS[i])
+            if message then
+                break
+            end
+        end
+        if not message then
+            for i = 1, redis.call("llen", sources_key) do
+                local source_id = redis.call("rpoplpush", sources_key,
+                                             sources_key)
+                if not source_id then
+                    break
+                end
+                local source_queue_key = source_queue_prefix .. source_id
+                message = redis.call("lpop", source_queue_key)
+                if redis.call("llen", source_queue_key) == 0 then
+                    redis.call("lrem", sources_key, 0, source_id)
+                    redis.call("srem", active_key, source_id)
+                end
+                if message then
+                    break
+                end
+            end
+        end
+        if message and processing_key ~= "" then
+            redis.call("lpush", processing_key, message)
+        end
+        return message
+    '''
+
     def __init__(self, redis, routing_key):
         self.redis = redis
         # Routing keys are constructed with {site-id}:{message-key}, eg:
@@ -196,28 +1661,160 @@ class RedisConsumer(object):
         # Message keys are harvest_job_id for the gather consumer and
         # harvest_object_id for the fetch consumer
         self.message_key = routing_key.split(':')[-1]
+        self.priority_keys = get_priority_keys(routing_key)
+        self.reliable = redis_reliable_queue()
+        self.dedupe = _dedupes(routing_key)
+        self.consumer_id = None
+        self.fair = redis_fair_queue(routing_key)
+        self.pop = self.redis.register_script(self.pop_lua)
+        self.next_promotion = 0
 
     def consume(self, queue):
+        if self.reliable:
+            self._register()
         while True:
-            key, body = self.redis.blpop(self.routing_key)
-            self.redis.set(self.persistance_key(body),
-                           str(datetime.datetime.now()))
+            self._promote_due_messages()
+            if self.fair or self.reliable:
+                body = self._pop()
+                if body is None:
+                    self._wait(POLL_INTERVAL)
+            else:
+                # BLPOP checks the lists in the order given
+                popped = self.redis.blpop(self.priority_keys,
+                                          timeout=POLL_INTERVAL)
+                body = popped[1] if popped else None
+            if body is None:
+                continue
+            self._taken(body)
             yield (FakeMethod(body), self, body)
 
-    def persistance_key(self, message):
-        # If you change this, make sure to update the script in `queue_purge`
-        message = json.loads(message)
+    def _pop(self):
+        return self.pop(
+            keys=[get_sources_key(self.routing_key),
+                  get_active_sources_key(self.routing_key),
+                  self.processing_key if self.reliable else ''] +
+                 self.priority_keys,
+            args=['rpop' if self.reliable else 'lpop',
+                  get_source_queue_key(self.routing_key, '')])
+
+    def _wait(self, timeout):
+        '''
+        Blocks for up to ``timeout`` seconds until there might be messages to
+        take, of any priority.
+        '''
+        # Publishers leave a token for each message. BRPOPLPUSH can only
+        # wait on one list, so it would miss higher priority messages, and
+        # the fair queue is split in a list per source. The timeout is there
+        # for tokens trimmed away or left before a crash.
+        self.redis.blpop(get_tokens_key(self.routing_key),
+                         timeout=_blpop_timeout(timeout))
+
+    def _promote_due_messages(self):
+        '''
+        Moves the delayed messages that are due to the queue, at most once
+        every ``POLL_INTERVAL`` seconds.
+        '''
+        now = time.time()
+        if now < self.next_promotion:
+            return
+        self.next_promotion = now + POLL_INTERVAL
+        promote_due_messages(self.redis, self.routing_key)
+
+    def _taken(self, body):
+        pipe = self.redis.pipeline()
+        if not self.reliable:
+            # the whole message is kept, so batches of ids and messages
+            # that don't parse can be acknowledged and requeued as they are
+            pipe.zadd(self.inflight_key, time.time(), body)
+        if self.dedupe:
+            pipe.srem(self.queued_key, body)
+        pipe.execute()
+
+    @property
+    def queued_key(self):
+        return get_queued_key(self.routing_key)
+
+    @property
+    def processing_key(self):
+        return get_processing_key(self.routing_key, self.consumer_id)
+
+    def _register(self):
+        '''
+        Gives a reliable consumer an id and starts sending heartbeats for it,
+        so its processing list is requeued if the process dies.
+        '''
+        if self.consumer_id is not None:
+            return
+        self.consumer_id = '{0}:{1}:{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.heartbeat_ttl = _get_timeout('ckan.harvest.mq.consumer_heartbeat',
+                                          CONSUMER_HEARTBEAT)
+        self._beat()
+        heartbeat = threading.Thread(target=self._heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+
+    def _beat(self):
+        pipe = self.redis.pipeline()
+        pipe.setex(get_heartbeat_key(self.routing_key, self.consumer_id),
+                   self.heartbeat_ttl, 1)
+        pipe.sadd(get_consumers_key(self.routing_key), self.consumer_id)
+        pipe.execute()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(max(self.heartbeat_ttl / 3.0, 1))
+            try:
+                self._beat()
+            except Exception:
+                log.exception('Could not send heartbeat for consumer %s',
+                              self.consumer_id)
 
-        # something has been dumping {[message_key]: null} entries
-        # into the harvest queue. At this point, it's a lot cause to
-        # try to figure out what was originally referenced. If we just
-        # pass back routing_key:None, then we'll get a harvest object we
-        # can't find, and a local error will result but all the queues
-        # won't be blocked.
-        return self.routing_key + ':' + str(message[self.message_key])
+    @property
+    def inflight_key(self):
+        return get_inflight_key(self.routing_key)
 
     def basic_ack(self, message):
-        self.redis.delete(self.persistance_key(message))
+        if self.reliable:
+            self.redis.lrem(self.processing_key, -1, message)
+        else:
+            self.redis.zrem(self.inflight_key, message)
+
+    def close(self):
+        return
+
+    def queue_status(self):
+        '''
+        Returns the number of messages waiting, in flight and delayed, and
+        of consumers registered (only reliable ones are).
+        '''
+        source_keys = []
+        if self.fair:
+            source_keys = [
+                get_source_queue_key(self.routing_key, source_id)
+                for source_id in self.redis.smembers(
+                    get_active_sources_key(self.routing_key))]
+        consumer_ids = []
+        if self.reliable:
+            consumer_ids = list(self.redis.smembers(
+                get_consumers_key(self.routing_key)))
+        pipe = self.redis.pipeline()
+        for key in self.priority_keys + source_keys:
+            pipe.llen(key)
+        for consumer_id in consumer_ids:
+            pipe.llen(get_processing_key(self.routing_key, consumer_id))
+        pipe.zcard(self.inflight_key)
+        pipe.zcard(get_delayed_key(self.routing_key))
+        results = pipe.execute()
+        num_lists = len(self.priority_keys) + len(source_keys)
+        waiting, processing = results[:num_lists], results[num_lists:-2]
+        inflight, delayed = results[-2:]
+        return {
+            'depth': sum(waiting),
+            'in_flight': sum(processing) if self.reliable else inflight,
+            'delayed': delayed,
+            'consumers': len(consumer_ids) if self.reliable else None,
+        }
 
     def queue_purge(self, queue=None):
         '''
@@ -228,30 +1825,297 @@ class RedisConsumer(object):
         '''
         # Use a script to make the operation atomic
         lua_code = b'''
-            local routing_key = KEYS[1]
-            local message_key = ARGV[1]
+            local inflight_key = KEYS[1]
+            local queued_key = KEYS[2]
+            local sources_key = KEYS[3]
+            local active_key = KEYS[4]
+            local tokens_key = KEYS[5]
+            local delayed_key = KEYS[6]
+            local source_queue_prefix = ARGV[1]
             local count = 0
-            while true do
-                local s = redis.call("lpop", routing_key)
-                if s == false then
-                    break
+            local function purge(queue_key)
+                while true do
+                    local s = redis.call("lpop", queue_key)
+                    if s == false then
+                        break
+                    end
+                    redis.call("zrem", inflight_key, s)
+                    count = count + 1
                 end
-                local value = cjson.decode(s)
-                local id = value[message_key]
-                local persistance_key = routing_key .. ":" .. id
-                redis.call("del", persistance_key)
-                count = count + 1
             end
+            -- lists of each priority
+            for i = 7, #KEYS do
+                purge(KEYS[i])
+            end
+            -- sub-queues of the fair queue
+            for _, source_id in ipairs(redis.call("smembers", active_key)) do
+                purge(source_queue_prefix .. source_id)
+            end
+            count = count + redis.call("zcard", delayed_key)
+            redis.call("del", queued_key, sources_key, active_key, tokens_key,
+                       delayed_key)
             return count
         '''
         script = self.redis.register_script(lua_code)
-        return script(keys=[self.routing_key], args=[self.message_key])
-
-    def basic_get(self, queue):
-        body = self.redis.lpop(self.routing_key)
+        return script(keys=[self.inflight_key,
+                            self.queued_key,
+                            get_sources_key(self.routing_key),
+                            get_active_sources_key(self.routing_key),
+                            get_tokens_key(self.routing_key),
+                            get_delayed_key(self.routing_key)] +
+                           self.priority_keys,
+                      args=[get_source_queue_key(self.routing_key, '')])
+
+    def basic_get(self, queue, timeout=0):
+        '''
+        Takes the next message, waiting up to ``timeout`` seconds for one.
+        '''
+        if self.reliable:
+            self._register()
+        self._promote_due_messages()
+        if timeout and not (self.fair or self.reliable):
+            popped = self.redis.blpop(self.priority_keys,
+                                      timeout=_blpop_timeout(timeout))
+            body = popped[1] if popped else None
+        else:
+            body = self._pop()
+            if body is None and timeout:
+                self._wait(timeout)
+                body = self._pop()
+        if body is not None:
+            self._taken(body)
         return (FakeMethod(body), self, body)
 
 
+def _blpop_timeout(timeout):
+    # BLPOP takes whole seconds, and 0 waits forever
+    return max(int(math.ceil(timeout)), 1)
+
+
+class PostgresConsumer(object):
+    '''
+    Consumes the messages of a queue from the ``harvest_queue`` table.
+
+    Messages are claimed in batches with ``SELECT ... FOR UPDATE SKIP
+    LOCKED``, so consumers never wait for each other or get the same
+    message. Acknowledged messages are deleted together, before the next
+    batch is claimed, so a consumer that dies after acknowledging some of
+    them may have them delivered again. Idle consumers wait for a
+    notification rather than polling the table.
+    '''
+
+    claim_sql = sqlalchemy.text('''
+        UPDATE harvest_queue SET claimed = :now, claimed_by = :consumer_id
+        WHERE id IN (
+            SELECT id FROM harvest_queue
+            WHERE queue = :queue AND claimed IS NULL AND available <= :now
+            ORDER BY priority DESC, id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED)
+        RETURNING id, body, priority''')
+
+    def __init__(self, engine, routing_key):
+        self.engine = engine
+        self.routing_key = routing_key
+        self.consumer_id = '{0}:{1}:{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.timeout = get_queue_timeout(routing_key)
+        # messages claimed but not handed out yet, and when
+        self.claimed = []
+        self.claimed_at = None
+        # acknowledged messages not deleted yet, which can come from other
+        # threads
+        self.acked = []
+        self.acked_lock = threading.Lock()
+        self.listener = None
+
+    def consume(self, queue):
+        while True:
+            if not self.claimed:
+                self._delete_acked()
+                self.claimed = self._claim(get_claim_batch_size())
+                if not self.claimed:
+                    self._wait(POLL_INTERVAL)
+                    continue
+            self._renew_claims()
+            id, body = self.claimed.pop(0)
+            yield (FakeMethod(id), self, body)
+
+    def _claim(self, limit):
+        with self.engine.begin() as conn:
+            rows = conn.execute(self.claim_sql,
+                                now=datetime.datetime.utcnow(),
+                                consumer_id=self.consumer_id,
+                                queue=self.routing_key,
+                                limit=limit).fetchall()
+        self.claimed_at = time.time()
+        # RETURNING doesn't keep the order of the subquery
+        rows.sort(key=lambda row: (-row.priority, row.id))
+        return [(row.id, row.body) for row in rows]
+
+    def _renew_claims(self):
+        '''
+        Refreshes the claims on the messages held by this consumer, so they
+        aren't released as stale while the ones before them are processed.
+        '''
+        if time.time() - self.claimed_at < self.timeout / 2.0:
+            return
+        # the acknowledged ones are still claimed until they are deleted
+        self._delete_acked()
+        table = harvest_model.harvest_queue_table
+        self.engine.execute(
+            table.update()
+                 .where(table.c.id.in_([id for id, body in self.claimed]))
+                 .values(claimed=datetime.datetime.utcnow()))
+        self.claimed_at = time.time()
+
+    def _wait(self, timeout):
+        '''
+        Blocks until a message is published, or for ``timeout`` seconds so
+        delayed messages are noticed when they become available.
+        '''
+        if self.listener is None:
+            import psycopg2.extensions
+            # a connection of its own, kept out of the pool
+            self.listener = self.engine.raw_connection()
+            self.listener.detach()
+            self.listener.connection.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self.listener.cursor()
+            cursor.execute('LISTEN ' + NOTIFY_CHANNEL)
+            cursor.close()
+            # messages might have been published before listening
+            return
+        connection = self.listener.connection
+        try:
+            ready = select.select([connection], [], [], timeout)
+        except select.error as e:
+            # interrupted by a signal, which the caller may want to act on
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready != ([], [], []):
+            connection.poll()
+            del connection.notifies[:]
+
+    def basic_ack(self, delivery_tag):
+        with self.acked_lock:
+            self.acked.append(delivery_tag)
+            full = len(self.acked) >= get_claim_batch_size()
+        if full:
+            self._delete_acked()
+
+    def _delete_acked(self):
+        with self.acked_lock:
+            ids, self.acked = self.acked, []
+        if ids:
+            self.engine.execute(sqlalchemy.text(
+                'DELETE FROM harvest_queue WHERE id = ANY(:ids)'), ids=ids)
+
+    def close(self):
+        '''
+        Deletes the acknowledged messages and closes the connection used to
+        wait for notifications.
+        '''
+        self._delete_acked()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def queue_status(self):
+        '''Returns the number of messages waiting, in flight and delayed'''
+        table = harvest_model.harvest_queue_table
+        now = datetime.datetime.utcnow()
+
+        def count(condition):
+            return sqlalchemy.func.coalesce(sqlalchemy.func.sum(
+                sqlalchemy.case([(condition, 1)], else_=0)), 0)
+
+        waiting, in_flight, delayed = self.engine.execute(
+            sqlalchemy.select([
+                count(sqlalchemy.and_(table.c.claimed == None,
+                                      table.c.available <= now)),
+                count(table.c.claimed != None),
+                count(sqlalchemy.and_(table.c.claimed == None,
+                                      table.c.available > now))])
+            .where(table.c.queue == self.routing_key)).first()
+        # SUM returns a decimal
+        return {'depth': int(waiting), 'in_flight': int(in_flight),
+                'delayed': int(delayed), 'consumers': None}
+
+    def basic_get(self, queue, timeout=0):
+        '''
+        Takes the next message, waiting up to ``timeout`` seconds for one.
+        '''
+        self._delete_acked()
+        claimed = self._claim(1)
+        if not claimed and timeout:
+            self._wait(timeout)
+            claimed = self._claim(1)
+        if not claimed:
+            return (FakeMethod(None), self, None)
+        id, body = claimed[0]
+        return (FakeMethod(id), self, body)
+
+    def queue_purge(self, queue=None):
+        '''
+        Purge the consumer's queue.
+
+        The ``queue`` parameter exists only for compatibility and is
+        ignored.
+        '''
+        table = harvest_model.harvest_queue_table
+        return self.engine.execute(table.delete().where(
+            table.c.queue == self.routing_key)).rowcount
+
+
+class LocalConsumer(object):
+    '''Consumes the messages of a queue of the local backend'''
+
+    def __init__(self, local_queue):
+        self.queue = local_queue
+
+    def consume(self, queue):
+        while True:
+            tag, body = self.queue.get()
+            yield (FakeMethod(tag), self, body)
+
+    def basic_ack(self, delivery_tag):
+        self.queue.ack(delivery_tag)
+
+    def close(self):
+        return
+
+    def queue_status(self):
+        '''Returns the number of messages waiting, in flight and delayed'''
+        status = self.queue.status()
+        status['consumers'] = None
+        return status
+
+    def requeue_unacked(self, delivery_tag):
+        '''
+        Puts the message back on the queue, to be tried again after
+        ``POLL_INTERVAL`` seconds, unless it was acknowledged.
+        '''
+        self.queue.requeue(delivery_tag, POLL_INTERVAL)
+
+    def basic_get(self, queue, timeout=0):
+        '''
+        Takes the next message, waiting up to ``timeout`` seconds for one.
+        '''
+        tag, body = self.queue.get(timeout=timeout)
+        return (FakeMethod(tag), self, body)
+
+    def queue_purge(self, queue=None):
+        '''
+        Purge the consumer's queue.
+
+        The ``queue`` parameter exists only for compatibility and is
+        ignored.
+        '''
+        return self.queue.purge()
+
+
 def get_consumer(queue_name, routing_key):
 
     connection = get_connection()
@@ -260,19 +2124,65 @@ def get_consumer(queue_name, routing_key):
     if backend in ('amqp', 'ampq'):
         channel = connection.channel()
         channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
-        channel.queue_declare(queue=queue_name, durable=True)
+        channel = _declare_queue_amqp(connection, channel, queue_name)
         channel.queue_bind(queue=queue_name, exchange=EXCHANGE_NAME, routing_key=routing_key)
+        # only take one message at a time, so higher priority messages
+        # published meanwhile are delivered next
+        channel.basic_qos(prefetch_count=1)
         return channel
     if backend == 'redis':
         return RedisConsumer(connection, routing_key)
+    if backend == 'postgres':
+        return PostgresConsumer(connection, routing_key)
+    if backend == 'local':
+        return LocalConsumer(get_local_queue(routing_key))
+
+
+def get_message(consumer, queue, timeout):
+    '''
+    Takes the next message of ``queue`` from ``consumer``, waiting up to
+    ``timeout`` seconds for one. Returns ``(method, header, body)``, with a
+    None body if there was no message.
+
+    Unlike ``consume`` it returns when there are no messages, so consumers
+    can stop between messages without leaving one taken and not processed.
+    '''
+    if not isinstance(consumer, pika.channel.Channel):
+        return consumer.basic_get(queue=queue, timeout=timeout)
+    deadline = time.time() + timeout
+    while True:
+        method, header, body = consumer.basic_get(queue=queue)
+        if body is not None or time.time() >= deadline:
+            return (method, header, body)
+        time.sleep(AMQP_POLL_INTERVAL)
+
+
+def _declare_queue_amqp(connection, channel, queue_name):
+    '''
+    Declares a queue that honours message priorities. Queues created by
+    older versions can't be changed, so those are used as they are, without
+    priorities, until they are deleted. Returns the channel to use.
+    '''
+    try:
+        channel.queue_declare(queue=queue_name, durable=True,
+                              arguments={'x-max-priority': MAX_PRIORITY})
+    except pika.exceptions.ChannelClosed:
+        log.warning('Queue %s exists without priorities, job priorities '
+                    'will be ignored until it is deleted and recreated',
+                    queue_name)
+        # the broker closes the channel when the declaration fails
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True)
+    return channel
 
 
 def gather_callback(channel, method, header, body):
     try:
         id = json.loads(body)['harvest_job_id']
         log.debug('Received harvest job id: %s' % id)
-    except KeyError:
+    except (ValueError, TypeError, KeyError):
         log.error('No harvest job id received')
+        dead_letter('gather', body, 'No harvest job id received')
         channel.basic_ack(method.delivery_tag)
         return False
 
@@ -303,7 +2213,11 @@ def gather_callback(channel, method, header, body):
     if harvester:
         try:
             harvest_object_ids = gather_stage(harvester, job)
-        except (Exception, KeyboardInterrupt):
+        except Exception, e:
+            dead_letter('gather', body, 'Gather stage failed: %r' % e)
+            channel.basic_ack(method.delivery_tag)
+            raise
+        except KeyboardInterrupt:
             channel.basic_ack(method.delivery_tag)
             raise
 
@@ -321,10 +2235,10 @@ def gather_callback(channel, method, header, body):
 
         log.debug('Received from plugin gather_stage: {0} objects (first: {1} last: {2})'.format(
                     len(harvest_object_ids), harvest_object_ids[:1], harvest_object_ids[-1:]))
-        for id in harvest_object_ids:
-            # Send the id to the fetch queue
-            publisher.send({'harvest_object_id':id})
-        log.debug('Sent {0} objects to the fetch queue'.format(len(harvest_object_ids)))
+        # Send the ids to the fetch queue
+        sent = publisher.send_many(get_fetch_messages(harvest_object_ids),
+                                   source=job.source, priority=job.priority)
+        log.debug('Sent {0} messages to the fetch queue'.format(sent))
 
     else:
         # This can occur if you:
@@ -341,9 +2255,7 @@ def gather_callback(channel, method, header, body):
 
 
 def get_harvester(harvest_source_type):
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == harvest_source_type:
-            return harvester
+    return registry.get_harvester(harvest_source_type)
 
 
 def gather_stage(harvester, job):
@@ -357,6 +2269,10 @@ def gather_stage(harvester, job):
 
     try:
         harvest_object_ids = harvester.gather_stage(job)
+        if isinstance(harvest_object_ids, list) and \
+                fingerprint.skip_unchanged_enabled():
+            harvest_object_ids = fingerprint.skip_unchanged_objects(
+                job, harvest_object_ids)
     except (Exception, KeyboardInterrupt):
         harvest_objects = model.Session.query(HarvestObject).filter_by(
             harvest_job_id=job.id
@@ -373,57 +2289,161 @@ def gather_stage(harvester, job):
 
 def fetch_callback(channel, method, header, body):
     try:
-        id = json.loads(body)['harvest_object_id']
-        log.info('Received harvest object id: %s' % id)
-    except KeyError:
+        ids = get_harvest_object_ids(json.loads(body))
+        log.info('Received harvest object ids: %s', ', '.join(ids))
+    except (ValueError, TypeError, KeyError):
         log.error('No harvest object id received')
+        dead_letter('fetch', body, 'No harvest object id received')
         channel.basic_ack(method.delivery_tag)
         return False
 
     try:
-        obj = HarvestObject.get(id)
+        # all the objects of the message are loaded with one query
+        objs = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)).all()
     except sqlalchemy.exc.DatabaseError:
         # Occasionally we see: sqlalchemy.exc.OperationalError
         # "SSL connection has been closed unexpectedly"
         # or DatabaseError "connection timed out"
-        log.exception('Connection Error during fetch of job %s', id)
-        # By not sending the ack, it will be retried later.
-        # Try to clear the issue with a remove.
+        log.exception('Connection Error during fetch of objects %s', ids)
+        # Try to clear the issue with a remove, and try again later
         model.Session.remove()
+        _retry_later(channel, method, body, 1)
         return
-    if not obj:
-        log.error('Harvest object does not exist: %s' % id)
+    objs_by_id = dict((obj.id, obj) for obj in objs)
+    for id in ids:
+        if id not in objs_by_id:
+            log.error('Harvest object does not exist: %s' % id)
+    objs = [objs_by_id[id] for id in ids if id in objs_by_id]
+    # Messages can be delivered more than once, eg when they were published
+    # again after losing the connection to the broker, so objects that were
+    # imported already are skipped. Failed ones can be replayed.
+    for obj in objs:
+        if obj.state == 'COMPLETE':
+            log.info('Harvest object %s was already processed', obj.id)
+    objs = [obj for obj in objs if obj.state != 'COMPLETE']
+    if not objs:
         channel.basic_ack(method.delivery_tag)
         return False
 
-    obj.retry_times += 1
-    obj.save()
+    for obj in objs:
+        obj.retry_times += 1
+    model.Session.commit()
+
+    # the final states of the objects are committed together if asked to
+    state_updates = None
+    if len(objs) > 1 and batch_state_updates():
+        state_updates = []
+
+    # each object is processed on its own, so the errors of one don't
+    # affect the others
+    for obj in objs:
+        _fetch_object(obj, state_updates)
+
+    if state_updates:
+        save_state_updates(state_updates)
+    model.Session.remove()
+    channel.basic_ack(method.delivery_tag)
+
+
+def get_harvest_object_ids(message):
+    '''
+    Returns the ids of the harvest objects of a fetch message, which has
+    either a ``harvest_object_id`` or a list of ``harvest_object_ids``.
+    '''
+    if 'harvest_object_ids' in message:
+        ids = message['harvest_object_ids']
+        if not isinstance(ids, list) or not ids:
+            raise ValueError('Invalid harvest object ids: %r' % ids)
+        return ids
+    return [message['harvest_object_id']]
+
 
-    if obj.retry_times >= 5:
+def _fetch_object(obj, state_updates=None):
+    '''
+    Sends the harvest object to the fetch and import stages of its
+    harvester, retrying it later or giving up on it if they fail.
+    '''
+    id = obj.id
+    started = time.time()
+    # failed objects are retried or dead-lettered on their own, even if
+    # they came in a message with others
+    body = json.dumps({'harvest_object_id': id})
+
+    if obj.retry_times > get_retry_max_attempts():
         obj.state = "ERROR"
         obj.save()
-        log.error('Too many consecutive retries for object {0}'.format(obj.id))
-        channel.basic_ack(method.delivery_tag)
-        return False
+        log.error('Too many consecutive retries for object {0}'.format(id))
+        dead_letter('fetch', body, 'Too many consecutive retries',
+                    attempts=obj.retry_times - 1)
+        return
 
-    # Send the harvest object to the plugins that implement
-    # the Harvester interface, only if the source type
-    # matches
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == obj.source.type:
-            fetch_and_import_stages(harvester, obj)
+    # Send the harvest object to the harvester of its source type
+    attempt = obj.retry_times
+    try:
+        harvester = get_harvester(obj.source.type)
+        if harvester:
+            fetch_and_import_stages(harvester, obj, state_updates)
+            log.debug('Harvest object %s processed in %.3f seconds', id,
+                      time.time() - started)
+    except Exception, e:
+        log.exception('Error fetching or importing harvest object %s', id)
+        model.Session.rollback()
+        if is_transient_error(e) and attempt < get_retry_max_attempts():
+            _send_later(body, attempt, obj.priority)
+            obj.state = 'WAITING'
+            obj.save()
+            return
+        # not worth trying again
+        message = 'Error fetching or importing the object: %r' % e
+        dead_letter('fetch', body, message, attempts=attempt)
+        obj.state = 'ERROR'
+        obj.report_status = 'errored'
+        obj.save()
+        HarvestObjectError.create(message=message, object=obj)
 
-    model.Session.remove()
+
+def _retry_later(channel, method, body, attempt):
+    '''
+    Puts a fetch message back on the queue after a delay depending on the
+    number of attempts, and acknowledges the original one.
+    '''
+    _send_later(body, attempt)
     channel.basic_ack(method.delivery_tag)
 
-def fetch_and_import_stages(harvester, obj):
+
+def _send_later(body, attempt, priority=PRIORITY_NORMAL):
+    delay = get_retry_delay(attempt)
+    log.info('Retrying message %s in %.0f seconds', body, delay)
+    publisher = get_fetch_publisher()
+    try:
+        publisher.send_delayed(json.loads(body), delay, priority=priority)
+    finally:
+        publisher.close()
+
+def fetch_and_import_stages(harvester, obj, state_updates=None):
+    '''
+    Runs the fetch and import stages of the harvester for a harvest object,
+    recording its state and timestamps on it.
+
+    These are committed when the fetch stage starts, so objects stuck in it
+    show up as such, before the import stage, as it can roll the session
+    back (eg on validation errors), and at the end, besides any commit made
+    by the harvester. If a ``state_updates`` list is given, the final state
+    is appended to it instead, and left out of the session, to be written
+    for several objects at once with ``save_state_updates``.
+    '''
     obj.fetch_started = datetime.datetime.utcnow()
     obj.state = "FETCH"
     obj.save()
     success_fetch = harvester.fetch_stage(obj)
     obj.fetch_finished = datetime.datetime.utcnow()
-    obj.save()
-    if success_fetch is True:
+    unchanged = False
+    if success_fetch is True and fingerprint.skip_unchanged_enabled() and \
+            fingerprint.is_unchanged_after_fetch(obj):
+        obj.state = 'COMPLETE'
+        unchanged = True
+    elif success_fetch is True:
         # If no errors where found, call the import method
         obj.import_started = datetime.datetime.utcnow()
         obj.state = "IMPORT"
@@ -432,33 +2452,116 @@ def fetch_and_import_stages(harvester, obj):
         obj.import_finished = datetime.datetime.utcnow()
         if success_import:
             obj.state = "COMPLETE"
-            if success_import is 'unchanged':
-                obj.report_status = 'not modified'
-                obj.save()
-                return
+            unchanged = success_import is 'unchanged'
         else:
             obj.state = "ERROR"
-        obj.save()
     elif success_fetch == 'unchanged':
         obj.state = 'COMPLETE'
-        obj.report_status = 'not modified'
-        obj.save()
-        return
+        unchanged = True
     else:
         obj.state = "ERROR"
+
+    previous_report_status = _get_committed_value(obj, 'report_status')
+    # the final state must not be flushed by the queries below, in case it
+    # is left out of the session
+    with model.Session.no_autoflush:
+        if unchanged:
+            obj.report_status = 'not modified'
+        elif obj.state == 'ERROR':
+            obj.report_status = 'errored'
+        elif obj.current == False:
+            obj.report_status = 'deleted'
+        elif _has_previous_object(obj):
+            obj.report_status = 'updated'
+        else:
+            obj.report_status = 'added'
+
+    if state_updates is None:
         obj.save()
-    if obj.state == 'ERROR':
-        obj.report_status = 'errored'
-    elif obj.current == False:
-        obj.report_status = 'deleted'
-    elif len(model.Session.query(HarvestObject)
-           .filter_by(package_id = obj.package_id)
-           .limit(2)
-           .all()) == 2:
-        obj.report_status = 'updated'
-    else:
-        obj.report_status = 'added'
-    obj.save()
+        return
+    values = dict((column, getattr(obj, column)) for column in STATE_COLUMNS)
+    values['id'] = obj.id
+    state_updates.append(
+        (obj.harvest_job_id, previous_report_status, values))
+    # keep the later commits of the session from writing them
+    model.Session.expire(obj, STATE_COLUMNS)
+
+
+def _get_committed_value(obj, attribute):
+    added, unchanged, deleted = get_history(obj, attribute)
+    if deleted:
+        return deleted[0]
+    return unchanged[0] if unchanged else None
+
+
+def _has_previous_object(obj):
+    '''
+    Whether other harvest objects link to the dataset of this one, ie the
+    dataset existed before. Only the package_id index is used.
+    '''
+    return model.Session.query(sqlalchemy.exists().where(sqlalchemy.and_(
+        HarvestObject.package_id == obj.package_id,
+        HarvestObject.id != obj.id))).scalar()
+
+
+# harvest object columns set by fetch_and_import_stages
+STATE_COLUMNS = ('state', 'report_status', 'fetch_started', 'fetch_finished',
+                 'import_started', 'import_finished')
+TIMESTAMP_STATE_COLUMNS = ('fetch_started', 'fetch_finished',
+                           'import_started', 'import_finished')
+
+
+def batch_state_updates():
+    '''
+    Whether the final states of the harvest objects of a fetch message are
+    committed together (``ckan.harvest.mq.batch_state_updates``).
+    '''
+    return toolkit.asbool(
+        config.get('ckan.harvest.mq.batch_state_updates', False))
+
+
+def save_state_updates(state_updates):
+    '''
+    Writes the final states recorded by ``fetch_and_import_stages`` for
+    several harvest objects with a single UPDATE statement, and counts them
+    in the stats of their jobs, in a transaction of its own.
+    '''
+    if not state_updates:
+        return
+    # release any lock the session holds on the objects first
+    model.Session.commit()
+
+    columns = ('id',) + STATE_COLUMNS
+    rows, params = [], {}
+    for i, (job_id, previous, values) in enumerate(state_updates):
+        rows.append('(%s)' % ', '.join(':%s_%i' % (column, i)
+                                       for column in columns))
+        for column in columns:
+            params['%s_%i' % (column, i)] = values[column]
+    statement = sqlalchemy.text(
+        '''UPDATE harvest_object SET {updates}
+           FROM (VALUES {rows}) AS v ({columns})
+           WHERE harvest_object.id = v.id'''.format(
+            updates=', '.join(
+                '{0} = CAST(v.{0} AS timestamp)'.format(column)
+                if column in TIMESTAMP_STATE_COLUMNS
+                else '{0} = v.{0}'.format(column)
+                for column in STATE_COLUMNS),
+            rows=', '.join(rows),
+            columns=', '.join(columns)))
+
+    stats = {}
+    for job_id, previous, values in state_updates:
+        changes = stats.setdefault(job_id, {})
+        for status, amount in ((previous, -1), (values['report_status'], 1)):
+            if status in harvest_model.JOB_STATS_COLUMNS:
+                column = harvest_model.JOB_STATS_COLUMNS[status]
+                changes[column] = changes.get(column, 0) + amount
+
+    with model.meta.engine.begin() as connection:
+        connection.execute(statement, **params)
+        for job_id in sorted(stats):
+            harvest_model.update_job_stats(connection, job_id, stats[job_id])
 
 
 def get_gather_consumer():
@@ -0,0 +1,84 @@
+'''
+Index of the installed harvesters by name, so finding the harvester of a
+source is a dict lookup rather than going through all the plugins and
+calling their ``info()`` method every time.
+
+The index is built the first time it is used, once all the plugins are
+loaded and configured, and dropped whenever plugins are loaded or unloaded
+(see the ``IPluginObserver`` methods of the harvest plugin).
+'''
+import logging
+import threading
+
+from ckan.plugins import PluginImplementations
+
+from ckanext.harvest.interfaces import IHarvester
+
+log = logging.getLogger(__name__)
+
+# list of (harvester, info) tuples in plugin order, and the same by name
+_harvesters = None
+_harvesters_by_name = None
+_lock = threading.Lock()
+
+
+def _get_harvesters():
+    global _harvesters, _harvesters_by_name
+    harvesters, by_name = _harvesters, _harvesters_by_name
+    if harvesters is None:
+        with _lock:
+            if _harvesters is None:
+                _harvesters, _harvesters_by_name = _build()
+            harvesters, by_name = _harvesters, _harvesters_by_name
+    return harvesters, by_name
+
+
+def _build():
+    harvesters = []
+    by_name = {}
+    for harvester in PluginImplementations(IHarvester):
+        info = harvester.info()
+        if not info or 'name' not in info:
+            log.error('Harvester %r does not provide the harvester name in '
+                      'the info response' % str(harvester))
+            continue
+        harvesters.append((harvester, info))
+        # the first harvester with a name gets its sources
+        by_name.setdefault(info['name'], (harvester, info))
+    log.debug('Harvesters registered: %s',
+              ', '.join(info['name'] for harvester, info in harvesters))
+    return harvesters, by_name
+
+
+def reset():
+    '''Drops the index, so it is built again when next used'''
+    global _harvesters, _harvesters_by_name
+    with _lock:
+        _harvesters = _harvesters_by_name = None
+
+
+def get_harvester(name):
+    '''Returns the harvester for a source type, or None'''
+    entry = _get_harvesters()[1].get(name)
+    return entry[0] if entry else None
+
+
+def get_harvester_info(name):
+    '''Returns a copy of the ``info()`` dict of a harvester, or None'''
+    entry = _get_harvesters()[1].get(name)
+    return dict(entry[1]) if entry else None
+
+
+def get_harvesters():
+    '''Returns the installed harvesters that provide a name'''
+    return [harvester for harvester, info in _get_harvesters()[0]]
+
+
+def get_harvesters_info():
+    '''Returns copies of the ``info()`` dicts of the installed harvesters'''
+    return [dict(info) for harvester, info in _get_harvesters()[0]]
+
+
+def get_harvester_names():
+    '''Returns the source types of the installed harvesters'''
+    return [info['name'] for harvester, info in _get_harvesters()[0]]
@@ -1,6 +1,10 @@
 import json
+import datetime
 import factories
 import unittest
+import mock
+from sqlalchemy import event
+from sqlalchemy.orm import defer
 from nose.tools import assert_equal, assert_raises
 from nose.plugins.skip import SkipTest
 
@@ -26,9 +30,11 @@ except ImportError:
 from ckan import plugins as p
 from ckan.plugins import toolkit
 from ckan import model
+from ckan.lib.base import config
 
 from ckanext.harvest.interfaces import IHarvester
 import ckanext.harvest.model as harvest_model
+from ckanext.harvest.logic.dictization import harvest_source_dictize
 
 
 def call_action_api(action, apikey=None, status=200, **kwargs):
@@ -559,6 +565,327 @@ class TestHarvestObject(unittest.TestCase):
         self.assertRaises(toolkit.ValidationError, harvest_object_create,
                           context, data_dict)
 
+    def test_archive(self):
+        job = factories.HarvestJobObj()
+        old = factories.HarvestObjectObj(job=job, guid='archive',
+                                         content=u'old content',
+                                         extras={'a key': 'a value'})
+        current = factories.HarvestObjectObj(job=job, guid='archive',
+                                             content=u'new content')
+        harvest_model.HarvestObjectError.create(u'an error', old)
+        job.status = u'Finished'
+        current.current = True
+        current.save()
+        old_id, current_id = old.id, current.id
+
+        archived = harvest_model.archive_harvest_objects(
+            datetime.datetime.utcnow() + datetime.timedelta(days=1),
+            batch_size=1)
+
+        # only the object that is not current was moved
+        assert_equal(archived, 1)
+        assert not harvest_model.HarvestObject.get(old_id)
+        assert harvest_model.HarvestObject.get(current_id)
+
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        obj = toolkit.get_action('harvest_object_show')(
+            context, {'id': old_id})
+        assert_equal(obj['content'], u'old content')
+        assert_equal(obj['extras'], {'a key': 'a value'})
+        assert_equal([error['message'] for error in obj['errors']],
+                     [u'an error'])
+        assert_equal(obj['job'], job.id)
+        assert obj['archived']
+
+    def test_content_store(self):
+        job = factories.HarvestJobObj()
+        with mock.patch.dict(config, {'ckan.harvest.content_store': 'true'}):
+            objects = [factories.HarvestObjectObj(job=job, guid='stored',
+                                                  content=u'same content')
+                       for i in range(2)]
+        ids = [obj.id for obj in objects]
+        model.Session.remove()
+
+        objects = [harvest_model.HarvestObject.get(id) for id in ids]
+        assert objects[0].content_hash
+        assert_equal(objects[0].content_hash, objects[1].content_hash)
+        assert_equal(objects[0]._content, None)
+        assert_equal(objects[0].content, u'same content')
+        # stored once
+        assert_equal(model.Session.query(
+            harvest_model.harvest_object_content_table).filter_by(
+                hash=objects[0].content_hash).count(), 1)
+
+        # with the store disabled, new content goes back to harvest_object
+        objects[1].content = u'other content'
+        objects[1].save()
+        assert_equal(objects[1].content_hash, None)
+        assert_equal(objects[1].content, u'other content')
+
+        # it can still be used in queries, for the content in harvest_object
+        HarvestObject = harvest_model.HarvestObject
+        assert_equal(model.Session.query(HarvestObject.id).filter(
+            HarvestObject.content == u'other content').all(), [(ids[1],)])
+        model.Session.remove()
+        obj = model.Session.query(HarvestObject) \
+            .options(defer(HarvestObject.content)).get(ids[1])
+        assert '_content' not in obj.__dict__
+        assert_equal(obj.content, u'other content')
+
+    def test_archive_stored_content(self):
+        job = factories.HarvestJobObj()
+        with mock.patch.dict(config, {'ckan.harvest.content_store': 'true'}):
+            objects = [factories.HarvestObjectObj(job=job, guid='stored',
+                                                  content=u'content %i' % i)
+                       for i in range(3)]
+        job.status = u'Finished'
+        job.save()
+        ids = [obj.id for obj in objects]
+
+        # the contents of the batch are loaded together
+        with mock.patch.object(harvest_model, 'get_stored_content') as get:
+            archived = harvest_model.archive_harvest_objects(
+                datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        assert not get.called
+        assert_equal(archived, 3)
+
+        for i, id in enumerate(ids):
+            archive = model.Session.query(
+                harvest_model.HarvestObjectArchive).get(id)
+            assert_equal(archive.get_content(), u'content %i' % i)
+
+    def test_create_missing_index(self):
+        model.Session.remove()
+        model.meta.engine.execute('DROP INDEX harvest_object_guid_idx')
+        assert_equal([index.name for index in
+                      harvest_model.get_missing_indexes()],
+                     ['harvest_object_guid_idx'])
+
+        created = harvest_model.create_indexes_concurrently(
+            report=lambda message: None)
+
+        assert_equal(created, ['harvest_object_guid_idx'])
+        assert_equal(harvest_model.get_missing_indexes(), [])
+
+    def test_job_stats(self):
+        job = factories.HarvestJobObj()
+        objects = [factories.HarvestObjectObj(job=job) for i in range(3)]
+        for obj, status in zip(objects, ['added', 'added', 'errored']):
+            obj.report_status = status
+            obj.save()
+        # an object that was retried counts once, with its last status
+        objects[0].report_status = u'updated'
+        objects[0].save()
+        harvest_model.HarvestObjectError.create(u'an error', objects[2])
+        harvest_model.HarvestObjectError.create(u'another', objects[2])
+        harvest_model.HarvestGatherError.create(u'gather error', job)
+
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        expected = {'added': 1, 'updated': 1, 'not modified': 0,
+                    'errored': 2, 'deleted': 0}
+        job_dict = toolkit.get_action('harvest_job_show')(
+            context, {'id': job.id})
+        assert_equal(job_dict['stats'], expected)
+
+        # the backfill counts the same
+        model.Session.execute(
+            harvest_model.harvest_job_stats_table.delete())
+        model.Session.commit()
+        harvest_model.backfill_job_stats()
+        job_dict = toolkit.get_action('harvest_job_show')(
+            context, {'id': job.id})
+        assert_equal(job_dict['stats'], expected)
+
+        # jobs without stats get a row on their first change
+        model.Session.execute(
+            harvest_model.harvest_job_stats_table.delete())
+        model.Session.commit()
+        objects[1].report_status = u'deleted'
+        objects[1].save()
+        row = model.Session.query(harvest_model.HarvestJobStats) \
+            .filter_by(harvest_job_id=job.id).one()
+        assert_equal((row.added, row.deleted), (0, 1))
+
+    def test_job_stats_written_on_commit(self):
+        job = factories.HarvestJobObj()
+        obj = factories.HarvestObjectObj(job=job)
+
+        def added():
+            return model.Session.execute(
+                harvest_model.harvest_job_stats_table.select().where(
+                    harvest_model.harvest_job_stats_table.c.harvest_job_id
+                    == job.id)).first().added
+
+        # the shared row is only updated right before the commit
+        obj.report_status = u'added'
+        model.Session.flush()
+        assert_equal(added(), 0)
+        model.Session.commit()
+        assert_equal(added(), 1)
+
+        # and not at all if the transaction is rolled back
+        obj.report_status = u'updated'
+        model.Session.flush()
+        model.Session.rollback()
+        model.Session.commit()
+        assert_equal(added(), 1)
+
+    def test_job_stats_errors_flushed_together(self):
+        job = factories.HarvestJobObj()
+        obj = factories.HarvestObjectObj(job=job)
+        for message in (u'an error', u'another'):
+            model.Session.add(harvest_model.HarvestObjectError(
+                message=message, object=obj, stage=u'Import'))
+        model.Session.commit()
+        harvest_model.HarvestObjectError.create(u'a third one', obj)
+
+        stats = model.Session.query(harvest_model.HarvestJobStats) \
+            .filter_by(harvest_job_id=job.id).one()
+        assert_equal(stats.error_objects, 1)
+
+    def test_source_status_cache(self):
+        source = factories.HarvestSourceObj()
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        show_status = toolkit.get_action('harvest_source_show_status')
+        cached = lambda: harvest_model.get_cached_source_status(source.id, 60)
+
+        # only cached when asked for, not by calls that could be GET ones
+        assert_equal(show_status(context, {'id': source.id})['job_count'], 0)
+        assert_equal(cached(), (None, None))
+        context['cache_source_status'] = True
+        status = show_status(context, {'id': source.id})
+        assert_equal(cached(), (status, 0))
+
+        # new jobs drop the cached status, which isn't cached while the
+        # last job is running
+        job = factories.HarvestJobObj(source=source)
+        assert_equal(show_status(context, {'id': source.id})['job_count'], 1)
+        assert_equal(cached(), (None, 1))
+
+        job.status = u'Finished'
+        job.save()
+        status = show_status(context, {'id': source.id})
+        assert_equal(status['last_job']['status'], u'Finished')
+        assert_equal(cached(), (status, 2))
+
+        # and so do the objects the datasets are counted from
+        obj = factories.HarvestObjectObj(job=job)
+        assert_equal(cached(), (status, 2))
+        obj.current = True
+        obj.save()
+        assert_equal(cached(), (None, 3))
+
+    def test_source_status_not_cached_after_change(self):
+        source = factories.HarvestSourceObj()
+        job = factories.HarvestJobObj(source=source)
+        job.status = u'Finished'
+        job.save()
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+            'cache_source_status': True,
+        }
+        show_status = toolkit.get_action('harvest_source_show_status')
+        status = show_status(context, {'id': source.id})
+        status, version = harvest_model.get_cached_source_status(source.id, 60)
+
+        # a status computed before a change that commits before it is cached
+        factories.HarvestJobObj(source=source)
+        harvest_model.cache_source_status(source.id, status, version,
+                                          datetime.datetime.utcnow())
+        assert_equal(harvest_model.get_cached_source_status(source.id, 60),
+                     (None, version + 1))
+
+    def test_source_status_cache_stats_keys(self):
+        source = factories.HarvestSourceObj()
+        job = factories.HarvestJobObj(source=source)
+        factories.HarvestObjectObj(job=job)
+        job.status = u'Finished'
+        job.save()
+        # counted from the objects, as for jobs from before their stats were
+        # kept
+        model.Session.query(harvest_model.HarvestJobStats) \
+            .filter_by(harvest_job_id=job.id).delete()
+        model.Session.commit()
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+            'cache_source_status': True,
+        }
+        show_status = toolkit.get_action('harvest_source_show_status')
+        status = show_status(context, {'id': source.id})
+        assert_equal(status['last_job']['stats']['null'], 1)
+        assert_equal(show_status(context, {'id': source.id}), status)
+
+    def test_source_list_status(self):
+        source = factories.HarvestSourceObj()
+        other_source = factories.HarvestSourceObj()
+        job = factories.HarvestJobObj(source=source)
+        obj = factories.HarvestObjectObj(job=job)
+        harvest_model.HarvestObjectError.create(u'an error', obj)
+        harvest_model.HarvestGatherError.create(u'gather error', job)
+        job.status = u'Finished'
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        sources = dict((source_dict['id'], source_dict) for source_dict in
+                       toolkit.get_action('harvest_source_list')(context, {}))
+
+        assert_equal(sources[source.id]['status'], {
+            'job_count': 1,
+            'next_harvest': 'Not yet scheduled',
+            'last_harvest_request': str(job.gather_finished),
+            'overall_statistics': {'added': 0, 'errors': 2},
+        })
+        assert_equal(sources[other_source.id]['status']['msg'],
+                     'No jobs yet')
+        assert_equal(sources[source.id]['publisher_title'], u'')
+
+    def test_source_without_jobs_status(self):
+        source = factories.HarvestSourceObj()
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(model.meta.engine, 'before_cursor_execute',
+                     before_execute)
+        try:
+            status = harvest_source_dictize(source, context)['status']
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute',
+                         before_execute)
+
+        assert_equal(status['msg'], 'No jobs yet')
+        assert_equal(status['job_count'], 0)
+        # the jobs are counted, and there is nothing else to look for
+        assert_equal(len([statement for statement in statements
+                          if 'harvest_job' in statement]), 1)
+
           
 class TestHarvestDBLog(unittest.TestCase):
     @classmethod
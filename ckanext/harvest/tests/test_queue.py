@@ -14,6 +14,12 @@ from nose.tools import assert_equal, ok_
 from ckan.lib.base import config
 from nose.plugins.skip import SkipTest
 import uuid
+import time
+import socket
+import urllib2
+import mock
+import pika
+from sqlalchemy import event
 
 
 class MockHarvester(SingletonPlugin):
@@ -296,8 +302,768 @@ class TestHarvestQueue(object):
 
             assert_equal(redis.get('ckanext-harvest:some-random-key'),
                          'foobar')
-            assert_equal(redis.dbsize(), num_keys)
+            # The index used to deduplicate gather messages goes with the
+            # queue, while the in-flight index is left for resubmit_jobs, so
+            # there is one key less than before consuming
+            assert_equal(redis.dbsize(), num_keys - 1)
+            assert_equal(redis.exists(queue.get_queued_key(
+                queue.get_gather_routing_key())), False)
             assert_equal(redis.llen(queue.get_gather_routing_key()), 0)
             assert_equal(redis.llen(queue.get_fetch_routing_key()), 0)
         finally:
             redis.delete('ckanext-harvest:some-random-key')
+
+    def test_redis_send_many(self):
+        '''
+        Test that send_many pushes all messages, in order, across batches.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+
+        ids = [str(uuid.uuid4()) for i in range(5)]
+        publisher = queue.get_fetch_publisher()
+        with mock.patch('ckanext.harvest.queue.get_publish_batch_size',
+                        return_value=2):
+            sent = publisher.send_many(
+                {'harvest_object_id': id} for id in ids)
+
+        assert_equal(sent, 5)
+        values = redis.lrange(queue.get_fetch_routing_key(), 0, -1)
+        assert_equal([json.loads(v)['harvest_object_id'] for v in values],
+                     ids)
+        fetch_consumer.queue_purge()
+
+    def test_amqp_send_many_reconnects(self):
+        '''
+        Test that AMQP messages are published with confirmations, and that
+        only the one not confirmed is published again on a new connection
+        if the pooled one was lost.
+        '''
+        broken, working = mock.Mock(), mock.Mock()
+        broken.basic_publish.side_effect = [True,
+                                            socket.error('Connection reset')]
+        working.basic_publish.return_value = True
+        channels = [broken]
+        publisher = queue.Publisher(mock.Mock(), mock.Mock(), 'exchange',
+                                    'routing_key', pooled=True)
+        with mock.patch('ckanext.harvest.queue.reset_amqp_pool',
+                        side_effect=lambda: channels.append(working)), \
+                mock.patch('ckanext.harvest.queue.get_pooled_channel_amqp',
+                           side_effect=lambda confirm=False:
+                               (mock.Mock(), channels[-1])):
+            sent = publisher.send_many(
+                {'harvest_object_id': id} for id in 'abc')
+
+        assert_equal(sent, 3)
+        assert_equal(broken.basic_publish.call_count, 2)
+        assert_equal([json.loads(call[0][2])['harvest_object_id']
+                      for call in working.basic_publish.call_args_list],
+                     ['b', 'c'])
+
+    def test_amqp_queue_status_closes_connection(self):
+        '''
+        Test that the connection used to get the state of an AMQP queue is
+        closed, whether the queue exists or not.
+        '''
+        connection = mock.Mock()
+        declare = connection.channel.return_value.queue_declare
+        declare.return_value.method.message_count = 3
+        declare.return_value.method.consumer_count = 1
+        with mock.patch('ckanext.harvest.queue.get_connection_amqp',
+                        return_value=connection):
+            assert_equal(queue._get_queue_status_amqp('queue'),
+                         {'depth': 3, 'consumers': 1})
+            assert_equal(connection.close.call_count, 1)
+
+            declare.side_effect = pika.exceptions.ChannelClosed()
+            assert_equal(queue._get_queue_status_amqp('queue'),
+                         {'depth': 0, 'consumers': 0})
+            assert_equal(connection.close.call_count, 2)
+
+    def test_fetch_duplicate_message(self):
+        '''
+        Test that objects imported already are not processed again when
+        their message is delivered twice.
+        '''
+        from ckanext.harvest.tests.factories import HarvestObjectObj
+        obj = HarvestObjectObj()
+        obj.state = 'COMPLETE'
+        obj.save()
+        channel = mock.Mock()
+        method = mock.Mock()
+        with mock.patch('ckanext.harvest.queue.get_harvester') as harvester:
+            queue.fetch_callback(channel, method, None,
+                                 json.dumps({'harvest_object_id': obj.id}))
+        assert not harvester.called
+        channel.basic_ack.assert_called_once_with(method.delivery_tag)
+        assert_equal(HarvestObject.get(obj.id).retry_times, 0)
+
+    def test_redis_connection_pool(self):
+        '''
+        Test that Redis connections share one pool per process.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        pool = queue.get_connection().connection_pool
+        assert pool is queue.get_connection().connection_pool
+        assert pool is queue.get_fetch_publisher().redis.connection_pool
+
+        # a forked process gets its own pool
+        with mock.patch('os.getpid', return_value=-1):
+            assert queue.get_connection().connection_pool is not pool
+
+    def test_redis_resubmit_jobs(self):
+        '''
+        Test that only messages in flight for too long are resubmitted.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        inflight_key = queue.get_inflight_key(queue.get_fetch_routing_key())
+        redis.delete(inflight_key)
+
+        stale_id, recent_id = str(uuid.uuid4()), str(uuid.uuid4())
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send({'harvest_object_id': stale_id})
+        fetch_publisher.send({'harvest_object_id': recent_id})
+        consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+        next(consume)
+        next(consume)
+        assert_equal(redis.zcard(inflight_key), 2)
+        assert_equal(redis.llen(queue.get_fetch_routing_key()), 0)
+
+        # pretend the first message was taken an hour ago
+        stale_message = json.dumps({'harvest_object_id': stale_id})
+        recent_message = json.dumps({'harvest_object_id': recent_id})
+        redis.zadd(inflight_key, time.time() - 3600, stale_message)
+        queue.resubmit_jobs()
+
+        assert_equal(redis.zrange(inflight_key, 0, -1), [recent_message])
+        assert_equal(redis.lrange(queue.get_fetch_routing_key(), 0, -1),
+                     [stale_message])
+
+        fetch_consumer.basic_ack(recent_message)
+        assert_equal(redis.zcard(inflight_key), 0)
+        fetch_consumer.queue_purge()
+
+    def test_redis_fetch_batches(self):
+        '''
+        Test that messages with several harvest objects are tracked while in
+        flight, acknowledged and resubmitted unchanged.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        inflight_key = queue.get_inflight_key(routing_key)
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        redis.delete(inflight_key)
+
+        with mock.patch.dict(config,
+                             {'ckan.harvest.mq.fetch_batch_size': '2'}):
+            messages = list(queue.get_fetch_messages(['a', 'b', 'c']))
+        queue.get_fetch_publisher().send_many(messages)
+        consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+        method, header, first = next(consume)
+        method, header, second = next(consume)
+        assert_equal(json.loads(first), {'harvest_object_ids': ['a', 'b']})
+        assert_equal(redis.zcard(inflight_key), 2)
+
+        fetch_consumer.basic_ack(first)
+        assert_equal(redis.zrange(inflight_key, 0, -1), [second])
+
+        redis.zadd(inflight_key, time.time() - 3600, second)
+        queue.resubmit_jobs()
+        assert_equal(redis.lrange(routing_key, 0, -1), [second])
+        assert_equal(redis.zcard(inflight_key), 0)
+        fetch_consumer.queue_purge()
+
+    def test_redis_reliable_queue(self):
+        '''
+        Test that messages taken by a dead reliable consumer are requeued.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        with mock.patch('ckanext.harvest.queue.redis_reliable_queue',
+                        return_value=True):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            ids = [str(uuid.uuid4()) for i in range(3)]
+            fetch_publisher = queue.get_fetch_publisher()
+            for id in ids:
+                fetch_publisher.send({'harvest_object_id': id})
+
+            # messages come out in order and wait in the processing list
+            consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+            method, header, body = next(consume)
+            assert_equal(json.loads(body)['harvest_object_id'], ids[0])
+            fetch_consumer.basic_ack(body)
+            method, header, body = next(consume)
+            assert_equal(json.loads(body)['harvest_object_id'], ids[1])
+            assert_equal(redis.lrange(fetch_consumer.processing_key, 0, -1),
+                         [body])
+
+            # a live consumer keeps its messages
+            assert_equal(queue.reap_dead_consumers(redis, routing_key), 0)
+
+            # the consumer dies
+            redis.delete(queue.get_heartbeat_key(
+                routing_key, fetch_consumer.consumer_id))
+            assert_equal(queue.reap_dead_consumers(redis, routing_key), 1)
+            assert_equal(redis.llen(fetch_consumer.processing_key), 0)
+
+            other_consumer = queue.get_fetch_consumer()
+            method, header, body = other_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(json.loads(body)['harvest_object_id'], ids[1])
+            other_consumer.basic_ack(body)
+            other_consumer.queue_purge()
+            redis.delete(queue.get_consumers_key(routing_key),
+                         queue.get_heartbeat_key(
+                             routing_key, other_consumer.consumer_id))
+
+    def test_redis_gather_dedupe(self):
+        '''
+        Test that a job already waiting in the gather queue is not queued
+        again until it has been consumed.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        gather_consumer = queue.get_gather_consumer()
+        gather_consumer.queue_purge()
+        routing_key = queue.get_gather_routing_key()
+
+        job_id, other_job_id = str(uuid.uuid4()), str(uuid.uuid4())
+        gather_publisher = queue.get_gather_publisher()
+        gather_publisher.send({'harvest_job_id': job_id})
+        gather_publisher.send({'harvest_job_id': other_job_id})
+        gather_publisher.send({'harvest_job_id': job_id})
+        assert_equal(gather_publisher.send_many(
+            [{'harvest_job_id': job_id}, {'harvest_job_id': other_job_id}]), 2)
+        assert_equal(redis.llen(routing_key), 2)
+
+        method, header, body = gather_consumer.basic_get(
+            queue.get_gather_queue_name())
+        assert_equal(json.loads(body)['harvest_job_id'], job_id)
+        gather_publisher.send({'harvest_job_id': job_id})
+        assert_equal(redis.llen(routing_key), 2)
+
+        gather_consumer.queue_purge()
+        assert_equal(redis.scard(queue.get_queued_key(routing_key)), 0)
+
+    def test_redis_fair_queue(self):
+        '''
+        Test that the fetch consumers serve the sources in turn and that the
+        depth of each source queue is reported.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        with mock.patch.dict(config, {'ckan.harvest.mq.fair_queue': 'true'}):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            big_source = mock.Mock(id='big-source', config=None)
+            small_source = mock.Mock(id='small-source', config=None)
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send_many(
+                [{'harvest_object_id': 'big%s' % i} for i in range(3)],
+                source=big_source)
+            fetch_publisher.send_many(
+                [{'harvest_object_id': 'small%s' % i} for i in range(2)],
+                source=small_source)
+            assert_equal(queue.get_fetch_queue_depths(),
+                         {'big-source': 3, 'small-source': 2})
+
+            ids = []
+            for i in range(5):
+                method, header, body = fetch_consumer.basic_get(
+                    queue.get_fetch_queue_name())
+                ids.append(json.loads(body)['harvest_object_id'])
+                fetch_consumer.basic_ack(body)
+            assert_equal(ids, ['big0', 'small0', 'big1', 'small1', 'big2'])
+            assert_equal(queue.get_fetch_queue_depths(), {})
+            assert_equal(redis.llen(queue.get_sources_key(routing_key)), 0)
+            fetch_consumer.queue_purge()
+
+    def test_redis_priorities(self):
+        '''
+        Test that higher priority messages are consumed first.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send({'harvest_object_id': 'scheduled'})
+        fetch_publisher.send_many([{'harvest_object_id': 'manual'}],
+                                  priority=queue.PRIORITY_HIGH)
+
+        consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+        for id in ('manual', 'scheduled'):
+            method, header, body = next(consume)
+            assert_equal(json.loads(body)['harvest_object_id'], id)
+            fetch_consumer.basic_ack(body)
+        fetch_consumer.queue_purge()
+
+    def test_redis_priority_kept(self):
+        '''
+        Test that higher priority messages go back to their list when they
+        are resubmitted or retried.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        high_key = queue.get_priority_key(routing_key, queue.PRIORITY_HIGH)
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send({'harvest_object_id': 'manual'},
+                             priority=queue.PRIORITY_HIGH)
+
+        method, header, body = fetch_consumer.basic_get(
+            queue.get_fetch_queue_name())
+        redis.zadd(queue.get_inflight_key(routing_key), time.time() - 3600,
+                   body)
+        queue.resubmit_jobs()
+        assert_equal(redis.lrange(high_key, 0, -1), [body])
+        assert_equal(redis.llen(routing_key), 0)
+
+        fetch_consumer.queue_purge()
+        fetch_publisher.send({'harvest_object_id': 'scheduled'})
+        fetch_publisher.send_delayed({'harvest_object_id': 'retried'}, 0,
+                                     priority=queue.PRIORITY_HIGH)
+        assert_equal(queue.promote_due_messages(redis, routing_key), 1)
+        method, header, body = fetch_consumer.basic_get(
+            queue.get_fetch_queue_name())
+        assert_equal(json.loads(body)['harvest_object_id'], 'retried')
+        fetch_consumer.basic_ack(body)
+        fetch_consumer.queue_purge()
+
+    def test_redis_reliable_requeue_order(self):
+        '''
+        Test that in reliable mode delayed retries go behind the waiting
+        messages, and that consumers are woken up for any priority.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        tokens_key = queue.get_tokens_key(routing_key)
+        with mock.patch('ckanext.harvest.queue.redis_reliable_queue',
+                        return_value=True):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send_many([{'harvest_object_id': 'a'},
+                                       {'harvest_object_id': 'b'}])
+            fetch_publisher.send_delayed({'harvest_object_id': 'retried'}, 0)
+            assert_equal(queue.promote_due_messages(redis, routing_key), 1)
+            fetch_publisher.send({'harvest_object_id': 'urgent'},
+                                 priority=queue.PRIORITY_HIGH)
+            assert_equal(redis.llen(tokens_key), 4)
+
+            consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+            ids = []
+            for i in range(4):
+                method, header, body = next(consume)
+                ids.append(json.loads(body)['harvest_object_id'])
+                fetch_consumer.basic_ack(body)
+            assert_equal(ids, ['urgent', 'a', 'b', 'retried'])
+            fetch_consumer.queue_purge()
+            redis.delete(queue.get_consumers_key(routing_key),
+                         queue.get_heartbeat_key(
+                             routing_key, fetch_consumer.consumer_id))
+
+    def test_redis_delayed_retry(self):
+        '''
+        Test that delayed messages are only consumed once they are due.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_delayed({'harvest_object_id': 'later'}, 60)
+        fetch_publisher.send_delayed({'harvest_object_id': 'now'}, 0)
+
+        method, header, body = fetch_consumer.basic_get(
+            queue.get_fetch_queue_name())
+        assert_equal(json.loads(body)['harvest_object_id'], 'now')
+        fetch_consumer.basic_ack(body)
+        assert_equal(redis.zcard(queue.get_delayed_key(routing_key)), 1)
+        assert_equal(queue.promote_due_messages(redis, routing_key), 0)
+        fetch_consumer.queue_purge()
+        assert_equal(redis.exists(queue.get_delayed_key(routing_key)), False)
+
+    def test_retry_delay(self):
+        with mock.patch.dict(config, {'ckan.harvest.mq.retry_jitter': '0'}):
+            assert_equal(queue.get_retry_delay(1), queue.RETRY_DELAY)
+            assert_equal(queue.get_retry_delay(3), queue.RETRY_DELAY * 4)
+            assert_equal(queue.get_retry_delay(20), queue.RETRY_MAX_DELAY)
+        for i in range(10):
+            delay = queue.get_retry_delay(2)
+            ok_(queue.RETRY_DELAY <= delay <= queue.RETRY_DELAY * 2)
+
+    def test_is_transient_error(self):
+        ok_(queue.is_transient_error(socket.timeout()))
+        ok_(queue.is_transient_error(
+            urllib2.HTTPError('http://x', 503, 'Unavailable', {}, None)))
+        ok_(not queue.is_transient_error(
+            urllib2.HTTPError('http://x', 404, 'Not found', {}, None)))
+        ok_(not queue.is_transient_error(ValueError('bad content')))
+
+    def test_redis_dead_letters(self):
+        '''
+        Test that messages that can't be processed are kept aside and can be
+        replayed.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        queue.purge_dead_letters('fetch')
+
+        channel = mock.Mock()
+        queue.fetch_callback(channel, mock.Mock(), None, 'not json')
+        queue.dead_letter('fetch', '{"harvest_object_id": "abc"}', 'Failed',
+                          attempts=5)
+        entries = queue.list_dead_letters('fetch')
+        assert_equal([entry['body'] for entry in entries],
+                     ['not json', '{"harvest_object_id": "abc"}'])
+        assert_equal(entries[1]['attempts'], 5)
+        assert_equal(len(queue.list_dead_letters('fetch', limit=1)), 1)
+
+        # the invalid message stays in the dead letter queue
+        assert_equal(queue.replay_dead_letters('fetch'), 1)
+        assert_equal(redis.lrange(routing_key, 0, -1),
+                     [json.dumps({'harvest_object_id': 'abc'})])
+        assert_equal(queue.purge_dead_letters('fetch'), 1)
+        assert_equal(queue.list_dead_letters('fetch'), [])
+        fetch_consumer.queue_purge()
+
+    def test_redis_malformed_messages(self):
+        '''
+        Test that messages that can't be parsed are taken from the queue and
+        dead-lettered without stopping the consumer.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest()
+        redis = queue.get_connection()
+        routing_key = queue.get_fetch_routing_key()
+        inflight_key = queue.get_inflight_key(routing_key)
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+        redis.delete(inflight_key)
+        queue.purge_dead_letters('fetch')
+
+        bodies = ['not json', '{"harvest_object_id": null}', '[]']
+        redis.rpush(routing_key, *bodies)
+        queue.get_fetch_publisher().send({'harvest_object_id': 'abc'})
+        consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+        for i in range(len(bodies)):
+            method, header, body = next(consume)
+            assert_equal(queue.fetch_callback(fetch_consumer, method, header,
+                                              body), False)
+        method, header, body = next(consume)
+        assert_equal(json.loads(body), {'harvest_object_id': 'abc'})
+        fetch_consumer.basic_ack(method.delivery_tag)
+
+        assert_equal([entry['body']
+                      for entry in queue.list_dead_letters('fetch')],
+                     bodies)
+        assert_equal(redis.zcard(inflight_key), 0)
+        queue.purge_dead_letters('fetch')
+        fetch_consumer.queue_purge()
+
+    def test_postgres_queue(self):
+        '''
+        Test that the PostgreSQL backend delivers messages by priority, each
+        one to a single consumer, and releases stale claims.
+        '''
+        with mock.patch.dict(config, {'ckan.harvest.mq.type': 'postgres'}):
+            routing_key = queue.get_fetch_routing_key()
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            fetch_publisher = queue.get_fetch_publisher()
+            assert_equal(fetch_publisher.send_many(
+                [{'harvest_object_id': 'a'}, {'harvest_object_id': 'b'}]), 2)
+            fetch_publisher.send({'harvest_object_id': 'urgent'},
+                                 priority=queue.PRIORITY_HIGH)
+            fetch_publisher.send_delayed({'harvest_object_id': 'later'}, 60)
+
+            consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+            ids = []
+            for i in range(3):
+                method, header, body = next(consume)
+                ids.append(json.loads(body)['harvest_object_id'])
+                fetch_consumer.basic_ack(method.delivery_tag)
+            assert_equal(ids, ['urgent', 'a', 'b'])
+
+            # claimed messages are not given to other consumers
+            fetch_publisher.send({'harvest_object_id': 'c'})
+            other_consumer = queue.get_fetch_consumer()
+            method, header, body = other_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(json.loads(body)['harvest_object_id'], 'c')
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(body, None)
+
+            # until their consumer is presumed dead
+            engine = queue.get_connection()
+            assert_equal(queue.release_stale_claims(engine, routing_key, 60), 0)
+            assert_equal(queue.release_stale_claims(engine, routing_key, -1), 1)
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(json.loads(body)['harvest_object_id'], 'c')
+
+            assert_equal(fetch_consumer.queue_purge(), 2)
+
+    def test_postgres_acks_deleted_together(self):
+        '''
+        Test that the PostgreSQL backend deletes acknowledged messages with
+        one statement, before claiming more or when closed.
+        '''
+        with mock.patch.dict(config, {'ckan.harvest.mq.type': 'postgres'}):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send_many(
+                [{'harvest_object_id': id} for id in 'abc'])
+            deletes = []
+
+            def count_deletes(conn, cursor, statement, parameters, context,
+                              many):
+                if statement.lstrip().startswith('DELETE FROM harvest_queue'):
+                    deletes.append(statement)
+            event.listen(model.meta.engine, 'before_cursor_execute',
+                         count_deletes)
+            try:
+                consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+                for i in range(3):
+                    method, header, body = next(consume)
+                    fetch_consumer.basic_ack(method.delivery_tag)
+                assert_equal(fetch_consumer.queue_status()['in_flight'], 3)
+                fetch_consumer.close()
+            finally:
+                event.remove(model.meta.engine, 'before_cursor_execute',
+                             count_deletes)
+            assert_equal(len(deletes), 1)
+            assert_equal(fetch_consumer.queue_status()['in_flight'], 0)
+
+    def test_local_queue(self):
+        '''
+        Test that the local backend delivers messages by priority, delays
+        messages and puts back the ones not acknowledged.
+        '''
+        with mock.patch.dict(config, {'ckan.harvest.mq.type': 'local',
+                                      'ckan.harvest.mq.local_workers': '0'}):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            fetch_publisher = queue.get_fetch_publisher()
+            assert_equal(fetch_publisher.send_many(
+                [{'harvest_object_id': 'a'}, {'harvest_object_id': 'b'}]), 2)
+            fetch_publisher.send({'harvest_object_id': 'urgent'},
+                                 priority=queue.PRIORITY_HIGH)
+            fetch_publisher.send_delayed({'harvest_object_id': 'later'}, 60)
+
+            consume = fetch_consumer.consume(queue.get_fetch_queue_name())
+            ids = []
+            for i in range(3):
+                method, header, body = next(consume)
+                ids.append(json.loads(body)['harvest_object_id'])
+                fetch_consumer.basic_ack(method.delivery_tag)
+            assert_equal(ids, ['urgent', 'a', 'b'])
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(body, None)
+
+            # unacknowledged messages are pending until put back
+            fetch_publisher.send({'harvest_object_id': 'c'})
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert not queue.join_local_queues(timeout=0)
+            fetch_consumer.requeue_unacked(method.delivery_tag)
+            local_queue = queue.get_local_queue(queue.get_fetch_routing_key())
+            assert_equal(local_queue.pending(), 2)
+
+            assert_equal(fetch_consumer.queue_purge(), 2)
+            assert queue.join_local_queues(timeout=0)
+
+    def test_local_delayed_priority(self):
+        '''
+        Test that delayed and requeued messages of the local backend keep
+        their priority.
+        '''
+        with mock.patch.dict(config, {'ckan.harvest.mq.type': 'local',
+                                      'ckan.harvest.mq.local_workers': '0'}):
+            fetch_consumer = queue.get_fetch_consumer()
+            fetch_consumer.queue_purge()
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send({'harvest_object_id': 'a'})
+            fetch_publisher.send_delayed({'harvest_object_id': 'retried'}, 0,
+                                         priority=queue.PRIORITY_HIGH)
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            assert_equal(json.loads(body)['harvest_object_id'], 'retried')
+
+            local_queue = queue.get_local_queue(queue.get_fetch_routing_key())
+            local_queue.requeue(method.delivery_tag, 0)
+            tag, body = local_queue.get(timeout=0)
+            assert_equal(json.loads(body)['harvest_object_id'], 'retried')
+            local_queue.ack(tag)
+            fetch_consumer.queue_purge()
+
+    def test_fetch_batches(self):
+        '''
+        Test that harvest objects are sent in chunks when configured, and
+        that a chunk is acknowledged once.
+        '''
+        ids = ['a', 'b', 'c']
+        assert_equal(list(queue.get_fetch_messages(ids)),
+                     [{'harvest_object_id': id} for id in ids])
+        with mock.patch.dict(config,
+                             {'ckan.harvest.mq.fetch_batch_size': '2'}):
+            messages = list(queue.get_fetch_messages(ids))
+        assert_equal(messages, [{'harvest_object_ids': ['a', 'b']},
+                                {'harvest_object_ids': ['c']}])
+        assert_equal(queue.get_harvest_object_ids(messages[0]), ['a', 'b'])
+        assert_equal(queue.get_harvest_object_ids({'harvest_object_id': 'a'}),
+                     ['a'])
+
+        channel = mock.Mock()
+        method = mock.Mock()
+        queue.fetch_callback(channel, method, None,
+                             json.dumps({'harvest_object_ids': ['x', 'y']}))
+        channel.basic_ack.assert_called_once_with(method.delivery_tag)
+
+    def test_queue_status(self):
+        '''
+        Test that the state of the queues is reported.
+        '''
+        with mock.patch.dict(config, {'ckan.harvest.mq.type': 'local',
+                                      'ckan.harvest.mq.local_workers': '0'}):
+            queue.purge_queues()
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send_many(
+                [{'harvest_object_id': 'a'}, {'harvest_object_id': 'b'}])
+            fetch_publisher.send_delayed({'harvest_object_id': 'c'}, 60)
+            fetch_consumer = queue.get_fetch_consumer()
+            method, header, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+
+            status = queue.get_queue_status()
+            assert_equal(status['gather']['depth'], 0)
+            assert_equal(status['fetch']['depth'], 1)
+            assert_equal(status['fetch']['in_flight'], 1)
+            assert_equal(status['fetch']['delayed'], 1)
+            assert 'sources' in status['fetch']
+
+            fetch_consumer.basic_ack(method.delivery_tag)
+            queue.purge_queues()
+
+    def test_harvester_registry(self):
+        '''
+        Test that harvesters are found by name and their info can't be
+        changed by callers.
+        '''
+        from ckanext.harvest import registry
+        registry.reset()
+        harvester = registry.get_harvester('test')
+        assert isinstance(harvester, MockHarvester)
+        assert_equal(queue.get_harvester('test'), harvester)
+        assert_equal(registry.get_harvester('unknown'), None)
+        assert 'test' in registry.get_harvester_names()
+
+        info = registry.get_harvester_info('test')
+        info['title'] = 'changed'
+        assert_equal(registry.get_harvester_info('test')['title'], 'test')
+
+    def test_state_updates(self):
+        '''
+        Test that the final states of harvest objects are written together
+        with one statement, and not by the commits made meanwhile.
+        '''
+        from ckanext.harvest.tests.factories import (HarvestJobObj,
+                                                     HarvestObjectObj)
+        harvester = mock.Mock()
+        harvester.fetch_stage.return_value = 'unchanged'
+        job = HarvestJobObj()
+        objs = [HarvestObjectObj(job=job, guid='state_updates_%i' % i)
+                for i in range(3)]
+        state_updates = []
+        for obj in objs:
+            queue.fetch_and_import_stages(harvester, obj, state_updates)
+        assert_equal(len(state_updates), 3)
+        # the fetch stage of each object was committed, not the final state
+        model.Session.remove()
+        assert_equal([HarvestObject.get(obj.id).state for obj in objs],
+                     ['FETCH'] * 3)
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().startswith('UPDATE harvest_object '):
+                statements.append(statement)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', count)
+        try:
+            queue.save_state_updates(state_updates)
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count)
+        assert_equal(len(statements), 1)
+
+        model.Session.remove()
+        for obj in objs:
+            obj = HarvestObject.get(obj.id)
+            assert_equal(obj.state, 'COMPLETE')
+            assert_equal(obj.report_status, 'not modified')
+            assert obj.fetch_finished
+        stats = model.Session.query(harvest_model.HarvestJobStats) \
+            .filter_by(harvest_job_id=job.id).one()
+        assert_equal(stats.not_modified, 3)
+
+    def test_skip_unchanged(self):
+        '''
+        Test that harvest objects with the same normalized content as the
+        current object for their guid are not fetched.
+        '''
+        from ckanext.harvest import fingerprint
+        from ckanext.harvest.tests.factories import HarvestObjectObj
+        package = model.Package(name=u'skip-unchanged', state=u'active')
+        package.save()
+        previous = HarvestObjectObj(guid='skip_unchanged',
+                                    content='{"a": 1, "b": [1, 2]}')
+        previous.fingerprint = fingerprint.get_fingerprint(previous)
+        previous.package_id = package.id
+        previous.current = True
+        previous.save()
+
+        job = previous.job
+        same = HarvestObjectObj(job=job, guid='skip_unchanged',
+                                content='{"b": [1, 2],\n "a": 1}')
+        changed = HarvestObjectObj(job=job, guid='skip_unchanged',
+                                   content='{"a": 2, "b": [1, 2]}')
+        ids = fingerprint.skip_unchanged_objects(job, [same.id, changed.id])
+        assert_equal(ids, [changed.id])
+
+        same = HarvestObject.get(same.id)
+        assert_equal(same.state, 'COMPLETE')
+        assert_equal(same.report_status, 'not modified')
+        assert_equal(same.fingerprint, previous.fingerprint)
+        assert HarvestObject.get(changed.id).fingerprint
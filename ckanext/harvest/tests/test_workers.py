@@ -0,0 +1,316 @@
+import time
+import signal
+import threading
+import multiprocessing
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.harvest import workers
+from ckanext.harvest.queue import FakeMethod
+
+
+class FakeConsumer(object):
+    '''Hands out the given message bodies, and the ones put later'''
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+        self.condition = threading.Condition()
+
+    def put(self, body):
+        with self.condition:
+            self.bodies.append(body)
+            self.condition.notify_all()
+
+    def basic_get(self, queue, timeout=0):
+        with self.condition:
+            if not self.bodies and timeout:
+                self.condition.wait(timeout)
+            body = self.bodies.pop(0) if self.bodies else None
+        return (FakeMethod(body), self, body)
+
+    def close(self):
+        pass
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+def _exiting_worker(concurrency):
+    '''A worker process that dies straight away'''
+
+
+class TestFetchWorkers(object):
+
+    def setup(self):
+        self.consumer = FakeConsumer([])
+        self.callback = mock.Mock()
+        self.patches = [
+            mock.patch('ckanext.harvest.workers.SUPERVISE_INTERVAL', 0.01),
+            mock.patch('ckanext.harvest.workers.get_fetch_consumer',
+                       return_value=self.consumer),
+            mock.patch('ckanext.harvest.workers.fetch_callback',
+                       self.callback),
+            # handlers can only be set from the main thread
+            mock.patch('signal.signal'),
+            mock.patch('signal.siginterrupt'),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _start(self, fetch_workers):
+        thread = threading.Thread(target=fetch_workers.run)
+        thread.daemon = True
+        thread.start()
+        wait_until(lambda: fetch_workers.workers)
+        return thread
+
+    def test_restart_dead_threads(self):
+        '''
+        Test that worker threads that die are replaced.
+        '''
+        calls = []
+
+        def consume(state):
+            calls.append(state)
+            if len(calls) == 1:
+                raise Exception('Worker died')
+            while not state.stop:
+                time.sleep(0.01)
+
+        with mock.patch('ckanext.harvest.workers.consume_fetch_queue',
+                        side_effect=consume):
+            fetch_workers = workers.FetchWorkers(1, use_threads=True)
+            thread = self._start(fetch_workers)
+            # the new thread may start before it is in the list
+            wait_until(lambda: len(calls) == 2 and
+                       fetch_workers.workers[0][0].is_alive())
+            assert isinstance(fetch_workers.workers[0][0], threading.Thread)
+
+            fetch_workers._request_stop(signal.SIGTERM, None)
+            thread.join(5)
+            assert not thread.is_alive()
+
+    def test_restart_dead_processes(self):
+        '''
+        Test that worker processes that die are replaced.
+        '''
+        with mock.patch('ckanext.harvest.workers._process_worker',
+                        _exiting_worker):
+            fetch_workers = workers.FetchWorkers(1)
+            thread = self._start(fetch_workers)
+            first = fetch_workers.workers[0][0]
+            assert isinstance(first, multiprocessing.Process)
+            wait_until(lambda: fetch_workers.workers[0][0] is not first)
+
+            fetch_workers._request_stop(signal.SIGTERM, None)
+            thread.join(5)
+            assert not thread.is_alive()
+            assert not fetch_workers.workers[0][0].is_alive()
+
+    def test_finish_message_on_stop(self):
+        '''
+        Test that on SIGTERM a worker finishes the message it is processing
+        and takes no more.
+        '''
+        started, release = threading.Event(), threading.Event()
+        processed = []
+
+        def callback(channel, method, header, body):
+            started.set()
+            release.wait(5)
+            processed.append(body)
+
+        self.callback.side_effect = callback
+        self.consumer.bodies = ['a', 'b']
+        fetch_workers = workers.FetchWorkers(1, use_threads=True)
+        thread = self._start(fetch_workers)
+        assert started.wait(5)
+        fetch_workers._request_stop(signal.SIGTERM, None)
+        state = fetch_workers.workers[0][1]
+        wait_until(lambda: state.stop)
+        # the worker is waited for
+        assert thread.is_alive()
+        release.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert_equal(processed, ['a'])
+        assert_equal(self.consumer.bodies, ['b'])
+
+    def test_stop_idle_threads(self):
+        '''
+        Test that idle worker threads waiting for a message exit on SIGTERM.
+        '''
+        fetch_workers = workers.FetchWorkers(2, use_threads=True)
+        thread = self._start(fetch_workers)
+        fetch_workers._request_stop(signal.SIGTERM, None)
+        thread.join(5)
+
+        assert not thread.is_alive()
+        for worker, state in fetch_workers.workers:
+            assert not worker.is_alive()
+
+    def test_process_worker_finishes_message_on_stop(self):
+        '''
+        Test that a worker process stopped while processing a message
+        finishes it and takes no more.
+        '''
+        started, release = threading.Event(), threading.Event()
+        processed = []
+
+        def callback(channel, method, header, body):
+            started.set()
+            release.wait(5)
+            processed.append(body)
+
+        self.callback.side_effect = callback
+        self.consumer.bodies = ['a', 'b']
+        thread = threading.Thread(target=workers._process_worker)
+        thread.daemon = True
+        thread.start()
+        assert started.wait(5)
+        stop = signal.signal.call_args[0][1]
+        stop(signal.SIGTERM, None)
+        release.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert_equal(processed, ['a'])
+        assert_equal(self.consumer.bodies, ['b'])
+
+    def test_process_worker_stops_while_idle(self):
+        '''
+        Test that a worker process waiting for a message exits on SIGTERM.
+        '''
+        thread = threading.Thread(target=workers._process_worker)
+        thread.daemon = True
+        thread.start()
+        wait_until(lambda: signal.signal.called)
+        stop = signal.signal.call_args[0][1]
+        stop(signal.SIGTERM, None)
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert not self.callback.called
+
+
+class TestConcurrentFetchConsumer(object):
+
+    def setup(self):
+        self.consumer = FakeConsumer([])
+        self.callback = mock.Mock()
+        self.patches = [
+            mock.patch('ckanext.harvest.workers.SUPERVISE_INTERVAL', 0.01),
+            mock.patch('ckanext.harvest.workers.get_fetch_consumer',
+                       return_value=self.consumer),
+            mock.patch('ckanext.harvest.workers.fetch_callback',
+                       self.callback),
+            # handlers can only be set from the main thread
+            mock.patch('signal.signal'),
+            mock.patch('signal.siginterrupt'),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _start(self, fetch_consumer, bodies):
+        self.consumer.bodies = list(bodies)
+        thread = threading.Thread(target=fetch_consumer.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_max_in_flight(self):
+        '''
+        Test that no more than ``max_in_flight`` messages are taken at a
+        time.
+        '''
+        release = threading.Event()
+        processed = []
+
+        def callback(channel, method, header, body):
+            release.wait(5)
+            processed.append(body)
+
+        self.callback.side_effect = callback
+        fetch_consumer = workers.ConcurrentFetchConsumer(2)
+        thread = self._start(fetch_consumer, ['a', 'b', 'c', 'd'])
+        wait_until(lambda: fetch_consumer.in_flight == 2)
+        time.sleep(0.1)
+        assert_equal(self.consumer.bodies, ['c', 'd'])
+
+        release.set()
+        wait_until(lambda: len(processed) == 4)
+        fetch_consumer._request_stop(signal.SIGTERM, None)
+        thread.join(5)
+        assert not thread.is_alive()
+        assert_equal(sorted(processed), ['a', 'b', 'c', 'd'])
+
+    def test_stop_while_processing(self):
+        '''
+        Test that on SIGTERM the consumer takes no more messages and returns
+        once the ones in flight are processed.
+        '''
+        started, release = threading.Event(), threading.Event()
+        processed = []
+
+        def callback(channel, method, header, body):
+            started.set()
+            release.wait(5)
+            processed.append(body)
+
+        self.callback.side_effect = callback
+        fetch_consumer = workers.ConcurrentFetchConsumer(1)
+        thread = self._start(fetch_consumer, ['a', 'b', 'c'])
+        assert started.wait(5)
+        fetch_consumer._request_stop(signal.SIGTERM, None)
+        release.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert_equal(processed, ['a'])
+        assert_equal(self.consumer.bodies, ['b', 'c'])
+
+    def test_wakes_up_on_message(self):
+        '''
+        Test that an idle consumer takes a new message as soon as it is
+        published rather than on its next check.
+        '''
+        processed = []
+        self.callback.side_effect = \
+            lambda channel, method, header, body: processed.append(body)
+        fetch_consumer = workers.ConcurrentFetchConsumer(1)
+        with mock.patch('ckanext.harvest.workers.SUPERVISE_INTERVAL', 30):
+            thread = self._start(fetch_consumer, [])
+            time.sleep(0.1)
+            self.consumer.put('a')
+            wait_until(lambda: processed == ['a'])
+
+            # a message taken while the stop was requested is processed
+            fetch_consumer._request_stop(signal.SIGTERM, None)
+            self.consumer.put('b')
+            thread.join(5)
+        assert not thread.is_alive()
+        assert_equal(processed, ['a', 'b'])
+
+    def test_stop_while_idle(self):
+        '''
+        Test that the consumer stops straight away when there are no
+        messages to wait for.
+        '''
+        fetch_consumer = workers.ConcurrentFetchConsumer(2)
+        thread = self._start(fetch_consumer, [])
+        fetch_consumer._request_stop(signal.SIGTERM, None)
+        thread.join(5)
+        assert not thread.is_alive()
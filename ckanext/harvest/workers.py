@@ -0,0 +1,313 @@
+'''
+Supervisor for running several fetch consumers from one command.
+
+Workers are either processes (the default, each one with its own database
+and queue connections) or threads (cheaper, suitable for harvesters that
+spend most of their time waiting on remote servers). Workers that die are
+restarted, and on SIGTERM/SIGINT each worker finishes the message it is
+processing before exiting.
+
+A single consumer can also process several messages at a time by handing
+them to a pool of threads, up to a limit of messages in flight.
+
+It also runs the threads that process the queues of the ``local`` backend
+in the process that publishes to them.
+'''
+import time
+import Queue
+import signal
+import logging
+import threading
+import multiprocessing
+
+from ckan import model
+from ckan.lib.base import config
+
+from ckanext.harvest.queue import (get_fetch_consumer, fetch_callback,
+                                   get_fetch_queue_name, get_gather_consumer,
+                                   gather_callback, get_gather_queue_name,
+                                   get_local_workers, get_message, MQ_TYPE)
+
+log = logging.getLogger(__name__)
+
+# seconds between checks on the workers, which is also the longest a worker
+# waits for a message before checking whether it should stop
+SUPERVISE_INTERVAL = 1
+
+
+class _WorkerState(object):
+    '''Flag shared between a worker and whoever asks it to stop'''
+    def __init__(self):
+        self.stop = False
+
+
+def _handle_stop_signals(handler):
+    '''
+    Calls ``handler`` on SIGTERM and SIGINT. System calls they interrupt are
+    restarted rather than failed, so a message already sent by the queue
+    while the consumer was waiting for it is not lost.
+    '''
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
+        signal.siginterrupt(signum, False)
+
+
+def consume_fetch_queue(state):
+    '''
+    Runs a fetch consumer until ``state.stop`` is set, which is checked
+    between messages and at least every ``SUPERVISE_INTERVAL`` seconds while
+    waiting for one.
+    '''
+    consumer = get_fetch_consumer()
+    queue = get_fetch_queue_name()
+    try:
+        while not state.stop:
+            method, header, body = get_message(consumer, queue,
+                                               SUPERVISE_INTERVAL)
+            if body is not None:
+                fetch_callback(consumer, method, header, body)
+    finally:
+        consumer.close()
+
+
+def _process_worker(concurrency=1):
+    if concurrency > 1:
+        run_concurrent_fetch_consumer(concurrency)
+        return
+    state = _WorkerState()
+
+    def stop(signum, frame):
+        # leave once the current message, if any, is processed
+        state.stop = True
+
+    _handle_stop_signals(stop)
+    consume_fetch_queue(state)
+
+
+def _thread_worker(state):
+    try:
+        consume_fetch_queue(state)
+    finally:
+        model.Session.remove()
+
+
+class FetchWorkers(object):
+    '''
+    Starts ``num_workers`` fetch consumers and keeps them running until the
+    process receives SIGTERM or SIGINT.
+
+    :param num_workers: number of consumers to run
+    :type num_workers: int
+    :param use_threads: run the consumers as threads of this process rather
+        than as child processes
+    :type use_threads: bool
+    :param concurrency: number of messages each worker process handles at a
+        time, see :py:class:`ConcurrentFetchConsumer`
+    :type concurrency: int
+    '''
+
+    def __init__(self, num_workers, use_threads=False, concurrency=1):
+        self.num_workers = num_workers
+        self.use_threads = use_threads
+        self.concurrency = concurrency
+        self.workers = []
+        self.stopping = False
+
+    def run(self):
+        _handle_stop_signals(self._request_stop)
+
+        log.info('Starting %i fetch %s', self.num_workers,
+                 'threads' if self.use_threads else 'processes')
+        self.workers = [self._start_worker() for i in range(self.num_workers)]
+
+        while not self.stopping:
+            for i, worker in enumerate(self.workers):
+                if not self._is_alive(worker):
+                    log.error('Fetch worker %s died, restarting it',
+                              self._describe(worker))
+                    self.workers[i] = self._start_worker()
+            time.sleep(SUPERVISE_INTERVAL)
+
+        self._shutdown()
+
+    def _request_stop(self, signum, frame):
+        log.info('Received signal %s, stopping fetch workers', signum)
+        self.stopping = True
+
+    def _start_worker(self):
+        if self.use_threads:
+            state = _WorkerState()
+            thread = threading.Thread(target=_thread_worker, args=(state,))
+            thread.start()
+            return (thread, state)
+
+        # Don't let the child inherit the parent's database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+        process = multiprocessing.Process(target=_process_worker,
+                                          args=(self.concurrency,))
+        process.start()
+        return (process, None)
+
+    def _is_alive(self, worker):
+        return worker[0].is_alive()
+
+    def _describe(self, worker):
+        if self.use_threads:
+            return worker[0].name
+        return '%s (exit code %s)' % (worker[0].pid, worker[0].exitcode)
+
+    def _shutdown(self):
+        if self.use_threads:
+            for thread, state in self.workers:
+                state.stop = True
+            for thread, state in self.workers:
+                thread.join()
+        else:
+            for process, state in self.workers:
+                if process.is_alive():
+                    process.terminate()
+            for process, state in self.workers:
+                process.join()
+        log.info('Fetch workers stopped')
+
+
+def run_concurrent_fetch_consumer(max_in_flight):
+    '''
+    Processes up to ``max_in_flight`` fetch messages at a time in this
+    process until it receives SIGTERM or SIGINT.
+
+    AMQP channels can't be shared between threads, so with RabbitMQ this
+    runs as many threaded consumers instead, which has the same effect as
+    each one takes a single message at a time.
+    '''
+    if config.get('ckan.harvest.mq.type', MQ_TYPE) in ('amqp', 'ampq'):
+        FetchWorkers(max_in_flight, use_threads=True).run()
+    else:
+        ConcurrentFetchConsumer(max_in_flight).run()
+
+
+class ConcurrentFetchConsumer(object):
+    '''
+    Takes messages from a single fetch consumer and processes them in a pool
+    of ``max_in_flight`` threads, taking a new message only when a thread is
+    free. This suits harvesters that spend most of their time waiting on
+    remote servers or the database, without the cost of a process or queue
+    connection per message in flight.
+
+    On SIGTERM or SIGINT it stops taking messages and returns once the ones
+    in flight are processed.
+
+    :param max_in_flight: maximum number of messages processed at a time
+    :type max_in_flight: int
+    '''
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.tasks = Queue.Queue()
+        self.stopping = False
+
+    def run(self):
+        _handle_stop_signals(self._request_stop)
+
+        consumer = get_fetch_consumer()
+        for i in range(self.max_in_flight):
+            thread = threading.Thread(target=self._work, args=(consumer,))
+            # idle threads wait for a task, and the busy ones are waited for
+            # below
+            thread.daemon = True
+            thread.start()
+        log.info('Processing up to %i fetch messages at a time',
+                 self.max_in_flight)
+
+        # Messages are waited for with a timeout rather than consumed, so a
+        # stop request isn't left waiting for the next message, which would
+        # then be taken and not processed
+        queue = get_fetch_queue_name()
+        while self._wait_for_thread():
+            method, header, body = get_message(consumer, queue,
+                                               SUPERVISE_INTERVAL)
+            if body is None:
+                continue
+            with self.condition:
+                self.in_flight += 1
+            self.tasks.put((method, header, body))
+
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait(SUPERVISE_INTERVAL)
+        log.info('Fetch consumer stopped')
+
+    def _request_stop(self, signum, frame):
+        log.info('Received signal %s, stopping fetch consumer', signum)
+        self.stopping = True
+
+    def _wait_for_thread(self):
+        '''
+        Blocks until a thread is free. Returns False if the consumer is
+        stopping instead.
+        '''
+        with self.condition:
+            while self.in_flight >= self.max_in_flight and not self.stopping:
+                self.condition.wait(SUPERVISE_INTERVAL)
+        return not self.stopping
+
+    def _work(self, consumer):
+        while True:
+            method, header, body = self.tasks.get()
+            try:
+                fetch_callback(consumer, method, header, body)
+            except Exception:
+                log.exception('Error processing fetch message %s', body)
+            finally:
+                model.Session.remove()
+                with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+
+
+# threads consuming the queues of the local backend in this process
+_local_workers = []
+_local_workers_lock = threading.Lock()
+
+
+def start_local_workers():
+    '''
+    Starts the threads that process the queues of the local backend: one for
+    the gather queue and ``ckan.harvest.mq.local_workers`` for the fetch
+    queue. They are only started once per process, and not at all if
+    ``ckan.harvest.mq.local_workers`` is 0.
+    '''
+    num_workers = get_local_workers()
+    if num_workers < 1:
+        return
+    with _local_workers_lock:
+        if _local_workers:
+            return
+        consumers = [(get_gather_consumer, get_gather_queue_name(),
+                      gather_callback)]
+        consumers += [(get_fetch_consumer, get_fetch_queue_name(),
+                       fetch_callback)] * num_workers
+        for args in consumers:
+            thread = threading.Thread(target=_local_worker, args=args)
+            # they wait for messages forever, so don't keep the process alive
+            thread.daemon = True
+            thread.start()
+            _local_workers.append(thread)
+        log.info('Started %i local fetch threads', num_workers)
+
+
+def _local_worker(get_consumer, queue_name, callback):
+    consumer = get_consumer()
+    for method, header, body in consumer.consume(queue=queue_name):
+        try:
+            callback(consumer, method, header, body)
+        except Exception:
+            log.exception('Error processing message %s', body)
+        finally:
+            # with no broker to redeliver them, messages left unacknowledged
+            # are put back on the queue here
+            consumer.requeue_unacked(method.delivery_tag)
+            model.Session.remove()